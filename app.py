@@ -1,5 +1,14 @@
 import os
-from flask import Flask, request, render_template, redirect, url_for, session, jsonify
+from flask import (
+    Flask,
+    Response,
+    request,
+    render_template,
+    redirect,
+    url_for,
+    session,
+    jsonify,
+)
 import shutil
 import threading
 import time
@@ -9,12 +18,28 @@ import io
 import sys
 import builtins
 import base64
+import hmac
+import secrets
 
 # 从您现有的脚本导入训练函数
 # 确保 src 目录在 Python 路径中，或者调整导入方式
 sys.path.append(os.path.join(os.path.dirname(__file__), "src"))
 from federated_training import train_federated_model, set_flask_log_functions
 from federated_inference import run_inference
+from volume_manifest import get_volume_manifest
+from patch_store import DEFAULT_PATCH_STORE_DIR
+from client_selection import SELECTION_STRATEGIES
+from train_simple_model import CHECKPOINT_STAGES
+from update_compression import COMPRESSION_METHODS
+from round_checkpoint import DEFAULT_CHECKPOINT_PATH
+from server_optimizers import SERVER_OPTIMIZERS
+from remote_training import (
+    TOKEN_HEADER,
+    VERSION_HEADER,
+    RemoteTrainingSession,
+    StaleUpdateError,
+    UnknownClientError,
+)
 
 app = Flask(__name__)
 app.secret_key = "123456"
@@ -22,6 +47,11 @@ UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "upload
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# 结节标注文件（用于体数据清单中的标注数量）
+ANNOTATIONS_CSV = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "src", "annotations.csv"
+)
+
 # 推理文件上传目录
 INFERENCE_UPLOAD_FOLDER = os.path.join(UPLOAD_FOLDER, "server_inference")
 if not os.path.exists(INFERENCE_UPLOAD_FOLDER):
@@ -48,10 +78,24 @@ training_status = {
     "start_time": None,
     "end_time": None,
     "progress": 0,
+    "selected_clients": [],
+    "model_version": 0,
+    "staleness_histogram": {},
+    "update_throughput": 0.0,
+    "stop_reason": None,
 }
 
+# 每轮的分阶段训练耗时和吞吐量（由训练函数写入）
+training_metrics = {"rounds": []}
+
+# 进程外客户端代理的远程训练会话（由服务器通过start_remote_training启动）
+remote_session = None
+# 客户端代理的访问令牌：FL_AGENT_TOKEN环境变量，未设置时每次启动远程训练随机生成
+remote_agent_token = None
+
 # 设置全局变量，让训练函数能够访问
 builtins.app_training_status = training_status
+builtins.app_training_metrics = training_metrics
 
 # 全局推理状态
 inference_status = {
@@ -240,11 +284,12 @@ def upload_file():
     if uploaded_count == 0:
         return jsonify({"error": "没有成功上传文件"}), 400
 
-    # 计算总文件数（包括之前上传的）
-    all_files = os.listdir(client_upload_path)
-    total_mhd = len([f for f in all_files if f.lower().endswith(".mhd")])
-    total_raw = len([f for f in all_files if f.lower().endswith(".raw")])
-    total_files = len(all_files)
+    # 增量更新目录清单，并从清单计算总文件数（包括之前上传的）
+    manifest = get_volume_manifest(client_upload_path, ANNOTATIONS_CSV)
+    manifest.update(uploaded_filenames)
+    total_mhd = manifest.mhd_count
+    total_raw = manifest.raw_count
+    total_files = len(manifest.files)
 
     # 更新客户端状态
     client_data_status[username] = {
@@ -330,10 +375,85 @@ def start_training():
     data = request.get_json() if request.is_json else {}
     global_rounds = data.get("global_rounds", 5)  # 默认5轮
     local_epochs = data.get("local_epochs", 2)  # 默认2个本地epochs
+    batch_size = data.get("batch_size", 1)  # 默认batch size为1
+
+    # 数据加载参数
+    num_workers = data.get("num_workers", 0)  # 默认在主进程中加载
+    prefetch_factor = data.get("prefetch_factor", 2)
+    pin_memory = bool(data.get("pin_memory", False))
+    persistent_workers = bool(data.get("persistent_workers", True))
+    # 是否把客户端patch打包为分片存储后顺序读取
+    use_patch_store = bool(data.get("use_patch_store", False))
+    # 并行训练的客户端进程数，0表示依次训练
+    parallel_clients = data.get("parallel_clients", 0)
+    # 每轮参与训练的客户端比例、选择策略和随机种子
+    client_fraction = data.get("client_fraction", 1.0)
+    selection_strategy = data.get("selection_strategy", "uniform")
+    selection_seed = data.get("selection_seed")
+    # 异步缓冲聚合：每缓冲buffer_size个客户端更新就更新一次全局模型
+    asynchronous = bool(data.get("asynchronous", False))
+    buffer_size = data.get("buffer_size", 2)
+    # 本地训练是否使用bfloat16混合精度
+    mixed_precision = bool(data.get("mixed_precision", False))
+    # 做激活检查点的模型阶段（"all"或阶段名列表），用重算换内存
+    checkpoint_stages = data.get("checkpoint_stages")
+    # 客户端上传更新的压缩方式（delta/int8/topk），不设置时上传完整参数
+    update_compression = data.get("update_compression")
+    topk_ratio = data.get("topk_ratio", 0.01)
+    # 是否从上次中断的轮次检查点继续训练
+    resume = bool(data.get("resume", False))
+    # 聚合后的服务器优化器（fedavgm/fedadam/fedyogi）及其学习率
+    server_optimizer = data.get("server_optimizer")
+    server_optimizer_lr = data.get("server_optimizer_lr")
+    # 客户端是否跨轮次保留本地优化器动量
+    keep_optimizer_state = bool(data.get("keep_optimizer_state", False))
+    # 目标损失，训练历史记录首次达到的轮次
+    target_loss = data.get("target_loss")
+    # 验证集：每个客户端留出的体数据比例、验证patch数上限、评估间隔和早停设置
+    validation_fraction = data.get("validation_fraction", 0.0)
+    max_validation_patches = data.get("max_validation_patches", 32)
+    eval_every = data.get("eval_every", 1)
+    patience = data.get("patience")
+    min_delta = data.get("min_delta", 0.0)
+    # 重采样目标间距 (x, y, z)，例如[1.0, 1.0, 1.0]，随模型保存供推理使用；不设置时保持原始间距
+    target_spacing = data.get("target_spacing")
 
     # 参数验证
     global_rounds = max(1, min(20, int(global_rounds)))  # 限制在1-20之间
     local_epochs = max(1, min(10, int(local_epochs)))  # 限制在1-10之间
+    batch_size = max(1, min(16, int(batch_size)))  # 限制在1-16之间
+    num_workers = max(0, min(os.cpu_count() or 1, int(num_workers)))
+    prefetch_factor = max(1, min(16, int(prefetch_factor)))
+    parallel_clients = max(0, min(os.cpu_count() or 1, int(parallel_clients)))
+    client_fraction = max(0.01, min(1.0, float(client_fraction)))
+    if selection_strategy not in SELECTION_STRATEGIES:
+        selection_strategy = "uniform"
+    selection_seed = int(selection_seed) if selection_seed is not None else None
+    buffer_size = max(1, min(64, int(buffer_size)))
+    if update_compression not in COMPRESSION_METHODS:
+        update_compression = None
+    topk_ratio = max(1e-4, min(1.0, float(topk_ratio)))
+    if server_optimizer not in SERVER_OPTIMIZERS:
+        server_optimizer = None
+    server_optimizer_lr = (
+        max(1e-5, min(10.0, float(server_optimizer_lr)))
+        if server_optimizer_lr is not None
+        else None
+    )
+    target_loss = float(target_loss) if target_loss is not None else None
+    validation_fraction = max(0.0, min(0.5, float(validation_fraction)))
+    max_validation_patches = max(1, min(512, int(max_validation_patches)))
+    eval_every = max(1, min(global_rounds, int(eval_every)))
+    patience = max(1, min(20, int(patience))) if patience is not None else None
+    min_delta = max(0.0, float(min_delta))
+    if target_spacing is not None:
+        target_spacing = tuple(max(0.1, min(10.0, float(s))) for s in target_spacing)
+        if len(target_spacing) != 3:
+            target_spacing = None
+    if checkpoint_stages != "all":
+        checkpoint_stages = [
+            stage for stage in checkpoint_stages or [] if stage in CHECKPOINT_STAGES
+        ] or None
 
     client_paths_for_training = []
     for client_name, status in client_data_status.items():
@@ -356,8 +476,14 @@ def start_training():
             "start_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "end_time": None,
             "progress": 0,
+            "selected_clients": [],
+            "model_version": 0,
+            "staleness_histogram": {},
+            "update_throughput": 0.0,
+            "stop_reason": None,
         }
     )
+    training_metrics["rounds"] = []
 
     add_server_log(
         f"开始联邦学习训练 - {num_active_clients} 个客户端参与 (全局轮数: {global_rounds}, 本地轮数: {local_epochs})"
@@ -373,6 +499,58 @@ def start_training():
             add_training_log(f"参与训练的客户端数量: {num_active_clients}")
             add_training_log(f"全局训练轮数: {global_rounds}")
             add_training_log(f"本地训练轮数: {local_epochs}")
+            add_training_log(f"批大小: {batch_size}")
+            add_training_log(
+                f"数据加载进程数: {num_workers}, 预取: {prefetch_factor}, 锁页内存: {pin_memory}"
+            )
+            if parallel_clients > 1:
+                add_training_log(f"并行训练进程数: {parallel_clients}")
+            if use_patch_store:
+                add_training_log(f"使用分片patch存储: {DEFAULT_PATCH_STORE_DIR}")
+            if client_fraction < 1.0 or selection_strategy != "uniform":
+                add_training_log(
+                    f"客户端选择: 策略={selection_strategy}, 比例={client_fraction}, "
+                    f"种子={selection_seed}"
+                )
+            if asynchronous:
+                add_training_log(f"异步缓冲聚合: 缓冲区大小 {buffer_size}")
+            if mixed_precision:
+                add_training_log("本地训练使用bfloat16混合精度")
+            if checkpoint_stages:
+                add_training_log(f"激活检查点阶段: {checkpoint_stages}")
+            if server_optimizer:
+                add_training_log(
+                    f"服务器优化器: {server_optimizer}"
+                    + (
+                        f" (学习率 {server_optimizer_lr})"
+                        if server_optimizer_lr is not None
+                        else ""
+                    )
+                )
+            if keep_optimizer_state:
+                add_training_log("客户端跨轮次保留优化器状态")
+            if target_loss is not None:
+                add_training_log(f"目标损失: {target_loss}")
+            if validation_fraction > 0:
+                add_training_log(
+                    f"验证集: 每个客户端留出 {validation_fraction:.0%} 的体数据, "
+                    f"最多 {max_validation_patches} 个patch, 每 {eval_every} 轮评估"
+                )
+            if patience is not None:
+                add_training_log(f"早停: patience={patience}, min_delta={min_delta}")
+            if target_spacing is not None:
+                add_training_log(f"重采样目标间距: {target_spacing} mm")
+            if resume:
+                add_training_log(f"从轮次检查点继续训练: {DEFAULT_CHECKPOINT_PATH}")
+            if update_compression:
+                add_training_log(
+                    f"上传更新压缩: {update_compression}"
+                    + (
+                        f" (保留比例 {topk_ratio})"
+                        if update_compression == "topk"
+                        else ""
+                    )
+                )
             add_training_log(f"客户端数据路径: {client_paths_for_training}")
 
             # 设置联邦训练的日志函数，使训练过程中的日志能够在Web界面显示
@@ -384,17 +562,49 @@ def start_training():
                 global_rounds=global_rounds,
                 local_epochs=local_epochs,
                 client_data_dirs=client_paths_for_training,
+                num_workers=num_workers,
+                prefetch_factor=prefetch_factor,
+                pin_memory=pin_memory,
+                persistent_workers=persistent_workers,
+                batch_size=batch_size,
+                patch_store_dir=DEFAULT_PATCH_STORE_DIR if use_patch_store else None,
+                parallel_clients=parallel_clients,
+                client_fraction=client_fraction,
+                selection_strategy=selection_strategy,
+                selection_seed=selection_seed,
+                asynchronous=asynchronous,
+                buffer_size=buffer_size,
+                mixed_precision=mixed_precision,
+                checkpoint_stages=checkpoint_stages,
+                update_compression=update_compression,
+                topk_ratio=topk_ratio,
+                checkpoint_path=DEFAULT_CHECKPOINT_PATH,
+                resume=resume,
+                server_optimizer=server_optimizer,
+                server_optimizer_lr=server_optimizer_lr,
+                keep_optimizer_state=keep_optimizer_state,
+                target_loss=target_loss,
+                validation_fraction=validation_fraction,
+                max_validation_patches=max_validation_patches,
+                eval_every=eval_every,
+                patience=patience,
+                min_delta=min_delta,
+                target_spacing=target_spacing,
             )
 
-            # 更新训练状态
+            # 更新训练状态（早停时current_round为实际完成的轮数）
+            history = coordinator.server.training_history if coordinator else {}
             training_status.update(
                 {
                     "is_training": False,
-                    "current_round": global_rounds,
+                    "current_round": (history.get("rounds") or [global_rounds])[-1],
                     "end_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                     "progress": 100,
+                    "stop_reason": history.get("stop_reason"),
                 }
             )
+            if history.get("stop_reason"):
+                add_training_log(f"训练结束原因: {history['stop_reason']}")
 
             if coordinator:
                 add_server_log("联邦学习训练成功完成")
@@ -447,6 +657,189 @@ def get_server_status():
     return jsonify(response_data)
 
 
+@app.route("/server/start_remote_training", methods=["POST"])
+def start_remote_training():
+    """
+    启动远程联邦训练，由各客户端机器上的client_agent.py用本地数据训练
+
+    客户端代理必须提供访问令牌：使用FL_AGENT_TOKEN环境变量，未设置时随机生成一个，
+    写入服务器日志并在响应中返回，由服务器管理员分发给各客户端
+    """
+    global remote_session, remote_agent_token
+    if "username" not in session or session["role"] != "server":
+        return jsonify({"error": "未授权"}), 403
+
+    if training_status["is_training"]:
+        return jsonify({"error": "训练正在进行中"}), 400
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "请求体必须是JSON对象"}), 400
+    try:
+        num_clients = max(1, min(64, int(data.get("num_clients", 2))))
+        global_rounds = max(1, min(20, int(data.get("global_rounds", 5))))
+        local_epochs = max(1, min(10, int(data.get("local_epochs", 2))))
+        topk_ratio = max(1e-4, min(1.0, float(data.get("topk_ratio", 0.01))))
+    except (TypeError, ValueError):
+        return jsonify({"error": "训练参数必须是数字"}), 400
+    update_compression = data.get("update_compression", "int8")
+    if update_compression not in COMPRESSION_METHODS:
+        update_compression = "int8"
+    mixed_precision = bool(data.get("mixed_precision", False))
+
+    training_status.update(
+        {
+            "is_training": True,
+            "current_round": 0,
+            "total_rounds": global_rounds,
+            "active_clients": num_clients,
+            "start_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "end_time": None,
+            "progress": 0,
+            "selected_clients": [],
+            "stop_reason": None,
+        }
+    )
+    set_flask_log_functions(add_training_log, add_server_log)
+    remote_session = RemoteTrainingSession(
+        num_clients=num_clients,
+        global_rounds=global_rounds,
+        local_epochs=local_epochs,
+        update_compression=update_compression,
+        topk_ratio=topk_ratio,
+        mixed_precision=mixed_precision,
+    )
+    remote_agent_token = os.environ.get("FL_AGENT_TOKEN") or secrets.token_urlsafe(16)
+    add_server_log(
+        f"开始远程联邦学习训练 - 每轮 {num_clients} 个客户端代理 "
+        f"(全局轮数: {global_rounds}, 本地轮数: {local_epochs}, 压缩: {update_compression})"
+    )
+    if not os.environ.get("FL_AGENT_TOKEN"):
+        add_server_log(
+            f"未设置FL_AGENT_TOKEN，本次远程训练的客户端代理令牌: {remote_agent_token}"
+        )
+    return jsonify(
+        {
+            "message": "远程训练已启动，等待客户端代理连接",
+            "token": remote_agent_token,
+        }
+    )
+
+
+@app.route("/server/stop_remote_training", methods=["POST"])
+def stop_remote_training():
+    """停止远程联邦训练，客户端代理在下次查询状态时退出"""
+    if "username" not in session or session["role"] != "server":
+        return jsonify({"error": "未授权"}), 403
+
+    if remote_session is None or not remote_session.stop():
+        return jsonify({"error": "没有正在进行的远程训练"}), 400
+    add_server_log(f"远程联邦学习训练已停止 (完成 {remote_session.version} 轮)")
+    return jsonify({"message": "远程训练已停止", "version": remote_session.version})
+
+
+def check_agent_request():
+    """
+    校验客户端代理请求：远程训练已启动，且令牌与启动时的令牌一致
+
+    Returns:
+        出错时的响应，否则为None
+    """
+    if remote_session is None:
+        return jsonify({"error": "远程训练尚未启动"}), 404
+    if not hmac.compare_digest(
+        request.headers.get(TOKEN_HEADER, ""), remote_agent_token
+    ):
+        return jsonify({"error": "令牌无效"}), 403
+    return None
+
+
+@app.route("/api/fl/register", methods=["POST"])
+def fl_register():
+    """客户端代理注册，返回客户端序号和训练配置"""
+    error = check_agent_request()
+    if error:
+        return error
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "请求体必须是JSON对象"}), 400
+    try:
+        data_size = int(data.get("data_size", 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "data_size必须是整数"}), 400
+    if data_size < 0:
+        return jsonify({"error": "data_size不能为负数"}), 400
+    return jsonify(remote_session.register(str(data.get("name", "agent")), data_size))
+
+
+@app.route("/api/fl/status", methods=["GET"])
+def fl_status():
+    """当前全局模型版本和训练是否结束"""
+    error = check_agent_request()
+    if error:
+        return error
+    return jsonify(remote_session.status())
+
+
+@app.route("/api/fl/model", methods=["GET"])
+def fl_model():
+    """下载当前版本的全局模型"""
+    error = check_agent_request()
+    if error:
+        return error
+    version, body = remote_session.model_bytes()
+    return Response(
+        body,
+        mimetype="application/octet-stream",
+        headers={VERSION_HEADER: str(version)},
+    )
+
+
+@app.route("/api/fl/update", methods=["POST"])
+def fl_update():
+    """接收客户端代理的压缩更新"""
+    error = check_agent_request()
+    if error:
+        return error
+    try:
+        client_id = int(request.args["client_id"])
+        base_version = int(request.args["base_version"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "缺少client_id或base_version"}), 400
+
+    try:
+        version = remote_session.submit_update(
+            client_id, base_version, request.get_data()
+        )
+    except UnknownClientError as e:
+        return jsonify({"error": str(e)}), 404
+    except StaleUpdateError as e:
+        return jsonify({"error": str(e)}), 409
+    except ValueError as e:
+        add_server_log(f"拒绝客户端代理 {client_id} 的更新: {e}")
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        add_server_log(f"处理客户端代理更新失败: {e}")
+        return jsonify({"error": f"无法解析更新: {e}"}), 400
+    return jsonify({"accepted": True, "version": version})
+
+
+@app.route("/api/server/training_metrics", methods=["GET"])
+def get_training_metrics():
+    """获取每轮分阶段训练耗时和吞吐量API"""
+    if "username" not in session or session["role"] != "server":
+        return jsonify({"error": "未授权"}), 403
+
+    rounds = list(training_metrics["rounds"])
+    return jsonify(
+        {
+            "rounds": rounds,
+            "latest": rounds[-1] if rounds else None,
+            "is_training": training_status["is_training"],
+        }
+    )
+
+
 @app.route("/api/server/logs", methods=["GET"])
 def get_logs():
     """获取日志API"""
@@ -476,19 +869,18 @@ def initialize_client_data_status():
 
             # 检查客户端数据目录是否存在
             if os.path.exists(client_data_dir):
-                # 检查是否有有效的数据文件
-                files = os.listdir(client_data_dir)
-                mhd_files = [f for f in files if f.endswith(".mhd")]
-                raw_files = [f for f in files if f.endswith(".raw")]
+                # 通过目录清单检查是否有有效的数据文件（只对变化的文件重新登记）
+                manifest = get_volume_manifest(client_data_dir, ANNOTATIONS_CSV)
+                manifest.refresh()
 
-                if mhd_files and raw_files:
+                if manifest.mhd_count and manifest.raw_count:
                     client_data_status[username] = {
                         "uploaded": True,
                         "data_path": client_data_dir,
                         "last_login": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "file_count": len(mhd_files),
+                        "file_count": manifest.mhd_count,
                     }
-                    print(f"✅ 检测到 {username} 的数据: {len(mhd_files)} 个文件")
+                    print(f"✅ 检测到 {username} 的数据: {manifest.mhd_count} 个文件")
                 else:
                     print(f"⚠️ {username} 的数据目录存在但无有效数据文件")
             else:
@@ -580,6 +972,11 @@ def upload_inference_file():
             uploaded_files.extend([mhd_filename, raw_filename])
             add_server_log(f"推理文件对上传成功: {mhd_filename}, {raw_filename}")
 
+            # 登记到推理目录清单
+            get_volume_manifest(INFERENCE_UPLOAD_FOLDER, ANNOTATIONS_CSV).update(
+                [mhd_filename, raw_filename]
+            )
+
         except Exception as e:
             errors.append(f"上传文件对失败 {mhd_file.filename}: {str(e)}")
 
@@ -607,36 +1004,28 @@ def list_inference_files():
 
     files = []
     if os.path.exists(INFERENCE_UPLOAD_FOLDER):
-        for filename in os.listdir(INFERENCE_UPLOAD_FOLDER):
-            if filename.lower().endswith(".mhd"):
-                file_path = os.path.join(INFERENCE_UPLOAD_FOLDER, filename)
-                stat = os.stat(file_path)
-
-                # 检查对应的.raw文件是否存在
-                base_name = os.path.splitext(filename)[0]
-                raw_filename = base_name + ".raw"
-                raw_path = os.path.join(INFERENCE_UPLOAD_FOLDER, raw_filename)
-                has_raw_file = os.path.exists(raw_path)
-
-                raw_size = 0
-                if has_raw_file:
-                    raw_stat = os.stat(raw_path)
-                    raw_size = raw_stat.st_size
-
-                files.append(
-                    {
-                        "name": filename,
-                        "path": file_path,
-                        "size": stat.st_size,
-                        "raw_file": raw_filename if has_raw_file else None,
-                        "raw_size": raw_size,
-                        "total_size": stat.st_size + raw_size,
-                        "has_pair": has_raw_file,
-                        "upload_time": datetime.fromtimestamp(stat.st_mtime).strftime(
-                            "%Y-%m-%d %H:%M:%S"
-                        ),
-                    }
-                )
+        # 直接读取推理目录清单，不再扫描目录
+        manifest = get_volume_manifest(INFERENCE_UPLOAD_FOLDER, ANNOTATIONS_CSV)
+        for filename, entry in sorted(manifest.volumes.items()):
+            if not filename.lower().endswith(".mhd"):
+                continue
+            has_raw_file = entry["has_raw"]
+            raw_size = entry["raw_size"] if has_raw_file else 0
+
+            files.append(
+                {
+                    "name": filename,
+                    "path": os.path.join(INFERENCE_UPLOAD_FOLDER, filename),
+                    "size": entry["mhd_size"],
+                    "raw_file": entry["raw_file"] if has_raw_file else None,
+                    "raw_size": raw_size,
+                    "total_size": entry["mhd_size"] + raw_size,
+                    "has_pair": has_raw_file,
+                    "upload_time": entry["modified_time"],
+                    "shape": entry["shape"],
+                    "spacing": entry["spacing"],
+                }
+            )
 
     return jsonify({"files": files})
 
@@ -820,6 +1209,9 @@ def delete_inference_file():
     if not deleted_files:
         return jsonify({"error": "文件不存在"}), 404
 
+    # 从推理目录清单中移除
+    get_volume_manifest(INFERENCE_UPLOAD_FOLDER, ANNOTATIONS_CSV).remove(deleted_files)
+
     # 从上传文件列表中移除
     inference_status["uploaded_files"] = [
         f
@@ -834,8 +1226,30 @@ def delete_inference_file():
     return jsonify({"message": response_message, "deleted_files": deleted_files})
 
 
-# 在应用启动时初始化客户端数据状态
-initialize_client_data_status()
+_app_initialized = False
+_app_init_lock = threading.Lock()
+
+
+@app.before_request
+def initialize_app():
+    """
+    启动后的一次性初始化（在第一个请求前执行）：检测客户端数据、同步推理目录清单
+
+    不在模块导入时执行：并行训练以spawn方式启动的子进程会把本模块作为__mp_main__重新导入，
+    每个子进程都会重新哈希上传文件、并发改写同一个清单文件
+    """
+    global _app_initialized
+    if _app_initialized:
+        return
+    with _app_init_lock:
+        if _app_initialized:
+            return
+        # 初始化客户端数据状态
+        initialize_client_data_status()
+        # 同步推理目录清单（只登记清单之外新增或变化的文件）
+        get_volume_manifest(INFERENCE_UPLOAD_FOLDER, ANNOTATIONS_CSV).refresh()
+        _app_initialized = True
+
 
 if __name__ == "__main__":
     # 添加一些初始日志
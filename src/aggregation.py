@@ -0,0 +1,422 @@
+"""
+联邦平均的向量化聚合
+把每个客户端的浮点参数展平成一个向量并按客户端堆叠，
+加权平均用一次矩阵向量乘法完成，代替逐参数、逐客户端的小张量运算
+
+堆叠矩阵按内存上限分块，客户端很多时也不会一次性占用 客户端数 x 参数量 的内存
+
+BufferedAsyncAggregator实现FedBuff式的异步缓冲聚合，服务器不再等待最慢的客户端
+"""
+
+import math
+from collections import Counter, OrderedDict
+
+import torch
+
+# 单个堆叠块的最大字节数
+DEFAULT_MAX_STACK_BYTES = 256 * 1024**2
+
+
+def is_averaged(name, tensor):
+    """
+    参数是否参与加权平均
+
+    num_batches_tracked和整型缓冲区不做平均，直接取第一个客户端的值
+    """
+    if name.endswith("num_batches_tracked"):
+        return False
+    return tensor.dtype not in (torch.int32, torch.int64, torch.long)
+
+
+def _contiguous_view(tensors):
+    """
+    如果这些张量在同一块存储上首尾相接（例如扁平参数存储的视图），
+    返回覆盖它们的一维视图，否则返回None
+    """
+    first = tensors[0]
+    if first.dtype != torch.float32:
+        return None
+    storage_ptr = first.untyped_storage().data_ptr()
+    offset = first.storage_offset()
+    for tensor in tensors:
+        if (
+            tensor.dtype != torch.float32
+            or not tensor.is_contiguous()
+            or tensor.untyped_storage().data_ptr() != storage_ptr
+            or tensor.storage_offset() != offset
+        ):
+            return None
+        offset += tensor.numel()
+    start = first.storage_offset()
+    return first.as_strided((offset - start,), (1,), start)
+
+
+def _stacked_view(flat_views):
+    """
+    如果各客户端的展平参数是同一矩阵中连续的若干行（FlatParameterStore.stacked创建），
+    返回 (只含这些行的矩阵视图, 每个客户端对应的行号)，否则返回None
+
+    只选中部分客户端且行不连续时返回None：矩阵乘法会覆盖未选中的行，
+    计算量随全部客户端数增长，且未选中行中的NaN/inf也会污染结果（0·NaN = NaN）
+    """
+    if any(view is None for view in flat_views):
+        return None
+    first = flat_views[0]
+    num_elements = first.numel()
+    storage_ptr = first.untyped_storage().data_ptr()
+    base = min(view.storage_offset() for view in flat_views)
+    rows = []
+    for view in flat_views:
+        delta = view.storage_offset() - base
+        if view.untyped_storage().data_ptr() != storage_ptr or delta % num_elements:
+            return None
+        rows.append(delta // num_elements)
+    if max(rows) + 1 != len(set(rows)):
+        return None
+    matrix = first.as_strided((max(rows) + 1, num_elements), (num_elements, 1), base)
+    return matrix, rows
+
+
+def flatten_params(params, names, out=None):
+    """
+    把指定参数展平拼接成一个float32向量
+
+    Args:
+        params: 参数字典
+        names: 参数名列表
+        out: 写入的一维float32张量，None时新建（参数本身连续存放时直接返回零拷贝视图）
+
+    Returns:
+        一维float32张量
+    """
+    tensors = [params[name] for name in names]
+    view = _contiguous_view(tensors)
+    if view is not None:
+        return view if out is None else out.copy_(view)
+    if any(t.dtype != torch.float32 for t in tensors):
+        tensors = [t.float() for t in tensors]
+    return torch.cat([t.reshape(-1) for t in tensors], out=out)
+
+
+def unflatten_params(flat, template, names):
+    """
+    把一维向量按模板参数的形状和类型拆分回参数字典
+
+    Args:
+        flat: 一维张量
+        template: 提供形状和数据类型的参数字典
+        names: 参数名列表（与展平时的顺序一致）
+
+    Returns:
+        OrderedDict: 参数名 -> 张量
+    """
+    params = OrderedDict()
+    offset = 0
+    for name in names:
+        tensor = template[name]
+        numel = tensor.numel()
+        value = flat[offset : offset + numel].view(tensor.shape)
+        params[name] = value if tensor.dtype == flat.dtype else value.to(tensor.dtype)
+        offset += numel
+    return params
+
+
+def _weighted_sum(client_params_list, normalized_weights, names, max_stack_bytes):
+    """对指定的浮点参数做加权求和，返回一维float32向量"""
+    first_params = client_params_list[0]
+    device = first_params[names[0]].device
+    num_elements = sum(first_params[name].numel() for name in names)
+    accumulator = torch.zeros(num_elements, dtype=torch.float32, device=device)
+
+    # 客户端参数本身就是同一矩阵中连续的行时，直接做一次矩阵向量乘法，零拷贝
+    stacked_view = _stacked_view(
+        [
+            _contiguous_view([params[name] for name in names])
+            for params in client_params_list
+        ]
+    )
+    if stacked_view is not None:
+        matrix, rows = stacked_view
+        row_weights = torch.zeros(matrix.shape[0], dtype=torch.float32)
+        for row, weight in zip(rows, normalized_weights):
+            row_weights[row] += weight
+        return accumulator.addmv_(matrix.t(), row_weights.to(device))
+
+    # 否则按块展平堆叠，堆叠缓冲区在各块之间复用，每个客户端的参数只拷贝一次
+    weights = torch.tensor(normalized_weights, dtype=torch.float32, device=device)
+    chunk_size = max(1, max_stack_bytes // (num_elements * 4))
+    stacked = torch.empty(
+        (min(chunk_size, len(client_params_list)), num_elements),
+        dtype=torch.float32,
+        device=device,
+    )
+    for start in range(0, len(client_params_list), chunk_size):
+        chunk = client_params_list[start : start + chunk_size]
+        rows = stacked[: len(chunk)]
+        for row, params in zip(rows, chunk):
+            flatten_params(params, names, out=row)
+        accumulator.addmv_(rows.t(), weights[start : start + len(chunk)])
+    return accumulator
+
+
+def vectorized_fedavg(
+    client_params_list, normalized_weights, max_stack_bytes=DEFAULT_MAX_STACK_BYTES
+):
+    """
+    向量化的联邦平均
+
+    Args:
+        client_params_list: 客户端参数字典列表
+        normalized_weights: 归一化后的客户端权重
+        max_stack_bytes: 单个堆叠块的最大字节数
+
+    Returns:
+        OrderedDict: 聚合后的参数（顺序与第一个客户端一致）
+    """
+    first_params = client_params_list[0]
+    averaged_names = [
+        name for name, tensor in first_params.items() if is_averaged(name, tensor)
+    ]
+
+    averaged = {}
+    if averaged_names:
+        flat = _weighted_sum(
+            client_params_list, normalized_weights, averaged_names, max_stack_bytes
+        )
+        averaged = unflatten_params(flat, first_params, averaged_names)
+
+    global_params = OrderedDict()
+    for name, tensor in first_params.items():
+        if name in averaged:
+            global_params[name] = averaged[name]
+        else:
+            # 对于不需要聚合的参数，直接使用第一个客户端的值
+            global_params[name] = tensor.clone()
+    return global_params
+
+
+class StreamingAggregator:
+    """
+    在线联邦平均：客户端训练完成后立即把参数折叠进加权和，不再保留完整的参数列表，
+    服务器内存与客户端数量无关
+
+    权重在本轮开始时按参与客户端的数据量归一化，按客户端顺序执行 acc += w * x，
+    与原有逐参数FedAvg的浮点运算顺序一致；先于前序客户端完成的客户端暂存引用，
+    等前序客户端折叠后再折叠
+    """
+
+    def __init__(self, client_weights):
+        """
+        Args:
+            client_weights: 客户端键 -> 权重（通常为数据量），字典顺序即折叠顺序
+        """
+        total_weight = sum(client_weights.values())
+        self.order = list(client_weights)
+        self.normalized_weights = {
+            key: weight / total_weight for key, weight in client_weights.items()
+        }
+        self.num_folded = 0
+        self._pending = {}
+
+        self.template = None
+        self.averaged_names = None
+        self.accumulator = None
+        self._scratch = None
+
+    @property
+    def complete(self):
+        """是否所有客户端都已折叠"""
+        return self.num_folded == len(self.order)
+
+    def add(self, key, params):
+        """
+        加入一个客户端的参数
+
+        Args:
+            key: 客户端键（与client_weights中的键一致）
+            params: 客户端参数字典，折叠后不再被引用
+        """
+        if key not in self.normalized_weights:
+            raise KeyError(f"未登记的客户端: {key}")
+        self._pending[key] = params
+        while not self.complete and self.order[self.num_folded] in self._pending:
+            key = self.order[self.num_folded]
+            self._fold(self._pending.pop(key), self.normalized_weights[key])
+            self.num_folded += 1
+
+    def _fold(self, params, weight):
+        if self.accumulator is None:
+            # 第一个客户端：确定参数结构，并保留不参与平均的参数
+            self.averaged_names = [
+                name for name, tensor in params.items() if is_averaged(name, tensor)
+            ]
+            # 参与平均的参数只需记录形状和类型（meta张量不占内存）
+            averaged = set(self.averaged_names)
+            self.template = OrderedDict(
+                (
+                    name,
+                    (
+                        torch.empty(tensor.shape, dtype=tensor.dtype, device="meta")
+                        if name in averaged
+                        else tensor.clone()
+                    ),
+                )
+                for name, tensor in params.items()
+            )
+            num_elements = sum(params[name].numel() for name in self.averaged_names)
+            device = params[self.averaged_names[0]].device
+            self.accumulator = torch.zeros(
+                num_elements, dtype=torch.float32, device=device
+            )
+            self._scratch = torch.empty_like(self.accumulator)
+
+        flat = flatten_params(params, self.averaged_names)
+        torch.mul(flat, weight, out=self._scratch)
+        self.accumulator += self._scratch
+
+    def result(self):
+        """
+        返回聚合后的全局参数
+
+        Returns:
+            OrderedDict: 参数顺序与客户端state_dict一致
+        """
+        if not self.complete:
+            raise RuntimeError(
+                f"还有 {len(self.order) - self.num_folded} 个客户端的参数未折叠"
+            )
+        averaged = unflatten_params(
+            self.accumulator, self.template, self.averaged_names
+        )
+        global_params = OrderedDict()
+        for name, tensor in self.template.items():
+            global_params[name] = averaged[name] if name in averaged else tensor
+        return global_params
+
+
+def staleness_weight(staleness):
+    """过时更新的权重衰减 1/sqrt(1+s)，s为客户端拉取模型后服务器更新的次数"""
+    return 1.0 / math.sqrt(1.0 + staleness)
+
+
+class BufferedAsyncAggregator:
+    """
+    FedBuff式异步缓冲聚合
+
+    客户端从服务器拉取当前版本的全局模型后独立训练，完成后把参数增量
+    （训练后参数 - 拉取时的全局参数）交给服务器；缓冲满K个增量时服务器更新一次全局模型，
+    版本号加一。增量按数据量加权，并按过时程度 1/sqrt(1+s) 衰减
+
+    全局模型直接在服务器的扁平存储上原地更新；客户端拉取时的全局参数按版本保存快照，
+    没有客户端再引用时释放。增量在加入时即折叠进加权和，缓冲区不保存各客户端的增量
+    """
+
+    def __init__(self, global_store, buffer_size=2, server_lr=1.0):
+        """
+        Args:
+            global_store: 服务器全局模型的FlatParameterStore
+            buffer_size: 每次更新全局模型所需的客户端增量数K
+            server_lr: 服务器学习率，全局参数 += server_lr * 加权平均增量
+        """
+        self.global_store = global_store
+        self.buffer_size = buffer_size
+        self.server_lr = server_lr
+
+        self.version = 0
+        self.num_updates = 0
+        self.staleness_histogram = Counter()
+
+        # 版本号 -> [浮点扁平张量快照, 引用该版本的客户端数]
+        self._snapshots = {}
+        self._accumulators = None
+        self._buffered = 0
+        self._buffered_weight = 0.0
+
+    def pull(self, client_store):
+        """
+        把当前版本的全局模型拷贝到客户端
+
+        Args:
+            client_store: 客户端的FlatParameterStore
+
+        Returns:
+            int: 客户端拉取的模型版本号，交回增量时传给add
+        """
+        client_store.copy_from(self.global_store)
+        if self.version not in self._snapshots:
+            self._snapshots[self.version] = [
+                {
+                    dtype: tensor.clone()
+                    for dtype, tensor in self.global_store.flat_buffers.items()
+                    if tensor.is_floating_point()
+                },
+                0,
+            ]
+        self._snapshots[self.version][1] += 1
+        return self.version
+
+    def add(self, client_store, base_version, weight):
+        """
+        加入一个客户端的训练结果
+
+        Args:
+            client_store: 训练完成的客户端FlatParameterStore
+            base_version: 客户端训练前拉取的版本号（pull的返回值）
+            weight: 客户端权重（通常为数据量）
+
+        Returns:
+            int: 本次更新的过时程度（拉取后服务器已更新的次数）
+        """
+        snapshot = self._snapshots[base_version]
+        staleness = self.version - base_version
+        self.staleness_histogram[staleness] += 1
+        self.num_updates += 1
+
+        scaled_weight = weight * staleness_weight(staleness)
+        if self._accumulators is None:
+            self._accumulators = {
+                dtype: torch.zeros_like(base) for dtype, base in snapshot[0].items()
+            }
+        with torch.no_grad():
+            for dtype, base in snapshot[0].items():
+                delta = client_store.flat_buffers[dtype] - base
+                self._accumulators[dtype].add_(delta, alpha=scaled_weight)
+        self._buffered += 1
+        self._buffered_weight += weight
+
+        snapshot[1] -= 1
+        self._release_snapshots()
+
+        if self._buffered >= self.buffer_size:
+            self._apply(client_store)
+        return staleness
+
+    def _apply(self, client_store):
+        """用缓冲的增量更新全局模型"""
+        # 按缓冲区内的总数据量归一化，无过时时等价于对这K个客户端做FedAvg
+        scale = self.server_lr / self._buffered_weight
+        with torch.no_grad():
+            for dtype, tensor in self.global_store.flat_buffers.items():
+                if dtype in self._accumulators:
+                    tensor.add_(self._accumulators[dtype], alpha=scale)
+                    self._accumulators[dtype].zero_()
+                else:
+                    # num_batches_tracked等整型缓冲区取最新客户端的值
+                    tensor.copy_(client_store.flat_buffers[dtype])
+        self._buffered = 0
+        self._buffered_weight = 0.0
+        self.version += 1
+        self._release_snapshots()
+
+    def _release_snapshots(self):
+        """释放没有客户端引用的旧版本快照（当前版本的快照留给后续拉取）"""
+        for version in [
+            version
+            for version, (_, refs) in self._snapshots.items()
+            if refs == 0 and version != self.version
+        ]:
+            del self._snapshots[version]
+
+    def staleness_summary(self):
+        """过时程度直方图 {过时轮数: 更新数}，按过时程度排序"""
+        return dict(sorted(self.staleness_histogram.items()))
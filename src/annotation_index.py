@@ -0,0 +1,103 @@
+"""
+结节标注索引
+annotations.csv在进程内只读取一次，按seriesuid分组为连续的NumPy数组，
+提供O(1)的按序列查询；CSV文件的mtime变化时才重新加载
+
+同一进程中的所有数据集和预测器通过 get_annotation_index() 共享同一个索引
+"""
+
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+
+class AnnotationIndex:
+    """按seriesuid分组的结节标注索引"""
+
+    def __init__(self, csv_path):
+        """
+        读取标注文件并建立索引
+
+        Args:
+            csv_path: annotations.csv路径
+        """
+        self.csv_path = csv_path
+        self.mtime_ns = os.stat(csv_path).st_mtime_ns
+
+        annotations = pd.read_csv(csv_path).sort_values("seriesuid", kind="stable")
+        series_uids = annotations["seriesuid"].to_numpy().astype(str)
+
+        # 同一序列的标注在数组中连续存放
+        self.coords = np.ascontiguousarray(
+            annotations[["coordX", "coordY", "coordZ"]].to_numpy(dtype=np.float64)
+        )
+        self.diameters = np.ascontiguousarray(
+            annotations["diameter_mm"].to_numpy(dtype=np.float64)
+        )
+
+        unique_uids, starts, counts = np.unique(
+            series_uids, return_index=True, return_counts=True
+        )
+        self._slices = {
+            uid: slice(int(start), int(start + count))
+            for uid, start, count in zip(unique_uids, starts, counts)
+        }
+        # 索引在数据集和预测器之间共享，get()返回的视图不允许原地修改
+        self.coords.flags.writeable = False
+        self.diameters.flags.writeable = False
+
+    def __len__(self):
+        return len(self.diameters)
+
+    def __contains__(self, series_uid):
+        return series_uid in self._slices
+
+    @property
+    def series_uids(self):
+        """所有有标注的序列UID"""
+        return list(self._slices)
+
+    def count(self, series_uid):
+        """某个序列的标注数量"""
+        sl = self._slices.get(series_uid)
+        return 0 if sl is None else sl.stop - sl.start
+
+    def get(self, series_uid):
+        """
+        获取某个序列的所有标注
+
+        Args:
+            series_uid: 序列UID
+
+        Returns:
+            tuple: (coords, diameters)，coords为 (N, 3) 世界坐标 (x, y, z)，
+                   diameters为 (N,) 直径(mm)；均为只读视图，无标注时N为0
+        """
+        sl = self._slices.get(series_uid, slice(0, 0))
+        return self.coords[sl], self.diameters[sl]
+
+
+_index_registry = {}
+_index_lock = threading.Lock()
+
+
+def get_annotation_index(csv_path):
+    """
+    获取进程内共享的标注索引，CSV的mtime变化时自动重新加载
+
+    Args:
+        csv_path: annotations.csv路径
+
+    Returns:
+        AnnotationIndex实例
+    """
+    path = os.path.abspath(csv_path)
+    mtime_ns = os.stat(path).st_mtime_ns
+
+    with _index_lock:
+        index = _index_registry.get(path)
+        if index is None or index.mtime_ns != mtime_ns:
+            index = AnnotationIndex(path)
+            _index_registry[path] = index
+        return index
@@ -0,0 +1,603 @@
+"""
+性能基准测试
+
+用法:
+    python benchmarks.py label_rasterization
+    python benchmarks.py fedavg
+    python benchmarks.py mixed_precision
+    python benchmarks.py activation_checkpointing
+    python benchmarks.py update_compression
+    python benchmarks.py server_optimizers
+    python benchmarks.py step_timer
+"""
+
+import copy
+import sys
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+import numpy as np
+import torch
+
+from train_simple_model import (
+    DiceLoss,
+    Simple3DUNet,
+    autocast_context,
+    rasterize_nodules,
+)
+from aggregation import vectorized_fedavg
+from flat_params import FlatParameterStore, peak_rss_mb
+from training_metrics import STEP_PHASES, StepTimer
+
+
+def _rasterize_nodules_loop(label_array, centers, radii):
+    """原始实现：逐体素三重循环标记球形结节（仅用于对比）"""
+    for (z, y, x), radius_voxels in zip(centers, radii):
+        for zi in range(
+            max(0, z - radius_voxels),
+            min(label_array.shape[0], z + radius_voxels + 1),
+        ):
+            for yi in range(
+                max(0, y - radius_voxels),
+                min(label_array.shape[1], y + radius_voxels + 1),
+            ):
+                for xi in range(
+                    max(0, x - radius_voxels),
+                    min(label_array.shape[2], x + radius_voxels + 1),
+                ):
+                    if (zi - z) ** 2 + (yi - y) ** 2 + (
+                        xi - x
+                    ) ** 2 <= radius_voxels**2:
+                        label_array[zi, yi, xi] = 1.0
+    return label_array
+
+
+def benchmark_label_rasterization(
+    shape=(300, 512, 512), radii=(3, 8, 15, 25), repeats=3, seed=0
+):
+    """
+    对比向量化椭球印章与原始三重循环的标签生成速度
+
+    Args:
+        shape: 体数据形状 (z, y, x)
+        radii: 测试的结节体素半径
+        repeats: 向量化实现的重复次数（取最快值）
+        seed: 随机种子
+    """
+    rng = np.random.default_rng(seed)
+    print(f"标签生成基准测试 - 体数据形状: {shape}")
+    print(
+        f"{'半径':>6} {'三重循环(s)':>14} {'向量化(ms)':>12} {'加速比':>10} {'结果一致':>8}"
+    )
+
+    for radius in radii:
+        centers = np.stack(
+            [rng.integers(radius, s - radius, size=4) for s in shape], axis=1
+        )
+        iso_radii = np.full((len(centers), 3), float(radius))
+
+        loop_label = np.zeros(shape, dtype=np.float32)
+        start = time.perf_counter()
+        _rasterize_nodules_loop(loop_label, centers, [radius] * len(centers))
+        loop_time = time.perf_counter() - start
+
+        vec_time = float("inf")
+        for _ in range(repeats):
+            vec_label = np.zeros(shape, dtype=np.float32)
+            start = time.perf_counter()
+            rasterize_nodules(vec_label, centers, iso_radii)
+            vec_time = min(vec_time, time.perf_counter() - start)
+
+        same = np.array_equal(loop_label, vec_label)
+        print(
+            f"{radius:>6} {loop_time:>14.3f} {vec_time * 1000:>12.3f} "
+            f"{loop_time / vec_time:>9.0f}x {str(same):>8}"
+        )
+
+
+def _federated_averaging_loop(client_params_list, normalized_weights):
+    """原始实现：逐参数、逐客户端加权求和（仅用于对比）"""
+    global_params = OrderedDict()
+    for param_name, param_tensor in client_params_list[0].items():
+        if param_name.endswith("num_batches_tracked") or param_tensor.dtype in [
+            torch.int32,
+            torch.int64,
+            torch.long,
+        ]:
+            global_params[param_name] = param_tensor.clone()
+            continue
+
+        weighted_sum = torch.zeros_like(param_tensor, dtype=torch.float32)
+        for client_params, weight in zip(client_params_list, normalized_weights):
+            client_param = client_params[param_name]
+            if client_param.dtype != torch.float32:
+                client_param = client_param.float()
+            weighted_sum += weight * client_param
+        if param_tensor.dtype != torch.float32:
+            weighted_sum = weighted_sum.to(param_tensor.dtype)
+        global_params[param_name] = weighted_sum
+    return global_params
+
+
+def benchmark_fedavg(
+    client_counts=(3, 30, 300), distinct=8, max_matrix_bytes=2 * 1024**3, seed=0
+):
+    """
+    对比向量化联邦平均与原始逐参数循环的聚合速度
+
+    state_dict输入时只生成distinct份不同的Simple3DUNet参数，模拟的客户端循环引用它们，
+    计算量与客户端数成正比，不受影响；扁平矩阵输入（协调器中的客户端存储）需要真实分配
+    客户端数 x 参数量 的矩阵，超过max_matrix_bytes时跳过
+
+    Args:
+        client_counts: 模拟的客户端数量
+        distinct: state_dict输入时实际生成的不同参数份数
+        max_matrix_bytes: 扁平矩阵输入允许分配的最大字节数
+        seed: 随机种子
+    """
+    torch.manual_seed(seed)
+    template_model = Simple3DUNet(in_channels=1, out_channels=2)
+    template = template_model.state_dict()
+    pool = []
+    for _ in range(distinct):
+        params = OrderedDict()
+        for name, tensor in template.items():
+            params[name] = (
+                torch.randn_like(tensor)
+                if tensor.is_floating_point()
+                else tensor.clone()
+            )
+        pool.append(params)
+
+    num_elements = sum(t.numel() for t in template.values() if t.is_floating_point())
+    print(f"联邦平均基准测试 - 模型参数量: {num_elements / 1e6:.1f}M")
+    print(
+        f"{'客户端数':>8} {'逐参数循环(s)':>14} {'堆叠(s)':>9} {'扁平矩阵(s)':>12} "
+        f"{'加速比':>8} {'最大误差':>10}"
+    )
+
+    for num_clients in client_counts:
+        client_params_list = [pool[i % distinct] for i in range(num_clients)]
+        weights = np.random.default_rng(seed).uniform(1, 10, size=num_clients)
+        normalized_weights = (weights / weights.sum()).tolist()
+
+        start = time.perf_counter()
+        loop_params = _federated_averaging_loop(client_params_list, normalized_weights)
+        loop_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vec_params = vectorized_fedavg(client_params_list, normalized_weights)
+        vec_time = time.perf_counter() - start
+        max_error = max(
+            (loop_params[k].float() - vec_params[k].float()).abs().max().item()
+            for k in loop_params
+        )
+
+        # 协调器中的客户端参数是同一矩阵的行，聚合时零拷贝
+        flat_time = None
+        if num_clients * num_elements * 4 <= max_matrix_bytes:
+            stores = FlatParameterStore.stacked([template_model] * num_clients)
+            views = [store.state_dict_view() for store in stores]
+            for client_views, params in zip(views, client_params_list):
+                for name, view in client_views.items():
+                    view.copy_(params[name])
+            start = time.perf_counter()
+            flat_params = vectorized_fedavg(views, normalized_weights)
+            flat_time = time.perf_counter() - start
+            max_error = max(
+                max_error,
+                max(
+                    (loop_params[k].float() - flat_params[k].float()).abs().max().item()
+                    for k in loop_params
+                ),
+            )
+            del stores, views
+
+        best_time = min(vec_time, flat_time or vec_time)
+        flat_text = (
+            f"{flat_time:>12.3f}" if flat_time is not None else f"{'内存不足':>10}"
+        )
+        print(
+            f"{num_clients:>8} {loop_time:>14.3f} {vec_time:>9.3f} {flat_text} "
+            f"{loop_time / best_time:>7.1f}x {max_error:>10.2e}"
+        )
+
+
+def _time_steps(step, repeats):
+    """执行一次预热后返回step的平均耗时（秒）"""
+    step()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark_mixed_precision(
+    batch_sizes=(1, 2), patch_size=(64, 64, 64), repeats=3, seed=0
+):
+    """
+    对比float32与bfloat16 autocast下Simple3DUNet的训练步和推理耗时，以及Dice损失差异
+
+    两种精度使用相同的初始参数和输入；损失差异为同一参数下两种精度前向的损失之差，
+    训练后差异为各自训练repeats+1步后在同一输入上的float32损失之差
+
+    Args:
+        batch_sizes: 测试的批大小
+        patch_size: patch大小
+        repeats: 计时的重复次数（另有一次预热）
+        seed: 随机种子
+    """
+    torch.manual_seed(seed)
+    device = torch.device("cpu")
+    base_model = Simple3DUNet(in_channels=1, out_channels=2)
+    criterion = DiceLoss()
+    if hasattr(torch.backends.cpu, "get_cpu_capability"):
+        print(f"CPU指令集: {torch.backends.cpu.get_cpu_capability()}")
+    print(f"混合精度基准测试 - patch大小: {patch_size}")
+    print(
+        f"{'批大小':>6} {'fp32训练(s)':>12} {'bf16训练(s)':>12} {'加速比':>8} "
+        f"{'fp32推理(s)':>12} {'bf16推理(s)':>12} {'加速比':>8} "
+        f"{'损失差异':>10} {'训练后差异':>10}"
+    )
+
+    for batch_size in batch_sizes:
+        images = torch.rand(batch_size, 1, *patch_size)
+        labels = (torch.rand(batch_size, *patch_size) > 0.95).long()
+
+        train_times = {}
+        infer_times = {}
+        losses = {}
+        trained = {}
+        for mixed_precision in (False, True):
+            model = copy.deepcopy(base_model)
+            optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+
+            model.eval()
+            with torch.no_grad(), autocast_context(device, mixed_precision):
+                losses[mixed_precision] = criterion(
+                    model(images).float(), labels
+                ).item()
+
+            def infer():
+                with torch.no_grad(), autocast_context(device, mixed_precision):
+                    model(images)
+
+            infer_times[mixed_precision] = _time_steps(infer, repeats)
+
+            model.train()
+
+            def train_step():
+                optimizer.zero_grad()
+                with autocast_context(device, mixed_precision):
+                    outputs = model(images)
+                loss = criterion(outputs.float(), labels)
+                loss.backward()
+                optimizer.step()
+
+            train_times[mixed_precision] = _time_steps(train_step, repeats)
+
+            model.eval()
+            with torch.no_grad():
+                trained[mixed_precision] = criterion(model(images), labels).item()
+
+        print(
+            f"{batch_size:>6} {train_times[False]:>12.3f} {train_times[True]:>12.3f} "
+            f"{train_times[False] / train_times[True]:>7.2f}x "
+            f"{infer_times[False]:>12.3f} {infer_times[True]:>12.3f} "
+            f"{infer_times[False] / infer_times[True]:>7.2f}x "
+            f"{abs(losses[True] - losses[False]):>10.2e} "
+            f"{abs(trained[True] - trained[False]):>10.2e}"
+        )
+
+
+def _checkpoint_step_worker(patch_size, checkpoint_stages, batch_size, steps, seed):
+    """
+    在独立进程中执行训练步（ru_maxrss只增不减，每种配置需要新的进程）
+
+    Returns:
+        tuple: (平均每步耗时, 训练前的峰值内存MB, 训练后的峰值内存MB)
+    """
+    torch.manual_seed(seed)
+    model = Simple3DUNet(
+        in_channels=1, out_channels=2, checkpoint_stages=checkpoint_stages
+    )
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    criterion = DiceLoss()
+    images = torch.rand(batch_size, 1, *patch_size)
+    labels = (torch.rand(batch_size, *patch_size) > 0.95).long()
+
+    def train_step(images, labels):
+        optimizer.zero_grad()
+        loss = criterion(model(images), labels)
+        loss.backward()
+        optimizer.step()
+
+    # 先用很小的输入训练一步创建梯度和优化器状态，峰值增量只反映激活内存
+    train_step(images[..., :16, :16, :16], labels[..., :16, :16, :16])
+    baseline = peak_rss_mb()
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        train_step(images, labels)
+    step_time = (time.perf_counter() - start) / steps
+    return step_time, baseline, peak_rss_mb()
+
+
+def benchmark_activation_checkpointing(
+    patch_sizes=(64, 96),
+    stage_configs=(None, ("enc1", "dec1"), "all"),
+    batch_size=1,
+    steps=2,
+    seed=0,
+):
+    """
+    对比Simple3DUNet在不同激活检查点配置下每个训练步的峰值内存和耗时
+
+    每种配置在新的进程中运行，峰值内存增量为训练步相对模型和优化器状态的额外常驻内存
+
+    Args:
+        patch_sizes: 测试的patch边长
+        stage_configs: 检查点阶段配置（None为不使用，"all"为全部阶段）
+        batch_size: 批大小
+        steps: 每种配置的训练步数
+        seed: 随机种子
+    """
+    print(f"激活检查点基准测试 - 批大小: {batch_size}")
+    print(
+        f"{'patch':>6} {'检查点阶段':<16} {'每步耗时(s)':>12} {'峰值增量(MB)':>14} "
+        f"{'峰值内存(MB)':>14}"
+    )
+    context = mp.get_context("spawn")
+    for size in patch_sizes:
+        for stages in stage_configs:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                try:
+                    step_time, baseline, peak = pool.submit(
+                        _checkpoint_step_worker,
+                        (size, size, size),
+                        stages,
+                        batch_size,
+                        steps,
+                        seed,
+                    ).result()
+                except Exception as e:
+                    # 内存不足时子进程可能被系统终止
+                    print(f"{size:>6} {str(stages):<16} 失败: {type(e).__name__}")
+                    continue
+            label = "+".join(stages) if isinstance(stages, tuple) else str(stages)
+            print(
+                f"{size:>6} {label:<16} {step_time:>12.3f} {peak - baseline:>14.0f} "
+                f"{peak:>14.0f}"
+            )
+
+
+def _synthetic_client_loaders(num_clients, samples_per_client, patch_size, seed):
+    """每个客户端一个合成patch的DataLoader（随机图像和稀疏标签）"""
+    from torch.utils.data import DataLoader, Dataset
+
+    class SyntheticPatches(Dataset):
+        def __init__(self, samples):
+            self.samples = samples
+
+        def __len__(self):
+            return len(self.samples)
+
+        def __getitem__(self, index):
+            return self.samples[index]
+
+    generator = torch.Generator().manual_seed(seed)
+    loaders = []
+    for client in range(num_clients):
+        samples = [
+            {
+                "image": torch.rand(1, *patch_size, generator=generator),
+                "label": (torch.rand(patch_size, generator=generator) > 0.9).long(),
+                "series_uid": f"client{client}_{i}",
+            }
+            for i in range(samples_per_client)
+        ]
+        loaders.append(DataLoader(SyntheticPatches(samples), batch_size=1))
+    return loaders
+
+
+def benchmark_update_compression(
+    methods=(None, "delta", "int8", "topk"),
+    num_clients=3,
+    samples_per_client=2,
+    patch_size=(32, 32, 32),
+    global_rounds=3,
+    topk_ratio=0.01,
+    seed=0,
+):
+    """
+    对比不同上传压缩方式的通信量与对训练损失的影响
+
+    每种方式用相同的初始模型和合成数据执行一次完整的联邦训练（依次训练各客户端），
+    报告每轮上传字节数、压缩比、增量相对误差和最后一轮的平均客户端损失
+
+    Args:
+        methods: 压缩方式（None为上传完整参数）
+        num_clients: 客户端数
+        samples_per_client: 每个客户端的合成样本数
+        patch_size: 合成patch大小
+        global_rounds: 全局轮数
+        topk_ratio: topk压缩保留的元素比例
+        seed: 随机种子
+    """
+    from federated_training import FederatedLearningCoordinator
+
+    loaders = _synthetic_client_loaders(
+        num_clients, samples_per_client, patch_size, seed
+    )
+
+    results = []
+    for method in methods:
+        torch.manual_seed(seed)
+        coordinator = FederatedLearningCoordinator(
+            num_clients=num_clients,
+            update_compression=method,
+            topk_ratio=topk_ratio,
+        )
+        history = coordinator.federated_training(
+            loaders, global_rounds=global_rounds, local_epochs=1
+        )
+        dense_bytes = coordinator.clients[0].flat_store.nbytes * num_clients
+        update_bytes = history["update_bytes"] or [dense_bytes] * global_rounds
+        results.append(
+            (
+                method or "none",
+                update_bytes[-1] / 1024**2,
+                dense_bytes / update_bytes[-1],
+                history["update_error"][-1] if history["update_error"] else 0.0,
+                history["avg_loss"][-1],
+            )
+        )
+
+    print(f"上传压缩基准测试 - {num_clients} 个客户端, {global_rounds} 轮")
+    print(
+        f"{'方式':<8} {'每轮上传(MB)':>12} {'压缩比':>8} {'增量误差':>10} {'最终损失':>10}"
+    )
+    for method, megabytes, ratio, error, loss in results:
+        print(
+            f"{method:<8} {megabytes:>12.2f} {ratio:>7.1f}x {error:>10.4f} {loss:>10.4f}"
+        )
+
+
+def benchmark_server_optimizers(
+    configs=(
+        (None, False),
+        ("fedavgm", False),
+        ("fedadam", False),
+        ("fedyogi", False),
+        (None, True),
+        ("fedadam", True),
+    ),
+    num_clients=3,
+    samples_per_client=2,
+    patch_size=(32, 32, 32),
+    global_rounds=8,
+    target_loss=0.58,
+    seed=0,
+):
+    """
+    对比服务器优化器和客户端优化器状态保留对收敛轮数的影响
+
+    每种配置用相同的初始模型和合成数据执行完整的联邦训练，
+    报告达到目标损失所需的轮数和最后一轮的平均客户端损失
+
+    Args:
+        configs: (服务器优化器, 是否保留客户端优化器状态) 列表，None表示FedAvg
+        num_clients: 客户端数
+        samples_per_client: 每个客户端的合成样本数
+        patch_size: 合成patch大小
+        global_rounds: 全局轮数
+        target_loss: 目标损失
+        seed: 随机种子
+    """
+    from federated_training import FederatedLearningCoordinator
+
+    loaders = _synthetic_client_loaders(
+        num_clients, samples_per_client, patch_size, seed
+    )
+
+    results = []
+    for server_optimizer, keep_optimizer_state in configs:
+        torch.manual_seed(seed)
+        coordinator = FederatedLearningCoordinator(
+            num_clients=num_clients,
+            keep_optimizer_state=keep_optimizer_state,
+            server_optimizer=server_optimizer,
+        )
+        history = coordinator.federated_training(
+            loaders,
+            global_rounds=global_rounds,
+            local_epochs=1,
+            target_loss=target_loss,
+        )
+        results.append(
+            (
+                server_optimizer or "fedavg",
+                keep_optimizer_state,
+                history["rounds_to_target"],
+                history["avg_loss"][-1],
+            )
+        )
+
+    print(
+        f"服务器优化器基准测试 - {num_clients} 个客户端, {global_rounds} 轮, "
+        f"目标损失 {target_loss}"
+    )
+    print(
+        f"{'服务器优化器':<10} {'保留客户端状态':>12} {'达到目标轮数':>12} {'最终损失':>10}"
+    )
+    for name, keep_state, rounds, loss in results:
+        rounds_text = str(rounds) if rounds is not None else f">{global_rounds}"
+        print(f"{name:<10} {str(keep_state):>12} {rounds_text:>12} {loss:>10.4f}")
+
+
+def benchmark_step_timer(patch_size=(32, 32, 32), repeats=5, laps=100000, seed=0):
+    """
+    分阶段计时的开销：单次lap的耗时乘以每个batch的计时次数，与一个训练步的耗时相比
+
+    Args:
+        patch_size: 训练步使用的patch大小
+        repeats: 训练步计时的重复次数（另有一次预热）
+        laps: 测量lap耗时的调用次数
+        seed: 随机种子
+    """
+    torch.manual_seed(seed)
+    model = Simple3DUNet(in_channels=1, out_channels=2)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    criterion = DiceLoss()
+    images = torch.rand(1, 1, *patch_size)
+    labels = (torch.rand(1, *patch_size) > 0.95).long()
+
+    def train_step():
+        optimizer.zero_grad()
+        loss = criterion(model(images), labels)
+        loss.backward()
+        optimizer.step()
+
+    step_time = _time_steps(train_step, repeats)
+
+    timer = StepTimer()
+    start = time.perf_counter()
+    for _ in range(laps):
+        timer.lap("forward")
+    lap_time = (time.perf_counter() - start) / laps
+
+    start = time.perf_counter()
+    for _ in range(laps):
+        timer.end_step(1)
+    end_step_time = (time.perf_counter() - start) / laps
+
+    # 每个batch: 每个阶段一次lap + 一次end_step
+    per_step = lap_time * len(STEP_PHASES) + end_step_time
+    print(f"分阶段计时开销 - patch大小: {patch_size}")
+    print(f"lap: {lap_time * 1e6:.2f}us, end_step: {end_step_time * 1e6:.2f}us")
+    print(
+        f"每个batch计时开销: {per_step * 1e6:.2f}us, 训练步: {step_time * 1000:.1f}ms, "
+        f"开销占比: {per_step / step_time:.4%}"
+    )
+
+
+BENCHMARKS = {
+    "label_rasterization": benchmark_label_rasterization,
+    "fedavg": benchmark_fedavg,
+    "mixed_precision": benchmark_mixed_precision,
+    "activation_checkpointing": benchmark_activation_checkpointing,
+    "update_compression": benchmark_update_compression,
+    "server_optimizers": benchmark_server_optimizers,
+    "step_timer": benchmark_step_timer,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"未知的基准测试: {name}，可选: {', '.join(BENCHMARKS)}")
+            continue
+        BENCHMARKS[name]()
@@ -0,0 +1,294 @@
+"""
+联邦学习客户端代理
+在客户端机器上用本地数据训练，通过HTTP从服务器拉取全局模型、上传压缩后的参数增量，
+原始CT不离开本机（协议见remote_training.py）
+
+用法:
+    python client_agent.py --server http://127.0.0.1:5052 --data-dir ./client1_data --name hospital1
+
+客户端用--token或FL_AGENT_TOKEN环境变量提供服务器的访问令牌（服务器的FL_AGENT_TOKEN，
+未设置时为启动远程训练时服务器日志中生成的令牌）；
+同一台机器上可以启动多个代理进程（每个进程使用各自的数据目录）；
+run_local_agents.py在本机启动服务器和多个代理，用于验证整个流程
+"""
+
+import argparse
+import json
+import os
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import torch
+
+from federated_training import FederatedClient
+from flat_params import FlatParameterStore
+from remote_training import TOKEN_HEADER, VERSION_HEADER, deserialize, serialize
+from train_simple_model import (
+    Simple3DUNet,
+    SimpleLUNA16Dataset,
+    VolumeGroupedSampler,
+    build_data_loader,
+)
+from update_compression import UpdateCompressor
+from volume_cache import DEFAULT_CACHE_DIR
+
+
+def build_local_loader(
+    data_dir,
+    csv_path,
+    patch_size=(64, 64, 64),
+    cache_dir=DEFAULT_CACHE_DIR,
+    patches_per_volume=4,
+    batch_size=1,
+    num_workers=0,
+):
+    """
+    用本地数据目录创建训练数据加载器（以标注为中心的多patch采样）
+
+    Args:
+        data_dir: 本地MHD/RAW数据目录
+        csv_path: 标注文件路径
+        patch_size: patch大小
+        cache_dir: 标准化体数据缓存目录
+        patches_per_volume: 每个体数据每个epoch采样的patch数
+        batch_size: 批大小
+        num_workers: 数据加载进程数
+
+    Returns:
+        DataLoader: 训练数据加载器
+    """
+    dataset = SimpleLUNA16Dataset(
+        data_dir=data_dir,
+        csv_path=csv_path,
+        patch_size=patch_size,
+        is_custom=True,
+        cache_dir=cache_dir,
+        sampling="annotation",
+        patches_per_volume=patches_per_volume,
+    )
+    return build_data_loader(
+        dataset,
+        batch_size=batch_size,
+        sampler=VolumeGroupedSampler(dataset, shuffle=True),
+        num_workers=num_workers,
+        refill_failed=True,
+    )
+
+
+class ClientAgent:
+    """进程外的联邦客户端：轮询服务器，每个新版本的全局模型训练一次并上传更新"""
+
+    def __init__(
+        self,
+        server_url,
+        train_loader,
+        name,
+        token=None,
+        device="cpu",
+        poll_interval=2.0,
+        timeout=600,
+        max_retries=30,
+    ):
+        """
+        Args:
+            server_url: 服务器地址，例如 "http://127.0.0.1:5052"
+            train_loader: 本地训练数据加载器
+            name: 客户端名称
+            token: 服务器的访问令牌
+            device: 计算设备
+            poll_interval: 轮询服务器状态的间隔（秒）
+            timeout: 单次HTTP请求的超时（秒）
+            max_retries: 连续连接失败多少次后退出
+        """
+        self.server_url = server_url.rstrip("/")
+        self.train_loader = train_loader
+        self.name = name
+        self.token = token
+        self.device = device
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+        self.client = None
+        self.global_store = None
+        self.config = None
+
+    def _request(self, path, data=None, content_type="application/json"):
+        """
+        发送HTTP请求
+
+        Returns:
+            tuple: (响应头, 响应体字节)
+        """
+        request = urllib.request.Request(self.server_url + path, data=data)
+        if data is not None:
+            request.add_header("Content-Type", content_type)
+        if self.token:
+            request.add_header(TOKEN_HEADER, self.token)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.headers, response.read()
+
+    def _get_json(self, path, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        _, body = self._request(path, data)
+        return json.loads(body)
+
+    def register(self):
+        """向服务器注册，并按下发的配置创建本地模型和压缩器"""
+        data_size = len(self.train_loader.dataset)
+        self.config = self._get_json(
+            "/api/fl/register", {"name": self.name, "data_size": data_size}
+        )
+        model_kwargs = self.config["model_kwargs"]
+        self.client = FederatedClient(
+            self.config["client_id"], Simple3DUNet, model_kwargs, self.device
+        )
+        self.client.mixed_precision = self.config["mixed_precision"]
+        self.client.compressor = UpdateCompressor(
+            self.config["update_compression"],
+            topk_ratio=self.config["topk_ratio"],
+            error_feedback=self.config["error_feedback"],
+        )
+        # 本轮全局模型（压缩增量的基准）
+        self.global_store = FlatParameterStore(
+            Simple3DUNet(**model_kwargs).to(self.device)
+        )
+        print(
+            f"[{self.name}] 注册成功: 客户端序号 {self.config['client_id']}, "
+            f"数据量 {data_size}, 压缩方式 {self.config['update_compression']}"
+        )
+
+    def pull_model(self):
+        """
+        拉取当前版本的全局模型
+
+        Returns:
+            int: 模型版本号
+        """
+        headers, body = self._request("/api/fl/model")
+        flat_buffers = deserialize(body)
+        with torch.no_grad():
+            for dtype, tensor in self.global_store.flat_buffers.items():
+                tensor.copy_(flat_buffers[dtype])
+        self.client.load_global_store(self.global_store)
+        return int(headers[VERSION_HEADER])
+
+    def train_and_push(self, version):
+        """
+        在本地数据上训练一轮并上传压缩更新
+
+        Args:
+            version: 训练使用的全局模型版本
+
+        Returns:
+            bool: 服务器是否接受了本次更新
+        """
+        start = time.perf_counter()
+        epoch_losses = self.client.local_train(
+            self.train_loader, self.config["local_epochs"]
+        )
+        # 压缩会更新误差反馈残差；服务器没有接受本次更新时恢复压缩前的残差
+        compressor = self.client.compressor
+        residuals = {dtype: r.clone() for dtype, r in compressor.residuals.items()}
+        payload = self.client.get_compressed_update(self.global_store)
+        body = serialize(
+            {
+                "payload": payload,
+                "weight": self.client.get_data_size(self.train_loader),
+                "loss": float(epoch_losses[-1]) if epoch_losses else 0.0,
+                "update_error": self.client.compressor.last_error,
+            }
+        )
+        query = urllib.parse.urlencode(
+            {"client_id": self.config["client_id"], "base_version": version}
+        )
+        try:
+            self._request(
+                f"/api/fl/update?{query}", body, content_type="application/octet-stream"
+            )
+        except urllib.error.URLError as e:
+            compressor.residuals = residuals
+            if not isinstance(e, urllib.error.HTTPError) or e.code != 409:
+                raise
+            # 其他客户端已完成本轮聚合，拉取新模型后重新训练
+            print(f"[{self.name}] 版本 {version} 的更新已过时: {e.read().decode()}")
+            return False
+        print(
+            f"[{self.name}] 版本 {version} 训练完成并上传 "
+            f"({len(body) / 1024**2:.2f} MB, {time.perf_counter() - start:.1f}s)"
+        )
+        return True
+
+    def run(self):
+        """
+        注册后持续训练，直到服务器结束训练
+
+        全局模型版本变化时训练新版本；版本未变但服务器丢弃了本轮更新（聚合失败）时重新训练
+        """
+        self.register()
+        trained_version = None
+        failures = 0
+        while True:
+            try:
+                status = self._get_json("/api/fl/status")
+                failures = 0
+                if status["finished"]:
+                    print(f"[{self.name}] 服务器训练已结束 (版本 {status['version']})")
+                    return
+                if (
+                    status["version"] != trained_version
+                    or self.config["client_id"] not in status["pending_clients"]
+                ):
+                    version = self.pull_model()
+                    self.train_and_push(version)
+                    trained_version = version
+                    continue
+            except urllib.error.URLError as e:
+                failures += 1
+                if failures >= self.max_retries:
+                    raise
+                print(
+                    f"[{self.name}] 连接服务器失败 ({failures}/{self.max_retries}): {e}"
+                )
+            time.sleep(self.poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="联邦学习客户端代理")
+    parser.add_argument("--server", default="http://127.0.0.1:5052", help="服务器地址")
+    parser.add_argument("--data-dir", required=True, help="本地MHD/RAW数据目录")
+    parser.add_argument("--name", default=None, help="客户端名称，默认为数据目录名")
+    parser.add_argument("--csv", default="./src/annotations.csv", help="标注文件路径")
+    parser.add_argument("--token", default=os.environ.get("FL_AGENT_TOKEN"))
+    parser.add_argument("--patch-size", type=int, nargs=3, default=(64, 64, 64))
+    parser.add_argument("--patches-per-volume", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--num-workers", type=int, default=0)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    args = parser.parse_args()
+
+    train_loader = build_local_loader(
+        args.data_dir,
+        args.csv,
+        patch_size=tuple(args.patch_size),
+        cache_dir=args.cache_dir,
+        patches_per_volume=args.patches_per_volume,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+    )
+    agent = ClientAgent(
+        args.server,
+        train_loader,
+        name=args.name or os.path.basename(os.path.normpath(args.data_dir)),
+        token=args.token,
+        device="cuda" if torch.cuda.is_available() else "cpu",
+        poll_interval=args.poll_interval,
+    )
+    agent.run()
+
+
+if __name__ == "__main__":
+    main()
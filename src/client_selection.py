@@ -0,0 +1,119 @@
+"""
+每轮的客户端选择
+每轮只选择一部分(比例C)客户端参与训练，支持：
+    uniform      - 均匀随机选择
+    weighted     - 按数据量加权选择（有放回抽样，重复抽中的客户端只训练一次、权重按次数累计）
+    availability - 按在线概率模拟客户端是否可用，只在在线客户端中均匀选择
+
+聚合权重按入选概率做逆概率修正（数据量 / 入选概率），
+使被选中的子集在期望上与全体客户端参与的FedAvg一致
+
+同一个种子和轮次总是得到相同的选择结果
+"""
+
+import math
+import numpy as np
+
+SELECTION_STRATEGIES = ("uniform", "weighted", "availability")
+
+
+class ClientSelector:
+    """每轮客户端选择器"""
+
+    def __init__(
+        self,
+        strategy="uniform",
+        fraction=1.0,
+        seed=None,
+        min_clients=1,
+        availability=None,
+    ):
+        """
+        Args:
+            strategy: 选择策略，"uniform"、"weighted"或"availability"
+            fraction: 每轮选择的客户端比例C
+            seed: 随机种子，None表示每次运行随机
+            min_clients: 每轮至少选择的客户端数
+            availability: 客户端序号 -> 在线概率（availability策略使用，未列出的客户端视为总是在线）
+        """
+        if strategy not in SELECTION_STRATEGIES:
+            raise ValueError(
+                f"未知的客户端选择策略: {strategy}，可选: {', '.join(SELECTION_STRATEGIES)}"
+            )
+        self.strategy = strategy
+        self.fraction = fraction
+        self.seed = seed if seed is not None else int(np.random.SeedSequence().entropy)
+        self.min_clients = min_clients
+        self.availability = dict(availability or {})
+
+        # 每轮的选择记录
+        self.history = []
+
+    def num_selected(self, num_candidates):
+        """每轮选择的客户端数 max(min_clients, ceil(C * K))，不超过候选数"""
+        return min(
+            num_candidates,
+            max(self.min_clients, math.ceil(self.fraction * num_candidates)),
+        )
+
+    def select(self, round_num, data_sizes):
+        """
+        选择本轮参与训练的客户端
+
+        Args:
+            round_num: 轮次（与种子一起决定随机数，保证可复现）
+            data_sizes: 候选客户端序号 -> 数据量
+
+        Returns:
+            dict: 选中的客户端序号 -> 修正后的聚合权重（按客户端序号排序）
+        """
+        rng = np.random.default_rng([self.seed, round_num])
+        candidates = sorted(data_sizes)
+        sizes = np.array([data_sizes[i] for i in candidates], dtype=np.float64)
+        m = self.num_selected(len(candidates))
+        weights = {}
+
+        if self.strategy == "uniform":
+            # 入选概率相同，修正后的权重与数据量成正比
+            chosen = rng.choice(len(candidates), size=m, replace=False)
+            probability = m / len(candidates)
+            for k in chosen:
+                weights[candidates[k]] = sizes[k] / probability
+
+        elif self.strategy == "weighted":
+            # 按数据量有放回抽样，每次抽中的权重为 数据量/抽中概率，即相同的常数
+            p = sizes / sizes.sum()
+            for k in rng.choice(len(candidates), size=m, replace=True, p=p):
+                weights[candidates[k]] = weights.get(candidates[k], 0.0) + 1.0
+
+        else:
+            online = [
+                k
+                for k, i in enumerate(candidates)
+                if rng.random() < self.availability.get(i, 1.0)
+            ]
+            if not online:
+                self._record(round_num, weights)
+                return weights
+            chosen = rng.choice(online, size=min(m, len(online)), replace=False)
+            # 入选概率 ≈ 在线概率 x 在线客户端中的选择比例
+            fraction_online = min(m, len(online)) / len(online)
+            for k in chosen:
+                probability = (
+                    self.availability.get(candidates[k], 1.0) * fraction_online
+                )
+                weights[candidates[k]] = sizes[k] / probability
+
+        weights = {i: float(weights[i]) for i in sorted(weights)}
+        self._record(round_num, weights)
+        return weights
+
+    def _record(self, round_num, weights):
+        self.history.append({"round": round_num + 1, "selected": list(weights)})
+
+    def describe(self):
+        """选择器的配置描述（用于日志）"""
+        return (
+            f"策略={self.strategy}, 比例={self.fraction}, 种子={self.seed}, "
+            f"最少客户端数={self.min_clients}"
+        )
@@ -0,0 +1,120 @@
+"""
+客户端之间真正不同的本地状态：优化器动量和BatchNorm统计量
+以扁平张量紧凑保存，训练前换入模型/优化器，训练后换出，
+单模型模拟模式下所有客户端共用一个模型实例，只保存这些状态
+"""
+
+import torch
+import torch.nn as nn
+
+# 优化器动量的默认存储类型（保持精度，每轮换入换出不引入舍入误差）
+DEFAULT_STATE_DTYPE = torch.float32
+# 单模型模拟模式的紧凑存储类型（bfloat16的指数范围与float32相同，二阶矩不会下溢；
+# 每轮舍入到8位尾数，用精度换模拟大量客户端时的内存）
+COMPACT_STATE_DTYPE = torch.bfloat16
+
+_BN_TYPES = (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d)
+
+
+def pack_optimizer_state(optimizer, dtype=DEFAULT_STATE_DTYPE):
+    """
+    把优化器状态压缩为每种状态量一个扁平张量
+
+    Args:
+        optimizer: 优化器（例如Adam）
+        dtype: 与参数形状相同的状态量（动量等）的存储类型
+
+    Returns:
+        dict: {"indices": 有状态的参数序号, "tensors": {状态名: 扁平张量},
+               "scalars": [每个参数的标量状态]}，优化器没有状态时返回None
+    """
+    state = optimizer.state_dict()["state"]
+    if not state:
+        return None
+
+    indices = sorted(state)
+    tensors = {}
+    scalars = []
+    for index in indices:
+        param_scalars = {}
+        for key, value in state[index].items():
+            if torch.is_tensor(value) and value.dim() > 0:
+                tensors.setdefault(key, []).append(value.reshape(-1))
+            else:
+                param_scalars[key] = value
+        scalars.append(param_scalars)
+
+    return {
+        "indices": indices,
+        "tensors": {
+            key: torch.cat(values).to(dtype) for key, values in tensors.items()
+        },
+        "scalars": scalars,
+    }
+
+
+def load_optimizer_state(optimizer, packed):
+    """
+    把pack_optimizer_state保存的状态恢复到结构相同的优化器中
+
+    Args:
+        optimizer: 新建的优化器
+        packed: pack_optimizer_state的返回值
+    """
+    params = [p for group in optimizer.param_groups for p in group["params"]]
+    offsets = {key: 0 for key in packed["tensors"]}
+    state = {}
+    for index, param_scalars in zip(packed["indices"], packed["scalars"]):
+        param = params[index]
+        param_state = dict(param_scalars)
+        for key, flat in packed["tensors"].items():
+            start = offsets[key]
+            param_state[key] = (
+                flat[start : start + param.numel()].view(param.shape).to(param.dtype)
+            )
+            offsets[key] = start + param.numel()
+        state[index] = param_state
+
+    state_dict = optimizer.state_dict()
+    state_dict["state"] = state
+    optimizer.load_state_dict(state_dict)
+
+
+def state_nbytes(packed):
+    """紧凑状态占用的字节数"""
+    if packed is None:
+        return 0
+    return sum(t.numel() * t.element_size() for t in packed["tensors"].values())
+
+
+def extract_bn_stats(model):
+    """
+    拷贝模型中所有BatchNorm层的统计量（running_mean/running_var/num_batches_tracked）
+
+    Returns:
+        list: 按模块顺序排列的统计量张量
+    """
+    stats = []
+    for module in model.modules():
+        if isinstance(module, _BN_TYPES) and module.track_running_stats:
+            stats.extend(
+                [
+                    module.running_mean.clone(),
+                    module.running_var.clone(),
+                    module.num_batches_tracked.clone(),
+                ]
+            )
+    return stats
+
+
+def load_bn_stats(model, stats):
+    """把extract_bn_stats保存的统计量原地写回模型"""
+    buffers = []
+    for module in model.modules():
+        if isinstance(module, _BN_TYPES) and module.track_running_stats:
+            buffers.extend(
+                [module.running_mean, module.running_var, module.num_batches_tracked]
+            )
+    with torch.no_grad():
+        for buffer, value in zip(buffers, stats):
+            buffer.copy_(value)
@@ -6,7 +6,6 @@
 import os
 import numpy as np
 import torch
-import SimpleITK as sitk
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from scipy import ndimage
@@ -15,7 +14,14 @@ import warnings
 import matplotlib
 
 matplotlib.use("Agg")  # 使用非GUI后端
-from train_simple_model import Simple3DUNet
+from train_simple_model import (
+    Simple3DUNet,
+    autocast_context,
+    resample_volume,
+    preprocessing_variant,
+)
+from metaimage_io import read_volume
+from volume_cache import VolumeCache
 
 warnings.filterwarnings("ignore")
 
@@ -26,18 +32,38 @@ torch.serialization.add_safe_globals([np.core.multiarray.scalar])
 class FederatedLungNodulePredictor:
     """联邦学习肺结节预测器"""
 
-    def __init__(self, model_path, device=None):
+    def __init__(
+        self,
+        model_path,
+        device=None,
+        target_spacing=None,
+        cache_dir=None,
+        mixed_precision=False,
+    ):
         """
         初始化联邦学习预测器
 
         Args:
             model_path: 联邦训练模型路径
             device: 计算设备
+            target_spacing: 重采样目标间距 (x, y, z)，应与训练时一致；
+                            None表示使用模型检查点记录的训练间距（未记录时保持原始间距）
+            cache_dir: 重采样结果的缓存目录（与训练数据缓存共用），None表示不缓存
+            mixed_precision: 滑动窗口预测是否使用bfloat16 autocast
         """
         self.device = device or torch.device(
             "cuda" if torch.cuda.is_available() else "cpu"
         )
+        self.mixed_precision = mixed_precision
+        # 模型训练时的重采样间距（由load_federated_model从检查点读取）
+        self.model_target_spacing = None
         self.model = self.load_federated_model(model_path)
+        self.target_spacing = (
+            target_spacing if target_spacing is not None else self.model_target_spacing
+        )
+        if self.target_spacing is not None:
+            print(f"推理重采样间距: {tuple(self.target_spacing)}")
+        self.volume_cache = VolumeCache(cache_dir) if cache_dir else None
 
     def load_federated_model(self, model_path):
         """加载联邦训练的模型"""
@@ -56,6 +82,8 @@ class FederatedLungNodulePredictor:
                 model.load_state_dict(checkpoint["model_state_dict"])
                 round_num = checkpoint.get("round_num", "Unknown")
                 print(f"模型来自联邦学习第 {round_num} 轮")
+                if checkpoint.get("target_spacing") is not None:
+                    self.model_target_spacing = tuple(checkpoint["target_spacing"])
             else:
                 # 兼容普通模型格式
                 model.load_state_dict(checkpoint, weights_only=False)
@@ -72,6 +100,48 @@ class FederatedLungNodulePredictor:
         image = (image + 1000) / 1400.0  # 归一化到0-1
         return image.astype(np.float32)
 
+    def load_image(self, image_path):
+        """
+        加载图像；设置了target_spacing时返回重采样后的图像（优先从缓存读取）
+
+        Returns:
+            tuple: (image_array, normalized_image, spacing, origin)，
+                   重采样时image_array由标准化结果还原（HU截断到[-1000, 400]）
+        """
+        image_array, spacing, origin = read_volume(image_path)
+        if self.target_spacing is None:
+            return image_array, self.normalize_image(image_array), spacing, origin
+
+        series_uid = os.path.splitext(os.path.basename(image_path))[0]
+        variant = preprocessing_variant(self.target_spacing)
+        cached = (
+            self.volume_cache.get(series_uid, image_path, variant)
+            if self.volume_cache is not None
+            else None
+        )
+        if cached is not None:
+            normalized_image = np.asarray(cached[0], dtype=np.float32)
+            spacing = tuple(cached[1]["spacing"])
+        else:
+            normalized_image, spacing = resample_volume(
+                self.normalize_image(image_array), spacing, self.target_spacing
+            )
+            if self.volume_cache is not None:
+                try:
+                    self.volume_cache.put(
+                        series_uid,
+                        image_path,
+                        normalized_image,
+                        {"spacing": list(spacing), "origin": list(origin)},
+                        variant,
+                    )
+                except OSError as e:
+                    print(f"写入体数据缓存失败 {image_path}: {e}")
+
+        # 重采样后原点不变，世界坐标 = origin + 体素坐标 * 新间距
+        image_array = normalized_image * 1400.0 - 1000.0
+        return image_array, normalized_image, spacing, origin
+
     def predict(self, image_path, patch_size=(64, 64, 64), confidence_threshold=0.3):
         """
         对单个CT图像进行预测
@@ -84,18 +154,12 @@ class FederatedLungNodulePredictor:
         Returns:
             tuple: (nodules, probability_map, original_image, spacing, origin)
         """
-        # 加载图像
-        image = sitk.ReadImage(image_path)
-        image_array = sitk.GetArrayFromImage(image)
-        spacing = image.GetSpacing()
-        origin = image.GetOrigin()
+        # 加载图像（未压缩RAW直接memmap映射，可选重采样）并标准化
+        image_array, normalized_image, spacing, origin = self.load_image(image_path)
 
         print(f"图像形状: {image_array.shape}")
         print(f"图像间距: {spacing}")
 
-        # 标准化图像
-        normalized_image = self.normalize_image(image_array)
-
         # 预测
         probability_map = self.sliding_window_prediction(normalized_image, patch_size)
 
@@ -163,9 +227,10 @@ class FederatedLungNodulePredictor:
                 torch.from_numpy(patch).unsqueeze(0).unsqueeze(0).to(self.device)
             )
 
-            with torch.no_grad():
+            with torch.no_grad(), autocast_context(self.device, self.mixed_precision):
                 output = self.model(input_tensor)
-                prob = torch.sigmoid(output[0, 1]).cpu().numpy()  # 取结节通道的概率
+            # 取结节通道的概率（混合精度时先转回float32）
+            prob = torch.sigmoid(output[0, 1].float()).cpu().numpy()
 
             # 将结果添加到概率图
             actual_patch_shape = (z2 - z1, y2 - y1, x2 - x1)
@@ -260,11 +325,8 @@ class FederatedLungNodulePredictor:
         Returns:
             tuple: (nodules, probability_map, original_image, spacing, origin)
         """
-        # 加载图像
-        image = sitk.ReadImage(image_path)
-        image_array = sitk.GetArrayFromImage(image)
-        spacing = image.GetSpacing()
-        origin = image.GetOrigin()
+        # 加载图像（未压缩RAW直接memmap映射，可选重采样）
+        image_array, _, spacing, origin = self.load_image(image_path)
 
         print(f"快速模式 - 图像形状: {image_array.shape}")
         print(f"快速模式 - 图像间距: {spacing}")
@@ -307,7 +369,12 @@ class FederatedLungNodulePredictor:
 
 
 def predict_with_federated_model(
-    image_path, model_path="./src/best_federated_lung_nodule_model.pth", fast_mode=False
+    image_path,
+    model_path="./src/best_federated_lung_nodule_model.pth",
+    fast_mode=False,
+    target_spacing=None,
+    cache_dir=None,
+    mixed_precision=False,
 ):
     """
     使用联邦学习模型进行预测的便捷函数
@@ -316,11 +383,19 @@ def predict_with_federated_model(
         image_path: CT图像路径
         model_path: 联邦学习模型路径
         fast_mode: 是否使用快速模式（减少计算时间）
+        target_spacing: 重采样目标间距 (x, y, z)，None表示使用模型检查点记录的训练间距
+        cache_dir: 重采样结果的缓存目录
+        mixed_precision: 是否使用bfloat16 autocast推理
 
     Returns:
         预测结果
     """
-    predictor = FederatedLungNodulePredictor(model_path)
+    predictor = FederatedLungNodulePredictor(
+        model_path,
+        target_spacing=target_spacing,
+        cache_dir=cache_dir,
+        mixed_precision=mixed_precision,
+    )
 
     if fast_mode:
         # 快速模式：降低分辨率和减少处理步骤
@@ -26,7 +26,9 @@ from tqdm import tqdm
 import warnings
 from typing import List, Dict, Tuple
 import random
+import time
 from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, wait
 from datetime import datetime
 import sys  # 添加sys导入
 
@@ -72,8 +74,92 @@ def set_flask_log_functions(training_log_func, server_log_func):
     flask_add_server_log = server_log_func
 
 
+def get_flask_training_metrics():
+    """
+    获取Flask应用中的训练计时字典（/api/server/training_metrics返回的内容）
+
+    Returns:
+        dict: 训练计时，未在Flask应用中运行时返回None
+    """
+    import builtins
+
+    return getattr(builtins, "app_training_metrics", None)
+
+
+def get_flask_training_status():
+    """
+    获取Flask应用中的全局训练状态字典
+
+    Returns:
+        dict: 训练状态，未在Flask应用中运行时返回None
+    """
+    global_training_status = None
+    try:
+        # 尝试从全局变量获取训练状态
+        import builtins
+
+        if hasattr(builtins, "app_training_status"):
+            global_training_status = builtins.app_training_status
+            log_print(
+                f"成功连接到Flask训练状态: {global_training_status}",
+                is_training=True,
+            )
+        else:
+            # 尝试从各种可能的模块获取
+            for module_name in list(sys.modules.keys()):
+                if module_name in ["app", "__main__"]:
+                    module = sys.modules[module_name]
+                    if hasattr(module, "training_status"):
+                        global_training_status = module.training_status
+                        log_print(
+                            f"从模块 {module_name} 获取训练状态", is_training=True
+                        )
+                        break
+    except Exception as e:
+        log_print(f"无法连接到Flask训练状态: {e}", is_training=True)
+    return global_training_status
+
+
 # 导入简化的模型和数据集
-from train_simple_model import Simple3DUNet, SimpleLUNA16Dataset, DiceLoss
+from train_simple_model import (
+    Simple3DUNet,
+    SimpleLUNA16Dataset,
+    DiceLoss,
+    VolumeGroupedSampler,
+    autocast_context,
+    build_data_loader,
+)
+from volume_cache import DEFAULT_CACHE_DIR
+from patch_store import ShardedPatchDataset, update_patch_store
+
+from parallel_rounds import ParallelRoundExecutor
+from flat_params import FlatParameterStore, peak_rss_mb
+from aggregation import (
+    BufferedAsyncAggregator,
+    StreamingAggregator,
+    vectorized_fedavg,
+)
+from client_selection import ClientSelector
+from update_compression import UpdateCompressor, decompress_update, payload_nbytes
+from server_optimizers import ServerOptimizer
+from validation import EarlyStopping, build_validation_set
+from training_metrics import StepTimer, format_round_metrics, summarize_round
+from round_checkpoint import (
+    RoundCheckpointer,
+    capture_rng_state,
+    load_round_checkpoint,
+    restore_rng_state,
+)
+from client_state import (
+    COMPACT_STATE_DTYPE,
+    DEFAULT_STATE_DTYPE,
+    pack_optimizer_state,
+    load_optimizer_state,
+    state_nbytes,
+    extract_bn_stats,
+    load_bn_stats,
+)
+from volume_manifest import VolumeManifest, get_volume_manifest
 
 warnings.filterwarnings("ignore")
 
@@ -106,16 +192,44 @@ class FederatedServer:
         """
         self.device = device
         self.global_model = model_class(**model_kwargs).to(device)
+        # 全局模型参数的扁平存储，分发时整体拷贝
+        self.flat_store = FlatParameterStore(self.global_model)
         self.model_class = model_class
         self.model_kwargs = model_kwargs
         self.round_num = 0
+        # 聚合后的服务器优化器（ServerOptimizer），None表示直接使用平均参数
+        self.server_optimizer = None
+        # 训练数据的重采样目标间距，随模型保存，推理时按相同间距预处理
+        self.target_spacing = None
 
         # 存储训练历史
-        self.training_history = {"rounds": [], "avg_loss": [], "client_losses": []}
-
-    def get_global_model_params(self):
-        """获取全局模型参数"""
-        return copy.deepcopy(self.global_model.state_dict())
+        self.training_history = {
+            "rounds": [],
+            "avg_loss": [],
+            "client_losses": [],
+            "param_copy_time": [],
+            "peak_rss_mb": [],
+            "selected_clients": [],
+            # 异步缓冲聚合：每次全局更新的模型版本、累计吞吐量（客户端更新/秒）和过时程度直方图
+            "model_version": [],
+            "update_throughput": [],
+            "staleness_histogram": {},
+            # 压缩上传：每轮上传字节数、压缩比和还原增量的平均相对误差
+            "update_bytes": [],
+            "compression_ratio": [],
+            "update_error": [],
+            # 首次达到目标损失的轮次（未设置目标或尚未达到时为None）
+            "target_loss": None,
+            "rounds_to_target": None,
+            # 每轮分阶段耗时（数据等待/拷贝/前向/反向/优化器/参数分发/聚合）和吞吐量
+            "round_metrics": [],
+            "samples_per_sec": [],
+            # 验证集评估的轮次和损失、验证损失最佳的轮次和训练结束原因
+            "val_rounds": [],
+            "val_loss": [],
+            "best_round": None,
+            "stop_reason": None,
+        }
 
     def federated_averaging(
         self, client_params_list: List[Dict], client_weights: List[float]
@@ -137,56 +251,49 @@ class FederatedServer:
                 is_training=True,
             )
 
-            # 初始化聚合参数
-            global_params = OrderedDict()
-
-            # 获取第一个客户端的参数结构
-            first_client_params = client_params_list[0]
-
-            # 对每个参数进行加权平均
-            for param_name in first_client_params.keys():
-                param_tensor = first_client_params[param_name]
-
-                # 检查是否是需要跳过的参数（如BatchNorm的num_batches_tracked）
-                if param_name.endswith("num_batches_tracked"):
-                    # 对于不需要聚合的参数，直接使用第一个客户端的值
-                    global_params[param_name] = param_tensor.clone()
-                    continue
-
-                # 确保参数是浮点类型以支持加权平均
-                if param_tensor.dtype in [torch.int32, torch.int64, torch.long]:
-                    # 对于整型参数，取第一个客户端的值（通常是索引类型参数）
-                    global_params[param_name] = param_tensor.clone()
-                    continue
-
-                # 对浮点参数进行加权求和
-                weighted_sum = torch.zeros_like(param_tensor, dtype=torch.float32)
-
-                for client_params, weight in zip(
-                    client_params_list, normalized_weights
-                ):
-                    client_param = client_params[param_name]
-                    if client_param.dtype != torch.float32:
-                        client_param = client_param.float()
-                    weighted_sum += weight * client_param
-
-                # 恢复原始数据类型
-                if param_tensor.dtype != torch.float32:
-                    weighted_sum = weighted_sum.to(param_tensor.dtype)
-
-                global_params[param_name] = weighted_sum
+            # 展平堆叠后一次矩阵乘法完成加权平均，
+            # num_batches_tracked和整型缓冲区取第一个客户端的值
+            global_params = vectorized_fedavg(client_params_list, normalized_weights)
 
             # 更新全局模型
-            self.global_model.load_state_dict(global_params)
-            self.round_num += 1
-
-            log_print(f"✅ 全局模型已更新 - 第 {self.round_num} 轮", is_training=True)
+            self.update_global_model(global_params)
 
         except Exception as e:
             log_print(f"❌ 模型聚合过程中出现错误: {e}", is_training=True)
             log_print(f"错误类型: {type(e).__name__}", is_training=True)
             raise e
 
+    def update_global_model(self, global_params):
+        """
+        用聚合结果更新全局模型
+
+        Args:
+            global_params: 聚合后的全局参数
+        """
+        previous = None
+        if self.server_optimizer is not None:
+            previous = [p.detach().clone() for p in self.global_model.parameters()]
+        self.global_model.load_state_dict(global_params)
+        if previous is not None:
+            # 平均参数 - 上一轮全局参数 作为伪梯度交给服务器优化器
+            self.server_optimizer.step(list(self.global_model.parameters()), previous)
+        self.round_num += 1
+
+        log_print(f"✅ 全局模型已更新 - 第 {self.round_num} 轮", is_training=True)
+
+    def receive_compressed_update(self, payload):
+        """
+        解压客户端上传的压缩更新：当前全局参数 + 解压后的增量
+
+        Args:
+            payload: 客户端UpdateCompressor.compress的返回值
+
+        Returns:
+            OrderedDict: 还原的客户端参数（与state_dict布局相同），交给聚合使用
+        """
+        flat_buffers = decompress_update(payload, self.flat_store.flat_buffers)
+        return self.flat_store.state_dict_view(flat_buffers)
+
     def evaluate_global_model(self, test_loader):
         """评估全局模型性能"""
         self.global_model.eval()
@@ -197,7 +304,7 @@ class FederatedServer:
 
         with torch.no_grad():
             for batch in test_loader:
-                if batch["series_uid"][0] == "error":
+                if len(batch["series_uid"]) == 0:
                     continue
 
                 images = batch["image"].to(self.device)
@@ -221,6 +328,11 @@ class FederatedServer:
                 "model_state_dict": self.global_model.state_dict(),
                 "round_num": self.round_num,
                 "training_history": self.training_history,
+                "target_spacing": (
+                    list(self.target_spacing)
+                    if self.target_spacing is not None
+                    else None
+                ),
             },
             save_path,
         )
@@ -230,7 +342,14 @@ class FederatedServer:
 class FederatedClient:
     """联邦学习客户端"""
 
-    def __init__(self, client_id: int, model_class, model_kwargs, device="cpu"):
+    def __init__(
+        self,
+        client_id: int,
+        model_class,
+        model_kwargs,
+        device="cpu",
+        shared_store: FlatParameterStore = None,
+    ):
         """
         初始化联邦客户端
 
@@ -239,24 +358,50 @@ class FederatedClient:
             model_class: 模型类
             model_kwargs: 模型初始化参数
             device: 计算设备
+            shared_store: 多个客户端共用的模型扁平存储（单模型模拟模式），
+                          None表示创建独立的模型
         """
         self.client_id = client_id
         self.device = device
-        self.model = model_class(**model_kwargs).to(device)
+        if shared_store is not None:
+            self.model = shared_store.model
+            self.flat_store = shared_store
+        else:
+            self.model = model_class(**model_kwargs).to(device)
+            # 本地模型参数的扁平存储，接收全局模型和上传参数时无需deepcopy
+            self.flat_store = FlatParameterStore(self.model)
         self.model_class = model_class
         self.model_kwargs = model_kwargs
 
         # 本地训练参数
         self.learning_rate = 0.001
         self.local_epochs = 3
+        # 前向/反向是否使用bfloat16 autocast（参数、损失和聚合仍为float32）
+        self.mixed_precision = False
+        # 上传更新的压缩器（UpdateCompressor），None表示上传完整参数
+        self.compressor = None
 
         # 训练历史
         self.training_history = []
 
+        # 最近一次本地训练的耗时统计（秒）
+        self.last_timing = StepTimer(device).summary()
+
+        # 跨轮次保留的本地状态（紧凑存储，训练前换入、训练后换出）
+        self.keep_optimizer_state = False
+        self.optimizer_state_dtype = DEFAULT_STATE_DTYPE
+        self.optimizer_state = None
+        self.local_bn_stats = False
+        self.bn_stats = None
+
     def load_global_model(self, global_params: Dict):
         """加载全局模型参数"""
         self.model.load_state_dict(global_params)
 
+    def load_global_store(self, global_store: FlatParameterStore):
+        """从全局模型的扁平存储整体拷贝参数"""
+        self.flat_store.copy_from(global_store)
+
     def local_train(self, train_loader, epochs=None):
         """
         执行本地训练
@@ -275,32 +420,54 @@ class FederatedClient:
         optimizer = torch.optim.Adam(self.model.parameters(), lr=self.learning_rate)
         criterion = DiceLoss()  # 使用原始训练的DiceLoss
 
+        # 换入本客户端的优化器动量和BN统计量
+        if self.keep_optimizer_state and self.optimizer_state is not None:
+            load_optimizer_state(optimizer, self.optimizer_state)
+        if self.local_bn_stats and self.bn_stats is not None:
+            load_bn_stats(self.model, self.bn_stats)
+
         epoch_losses = []
 
         log_print(
             f"客户端 {self.client_id} 开始本地训练 ({epochs} 轮)...", is_training=True
         )
 
+        # 分阶段计时：数据等待、拷贝、前向、反向、优化器更新
+        timer = StepTimer(self.device)
+        # 加载失败被丢弃的样本数
+        num_dropped = 0
+
         for epoch in range(epochs):
             total_loss = 0.0
             num_batches = 0
 
+            timer.wait()
             for batch_idx, batch in enumerate(train_loader):
+                timer.lap("data_wait")
+                num_samples = 0
                 try:
-                    if batch["series_uid"][0] == "error":
+                    num_dropped += batch.get("num_dropped", 0)
+                    # 整个batch都加载失败时跳过
+                    if len(batch["series_uid"]) == 0:
                         continue
 
                     images = batch["image"].to(self.device)
                     labels = batch["label"].to(self.device)
+                    timer.lap("h2d")
 
                     optimizer.zero_grad()
-                    outputs = self.model(images)
-                    loss = criterion(outputs, labels)
+                    with autocast_context(self.device, self.mixed_precision):
+                        outputs = self.model(images)
+                    loss = criterion(outputs.float(), labels)
+                    timer.lap("forward")
                     loss.backward()
+                    timer.lap("backward")
                     optimizer.step()
 
                     total_loss += loss.item()
                     num_batches += 1
+                    num_samples = len(batch["series_uid"])
+                    timer.lap("optimizer")
 
                     if batch_idx % 10 == 0:  # 减少打印频率
                         log_print(
@@ -313,6 +480,8 @@ class FederatedClient:
                         f"  客户端 {self.client_id} 训练出错: {e}", is_training=True
                     )
                     continue
+                finally:
+                    timer.end_step(num_samples)
 
             avg_loss = total_loss / num_batches if num_batches > 0 else 0.0
             epoch_losses.append(avg_loss)
@@ -321,12 +490,53 @@ class FederatedClient:
                 is_training=True,
             )
 
+        self.last_timing = timer.summary()
+        if num_dropped > 0:
+            log_print(
+                f"  客户端 {self.client_id} - 丢弃 {num_dropped} 个加载失败的样本",
+                is_training=True,
+            )
+        timing = self.last_timing
+        log_print(
+            f"  客户端 {self.client_id} - 数据等待 {timing['data_wait']:.2f}s, "
+            f"计算 {timing['compute']:.2f}s (拷贝 {timing['h2d']:.2f}s, "
+            f"前向 {timing['forward']:.2f}s, 反向 {timing['backward']:.2f}s, "
+            f"优化器 {timing['optimizer']:.2f}s), {timing['samples_per_sec']:.2f} 样本/秒",
+            is_training=True,
+        )
+
+        # 换出本地状态，模型可以交给下一个客户端使用
+        if self.keep_optimizer_state:
+            self.optimizer_state = pack_optimizer_state(
+                optimizer, self.optimizer_state_dtype
+            )
+        if self.local_bn_stats:
+            self.bn_stats = extract_bn_stats(self.model)
+
         self.training_history.extend(epoch_losses)
         return epoch_losses
 
-    def get_model_params(self):
-        """获取本地模型参数"""
-        return copy.deepcopy(self.model.state_dict())
+    def local_state_nbytes(self):
+        """客户端保存的本地状态（优化器动量、BN统计量、压缩残差）占用的字节数"""
+        bn_bytes = sum(t.numel() * t.element_size() for t in self.bn_stats or [])
+        residual_bytes = self.compressor.residual_nbytes() if self.compressor else 0
+        return state_nbytes(self.optimizer_state) + bn_bytes + residual_bytes
+
+    def get_compressed_update(self, global_store: FlatParameterStore):
+        """
+        压缩本轮训练后相对全局模型的参数增量
+
+        Args:
+            global_store: 本轮开始时加载的全局模型扁平存储
+
+        Returns:
+            压缩后的更新，由FederatedServer.receive_compressed_update解压
+        """
+        return self.compressor.compress(self.flat_store, global_store)
+
+    def get_model_params_view(self):
+        """获取本地模型参数的零拷贝视图（在下一次加载全局模型之前有效）"""
+        return self.flat_store.state_dict_view()
 
     def get_data_size(self, data_loader):
         """获取数据集大小"""
@@ -337,7 +547,21 @@ class FederatedLearningCoordinator:
     """联邦学习协调器"""
 
     def __init__(
-        self, num_clients=3, model_class=Simple3DUNet, model_kwargs=None, device="cpu"
+        self,
+        num_clients=3,
+        model_class=Simple3DUNet,
+        model_kwargs=None,
+        device="cpu",
+        simulation=False,
+        keep_optimizer_state=False,
+        local_bn_stats=False,
+        mixed_precision=False,
+        update_compression=None,
+        topk_ratio=0.01,
+        error_feedback=True,
+        server_optimizer=None,
+        server_optimizer_lr=None,
+        server_momentum=0.9,
     ):
         """
         初始化联邦学习协调器
@@ -347,23 +571,78 @@ class FederatedLearningCoordinator:
             model_class: 模型类
             model_kwargs: 模型初始化参数
             device: 计算设备
+            simulation: 单模型模拟模式，所有客户端共用一个模型实例依次训练，
+                        每个客户端只保存自己的本地状态，内存不随客户端数量增长
+            keep_optimizer_state: 客户端是否跨轮次保留优化器动量
+                                  （float32存储，单模型模拟模式下用bfloat16紧凑存储）
+            local_bn_stats: 客户端是否保留自己的BatchNorm统计量
+            mixed_precision: 客户端本地训练是否使用bfloat16 autocast
+            update_compression: 客户端上传更新的压缩方式（"delta"、"int8"或"topk"），
+                                None表示上传完整参数
+            topk_ratio: topk压缩保留的元素比例
+            error_feedback: 压缩时是否使用误差反馈
+            server_optimizer: 聚合后的服务器优化器，"fedavg"、"fedavgm"、"fedadam"或"fedyogi"；
+                              None表示直接使用平均参数
+            server_optimizer_lr: 服务器优化器的学习率，None表示使用该方法的默认值
+            server_momentum: fedavgm的服务器动量系数
         """
         if model_kwargs is None:
             model_kwargs = {"in_channels": 1, "out_channels": 2}
 
         self.num_clients = num_clients
         self.device = device
+        # 各客户端留出的验证数据集（distribute_data_from_folders中划分）
+        self.validation_datasets = []
+        # 客户端数据的来源和采样设置（distribute_data_from_folders中记录，写入轮次检查点）
+        self.data_config = {}
 
         # 创建服务器
         self.server = FederatedServer(model_class, model_kwargs, device)
+        if server_optimizer is not None:
+            self.server.server_optimizer = ServerOptimizer(
+                server_optimizer, lr=server_optimizer_lr, momentum=server_momentum
+            )
 
-        # 创建客户端
-        self.clients = [
-            FederatedClient(i, model_class, model_kwargs, device)
-            for i in range(num_clients)
-        ]
+        self.simulation = simulation
+        if simulation:
+            # 所有客户端共用一个模型实例
+            shared_store = FlatParameterStore(model_class(**model_kwargs).to(device))
+            self.clients = [
+                FederatedClient(
+                    i, model_class, model_kwargs, device, shared_store=shared_store
+                )
+                for i in range(num_clients)
+            ]
+        else:
+            # 创建客户端
+            self.clients = [
+                FederatedClient(i, model_class, model_kwargs, device)
+                for i in range(num_clients)
+            ]
+
+            # 客户端参数存放在同一矩阵的相邻行，聚合时无需拷贝堆叠
+            client_stores = FlatParameterStore.stacked([c.model for c in self.clients])
+            for client, store in zip(self.clients, client_stores):
+                client.flat_store = store
+
+        for client in self.clients:
+            client.keep_optimizer_state = keep_optimizer_state
+            if simulation:
+                client.optimizer_state_dtype = COMPACT_STATE_DTYPE
+            client.local_bn_stats = local_bn_stats
+            client.mixed_precision = mixed_precision
+            if update_compression is not None:
+                client.compressor = UpdateCompressor(
+                    update_compression,
+                    topk_ratio=topk_ratio,
+                    error_feedback=error_feedback,
+                )
 
-        log_print(f"联邦学习系统初始化完成 - {num_clients} 个客户端", is_training=False)
+        log_print(
+            f"联邦学习系统初始化完成 - {num_clients} 个客户端"
+            + (" (单模型模拟模式)" if simulation else ""),
+            is_training=False,
+        )
 
     def distribute_data(self, dataset, distribution_strategy="iid"):
         """
@@ -447,6 +726,18 @@ class FederatedLearningCoordinator:
         csv_path,
         patch_size=(64, 64, 64),
         max_samples_per_client=None,
+        cache_dir=None,
+        patch_sampling="center",
+        patches_per_volume=1,
+        positive_ratio=0.5,
+        num_workers=0,
+        prefetch_factor=2,
+        pin_memory=False,
+        persistent_workers=True,
+        batch_size=1,
+        target_spacing=None,
+        patch_store_dir=None,
+        validation_fraction=0.0,
     ):
         """
         从指定的客户端文件夹分布数据到各个客户端
@@ -456,6 +747,20 @@ class FederatedLearningCoordinator:
             csv_path: CSV注释文件路径
             patch_size: 数据块大小
             max_samples_per_client: 每个客户端的最大样本数量
+            cache_dir: 标准化体数据缓存目录，None表示不使用缓存
+            patch_sampling: patch采样方式，"center"为中心裁剪，"annotation"为以标注为中心的多patch采样
+            patches_per_volume: 每个体数据采样的patch数量（仅annotation模式）
+            positive_ratio: 正样本patch的比例（仅annotation模式）
+            num_workers: 每个客户端的数据加载进程数，0表示在主进程中加载
+            prefetch_factor: 每个数据加载进程预取的batch数
+            pin_memory: 是否使用锁页内存
+            persistent_workers: 是否在epoch/轮次之间保留数据加载进程
+            batch_size: 本地训练的批大小
+            target_spacing: 重采样目标间距 (x, y, z)，None表示保持原始间距
+            patch_store_dir: 分片patch存储根目录，每个客户端使用其下的同名子目录；
+                             None表示直接从MHD/RAW随机读取
+            validation_fraction: 每个客户端留作验证集的体数据比例（至少保留一个训练体数据），
+                                 留出的数据集保存在self.validation_datasets中
 
         Returns:
             客户端数据加载器列表
@@ -466,6 +771,20 @@ class FederatedLearningCoordinator:
             )
 
         client_loaders = []
+        self.validation_datasets = []
+        self.server.target_spacing = target_spacing
+        self.data_config = {
+            "client_data_dirs": [
+                os.path.abspath(d) if d else None for d in client_data_dirs
+            ],
+            "patch_size": list(patch_size),
+            "max_samples_per_client": max_samples_per_client,
+            "patch_sampling": patch_sampling,
+            "patches_per_volume": patches_per_volume,
+            "positive_ratio": positive_ratio,
+            "target_spacing": list(target_spacing) if target_spacing else None,
+            "validation_fraction": validation_fraction,
+        }
 
         for i, data_dir in enumerate(client_data_dirs):
             if not os.path.exists(data_dir):
@@ -509,6 +828,11 @@ class FederatedLearningCoordinator:
                     patch_size=patch_size,
                     max_samples=max_samples_per_client,
                     is_custom=is_custom,
+                    cache_dir=cache_dir,
+                    sampling=patch_sampling,
+                    patches_per_volume=patches_per_volume,
+                    positive_ratio=positive_ratio,
+                    target_spacing=target_spacing,
                 )
 
                 # 如果没有找到数据，创建一个空的数据集
@@ -527,9 +851,91 @@ class FederatedLearningCoordinator:
                         f"客户端 {i} 数据量: 0 (来自 {data_dir})", is_training=True
                     )
                 else:
-                    loader = DataLoader(
-                        client_dataset, batch_size=1, shuffle=True, num_workers=0
-                    )
+                    held_out_uids = set()
+                    num_volumes = len(client_dataset.image_files)
+                    if validation_fraction > 0 and num_volumes > 1:
+                        # 末尾的体数据留作验证集，不参与本地训练
+                        num_held_out = min(
+                            num_volumes - 1,
+                            max(1, int(round(num_volumes * validation_fraction))),
+                        )
+                        validation_dataset = copy.copy(client_dataset)
+                        validation_dataset.image_files = client_dataset.image_files[
+                            -num_held_out:
+                        ]
+                        validation_dataset.rng = np.random.default_rng(i)
+                        validation_dataset._volume_memo = None
+                        client_dataset.image_files = client_dataset.image_files[
+                            :-num_held_out
+                        ]
+                        held_out_uids = {
+                            f["series_uid"] for f in validation_dataset.image_files
+                        }
+                        self.validation_datasets.append(validation_dataset)
+                        log_print(
+                            f"  客户端 {i} 留出 {num_held_out} 个体数据作为验证集",
+                            is_training=True,
+                        )
+
+                    # 根据目录清单估算体数据内存，无需打开图像
+                    if VolumeManifest.exists(data_dir):
+                        manifest = get_volume_manifest(data_dir, csv_path)
+                        estimated_bytes = manifest.estimate_bytes(
+                            itemsize=4,
+                            series_uids={
+                                f["series_uid"] for f in client_dataset.image_files
+                            },
+                        )
+                        log_print(
+                            f"  客户端 {i} 体数据预计内存: {estimated_bytes / 1024**2:.1f} MB",
+                            is_training=True,
+                        )
+
+                    if patch_store_dir is not None and is_custom:
+                        # 增量打包为分片存储，训练时按分片顺序读取
+                        store_dir = os.path.join(
+                            patch_store_dir,
+                            os.path.basename(os.path.normpath(data_dir)),
+                        )
+                        update_patch_store(
+                            data_dir=data_dir,
+                            store_dir=store_dir,
+                            csv_path=csv_path,
+                            patch_size=patch_size,
+                            max_samples=max_samples_per_client,
+                            patches_per_volume=patches_per_volume,
+                            positive_ratio=positive_ratio,
+                            target_spacing=target_spacing,
+                            cache_dir=cache_dir,
+                        )
+                        store_dataset = ShardedPatchDataset(
+                            store_dir, exclude_series_uids=held_out_uids
+                        )
+                        log_print(
+                            f"  客户端 {i} 使用分片存储: {store_dir} "
+                            f"({len(store_dataset.shards)} 个分片, {len(store_dataset)} 个patch)",
+                            is_training=True,
+                        )
+                        loader = build_data_loader(
+                            store_dataset,
+                            batch_size=batch_size,
+                            num_workers=num_workers,
+                            prefetch_factor=prefetch_factor,
+                            pin_memory=pin_memory,
+                            persistent_workers=persistent_workers,
+                        )
+                    else:
+                        # 同一体数据的多个patch连续采样，每个体数据每个epoch只加载一次
+                        loader = build_data_loader(
+                            client_dataset,
+                            batch_size=batch_size,
+                            sampler=VolumeGroupedSampler(client_dataset, shuffle=True),
+                            num_workers=num_workers,
+                            prefetch_factor=prefetch_factor,
+                            pin_memory=pin_memory,
+                            persistent_workers=persistent_workers,
+                            refill_failed=True,
+                        )
                     client_loaders.append(loader)
                     log_print(
                         f"客户端 {i} 数据量: {len(client_dataset.image_files)} (来自 {data_dir})",
@@ -552,8 +958,49 @@ class FederatedLearningCoordinator:
 
         return client_loaders
 
+    def build_validation_loader(self, max_patches=None, batch_size=1, seed=0):
+        """
+        从留出的验证数据集采样一次验证patch，之后每次评估都使用同一批patch
+
+        Args:
+            max_patches: 最多使用的验证patch数，超过时随机子采样；None表示全部使用
+            batch_size: 评估批大小
+            seed: 子采样的随机种子
+
+        Returns:
+            DataLoader: 验证数据加载器，没有留出数据时返回None
+        """
+        if not self.validation_datasets:
+            return None
+
+        build_start = time.perf_counter()
+        validation_set = build_validation_set(
+            self.validation_datasets, max_patches=max_patches, seed=seed
+        )
+        log_print(
+            f"验证集构建完成: {len(validation_set)} 个patch，"
+            f"{validation_set.nbytes / 1024**2:.1f} MB，"
+            f"耗时 {time.perf_counter() - build_start:.2f}s",
+            is_training=True,
+        )
+        if len(validation_set) == 0:
+            return None
+        return DataLoader(validation_set, batch_size=batch_size, shuffle=False)
+
     def federated_training(
-        self, train_loaders, test_loader=None, global_rounds=5, local_epochs=3
+        self,
+        train_loaders,
+        test_loader=None,
+        global_rounds=5,
+        local_epochs=3,
+        parallel_clients=0,
+        aggregation="streaming",
+        client_selector=None,
+        checkpoint_path=None,
+        resume=False,
+        target_loss=None,
+        eval_every=1,
+        early_stopping=None,
     ):
         """
         执行联邦学习训练
@@ -563,39 +1010,71 @@ class FederatedLearningCoordinator:
             test_loader: 测试数据加载器
             global_rounds: 全局训练轮数
             local_epochs: 本地训练轮数
+            parallel_clients: 并行训练的客户端进程数，<=1表示在当前进程中依次训练
+            aggregation: "streaming"为客户端完成后立即折叠进加权和（服务器内存与客户端数无关），
+                         "batch"为收集所有客户端参数后一次性向量化聚合
+            client_selector: 每轮客户端选择器（ClientSelector），None表示每轮所有客户端都参与
+            checkpoint_path: 轮次检查点路径，每轮聚合后在后台线程中写入；None表示不保存
+            resume: 是否从checkpoint_path中最后完成的轮次继续训练
+            target_loss: 目标损失，训练历史记录客户端平均训练损失（avg_loss）
+                         首次达到该损失的轮次（rounds_to_target）
+            eval_every: 每隔多少轮在test_loader上评估一次全局模型（最后一轮总是评估）
+            early_stopping: 按验证损失早停（EarlyStopping），结束时全局模型恢复为最佳轮次；
+                            None表示训练全部轮次
         """
         log_print(f"开始联邦学习训练 - {global_rounds} 轮全局训练", is_training=True)
+        if self.server.server_optimizer is not None:
+            log_print(
+                f"服务器优化器: {self.server.server_optimizer.describe()}",
+                is_training=True,
+            )
 
         # 尝试获取Flask应用中的全局训练状态
-        global_training_status = None
-        try:
-            # 尝试从全局变量获取训练状态
-            import builtins
+        global_training_status = get_flask_training_status()
+        training_metrics = get_flask_training_metrics()
+
+        if self.simulation:
+            # 共用模型时客户端只能依次训练，训练完成后立即折叠进聚合结果
+            if parallel_clients > 1:
+                log_print("单模型模拟模式下不使用并行训练", is_training=True)
+                parallel_clients = 0
+            aggregation = "streaming"
+
+        # 多进程并行训练客户端
+        executor = None
+        if parallel_clients > 1:
+            executor = ParallelRoundExecutor(min(parallel_clients, len(self.clients)))
+            log_print(
+                f"启用并行客户端训练: {executor.num_workers} 个进程，"
+                f"每个进程 {executor.threads_per_worker} 个线程",
+                is_training=True,
+            )
 
-            if hasattr(builtins, "app_training_status"):
-                global_training_status = builtins.app_training_status
-                log_print(
-                    f"成功连接到Flask训练状态: {global_training_status}",
-                    is_training=True,
+        if client_selector is not None:
+            log_print(f"启用客户端选择: {client_selector.describe()}", is_training=True)
+
+        # 轮次检查点：从最后完成的轮次继续，并在每轮聚合后保存
+        start_round = 0
+        checkpointer = None
+        if checkpoint_path:
+            if resume:
+                start_round = self.resume_from_checkpoint(
+                    checkpoint_path, early_stopping, global_rounds
                 )
-            else:
-                # 尝试从各种可能的模块获取
-                import sys
-
-                for module_name in list(sys.modules.keys()):
-                    if module_name in ["app", "__main__"]:
-                        module = sys.modules[module_name]
-                        if hasattr(module, "training_status"):
-                            global_training_status = module.training_status
-                            log_print(
-                                f"从模块 {module_name} 获取训练状态", is_training=True
-                            )
-                            break
-        except Exception as e:
-            log_print(f"无法连接到Flask训练状态: {e}", is_training=True)
-            pass
+            checkpointer = RoundCheckpointer(checkpoint_path)
+        if target_loss is not None:
+            self.server.training_history["target_loss"] = target_loss
+        if early_stopping is not None:
+            log_print(
+                f"启用早停: 每 {eval_every} 轮评估，patience={early_stopping.patience}, "
+                f"min_delta={early_stopping.min_delta}",
+                is_training=True,
+            )
+        stop_reason = f"完成全部 {global_rounds} 轮"
+        # 聚合失败时保留轮次检查点以便继续训练
+        failed = False
 
-        for round_num in range(global_rounds):
+        for round_num in range(start_round, global_rounds):
             import sys  # 确保sys在作用域内可用
 
             log_print(
@@ -622,52 +1101,159 @@ class FederatedLearningCoordinator:
                     log_print(f"更新训练状态失败: {e}", is_training=True)
                     pass
 
-            # 1. 分发全局模型到所有客户端
-            global_params = self.server.get_global_model_params()
-            for client in self.clients:
-                client.load_global_model(global_params)
-
-            # 2. 各客户端执行本地训练
-            client_params_list = []
-            client_weights = []
-
-            log_print(f"开始第 {round_num + 1} 轮客户端本地训练...", is_training=True)
-
+            # 1. 确定本轮参与训练的客户端
+            active = []
             for i, (client, train_loader) in enumerate(
                 zip(self.clients, train_loaders)
             ):
                 if len(train_loader.dataset) == 0:
                     log_print(f"客户端 {i} 数据为空，跳过训练", is_training=True)
                     continue
+                client.local_epochs = local_epochs
+                active.append((i, client, train_loader))
+
+            # 聚合权重（数据量）在训练前即可确定
+            client_weights = [
+                client.get_data_size(train_loader) for _, client, train_loader in active
+            ]
+
+            # 只训练选中的客户端，聚合权重按入选概率修正
+            if client_selector is not None and active:
+                selected_weights = client_selector.select(
+                    round_num,
+                    {i: weight for (i, _, _), weight in zip(active, client_weights)},
+                )
+                active = [entry for entry in active if entry[0] in selected_weights]
+                client_weights = [selected_weights[i] for i, _, _ in active]
+                log_print(
+                    f"第 {round_num + 1} 轮选中 {len(active)} 个客户端: "
+                    + ", ".join(
+                        f"客户端 {i} (权重 {weight:.1f})"
+                        for (i, _, _), weight in zip(active, client_weights)
+                    ),
+                    is_training=True,
+                )
 
-                log_print(f"客户端 {i} 开始本地训练...", is_training=True)
+            selected_clients = [i for i, _, _ in active]
+            if global_training_status:
+                global_training_status["selected_clients"] = selected_clients
+
+            # 2. 分发全局模型到参与训练的客户端（扁平存储整体拷贝）
+            # 单模型模拟模式下在每个客户端训练前分发
+            round_begin = time.perf_counter()
+            copy_start = round_begin
+            if not self.simulation:
+                for _, client, _ in active:
+                    client.load_global_store(self.server.flat_store)
+            param_copy_time = time.perf_counter() - copy_start
+
+            # 3. 各客户端执行本地训练
+            client_params_list = []
+            round_data_wait = 0.0
+            round_compute = 0.0
+            # 压缩上传的字节数（压缩后/未压缩）与各客户端还原增量的相对误差
+            round_update_bytes = 0
+            round_dense_bytes = 0
+            round_update_errors = []
+            # 各客户端的分阶段计时和服务器解压/聚合耗时
+            client_timings = {}
+            aggregation_time = 0.0
 
-                # 本地训练
-                client.local_epochs = local_epochs
-                epoch_losses = client.local_train(train_loader, local_epochs)
+            log_print(f"开始第 {round_num + 1} 轮客户端本地训练...", is_training=True)
 
-                # 收集模型参数和权重
-                client_params = client.get_model_params()
-                client_weight = client.get_data_size(train_loader)
+            aggregator = None
+            if aggregation == "streaming" and active:
+                aggregator = StreamingAggregator(
+                    {i: weight for (i, _, _), weight in zip(active, client_weights)}
+                )
 
-                client_params_list.append(client_params)
-                client_weights.append(client_weight)
+            def collect_result(index, result):
+                """客户端完成后立即处理其结果，流式聚合时折叠后不再保留参数"""
+                nonlocal round_data_wait, round_compute
+                nonlocal round_update_bytes, round_dense_bytes, aggregation_time
+                i, client, _ = active[index]
+                round_data_wait += result["timing"]["data_wait"]
+                round_compute += result["timing"]["compute"]
+                client_timings[i] = result["timing"]
+                params = result.pop("params")
+                if client.compressor is not None:
+                    # 客户端上传压缩增量，服务器解压还原后再聚合
+                    payload = client.get_compressed_update(self.server.flat_store)
+                    round_update_bytes += payload_nbytes(payload)
+                    round_dense_bytes += client.flat_store.nbytes
+                    round_update_errors.append(client.compressor.last_error)
+                aggregation_start = time.perf_counter()
+                if client.compressor is not None:
+                    params = self.server.receive_compressed_update(payload)
+                if aggregator is not None:
+                    aggregator.add(i, params)
+                else:
+                    client_params_list.append((index, params))
+                aggregation_time += time.perf_counter() - aggregation_start
 
                 log_print(
-                    f"客户端 {i} 本地训练完成，数据量: {client_weight}",
+                    f"客户端 {i} 本地训练完成，数据量: {result['weight']}",
                     is_training=True,
                 )
 
-            # 3. 服务器执行模型聚合
-            if client_params_list:
+            round_start = time.perf_counter()
+            if executor is not None and active:
+                log_print(
+                    f"{len(active)} 个客户端并行本地训练 ({executor.num_workers} 个进程)",
+                    is_training=True,
+                )
+                executor.run_round(
+                    [client for _, client, _ in active],
+                    [train_loader for _, _, train_loader in active],
+                    local_epochs,
+                    on_result=collect_result,
+                )
+            else:
+                for index, (i, client, train_loader) in enumerate(active):
+                    log_print(f"客户端 {i} 开始本地训练...", is_training=True)
+
+                    if self.simulation:
+                        copy_start = time.perf_counter()
+                        client.load_global_store(self.server.flat_store)
+                        param_copy_time += time.perf_counter() - copy_start
+
+                    # 本地训练
+                    client.local_train(train_loader, local_epochs)
+                    collect_result(
+                        index,
+                        {
+                            "params": client.get_model_params_view(),
+                            "weight": client.get_data_size(train_loader),
+                            "timing": client.last_timing,
+                        },
+                    )
+
+            log_print(
+                f"第 {round_num + 1} 轮本地训练耗时: {time.perf_counter() - round_start:.2f}s, "
+                f"数据等待时间: {round_data_wait:.2f}s, 计算时间: {round_compute:.2f}s",
+                is_training=True,
+            )
+
+            # 4. 服务器执行模型聚合
+            if active:
                 try:
                     log_print(f"开始第 {round_num + 1} 轮模型聚合...", is_training=True)
 
-                    self.server.federated_averaging(client_params_list, client_weights)
+                    aggregation_start = time.perf_counter()
+                    if aggregator is not None:
+                        self.server.update_global_model(aggregator.result())
+                    else:
+                        # 并行训练时按客户端顺序聚合
+                        client_params_list.sort(key=lambda item: item[0])
+                        self.server.federated_averaging(
+                            [params for _, params in client_params_list],
+                            client_weights,
+                        )
+                    aggregation_time += time.perf_counter() - aggregation_start
 
                     # 记录训练历史
                     client_losses = []
-                    for client in self.clients:
+                    for _, client, _ in active:
                         if client.training_history:
                             recent_losses = client.training_history[-local_epochs:]
                             if recent_losses:
@@ -677,29 +1263,124 @@ class FederatedLearningCoordinator:
 
                     self.server.training_history["rounds"].append(round_num + 1)
                     self.server.training_history["avg_loss"].append(avg_client_loss)
+                    self.server.training_history["selected_clients"].append(
+                        selected_clients
+                    )
 
                     log_print(
                         f"第 {round_num + 1} 轮平均客户端损失: {avg_client_loss:.4f}",
                         is_training=True,
                     )
 
-                    # 4. 评估全局模型（可选，可能跳过以避免错误）
-                    if test_loader is not None:
+                    # 参数分发耗时与进程峰值内存
+                    peak_rss = peak_rss_mb()
+                    history = self.server.training_history
+                    history["param_copy_time"].append(param_copy_time)
+                    history["peak_rss_mb"].append(peak_rss)
+                    log_print(
+                        f"第 {round_num + 1} 轮参数分发耗时: {param_copy_time * 1000:.1f}ms, "
+                        f"峰值内存: {peak_rss:.0f} MB",
+                        is_training=True,
+                    )
+
+                    # 分阶段耗时与吞吐量（不含评估）
+                    round_metrics = summarize_round(
+                        client_timings,
+                        param_copy_time,
+                        aggregation_time,
+                        time.perf_counter() - round_begin,
+                    )
+                    history["round_metrics"].append(round_metrics)
+                    history["samples_per_sec"].append(round_metrics["samples_per_sec"])
+                    log_print(
+                        f"第 {round_num + 1} 轮耗时分解: {format_round_metrics(round_metrics)}",
+                        is_training=True,
+                    )
+                    if training_metrics is not None:
+                        training_metrics["rounds"].append(
+                            {"round": round_num + 1, **round_metrics}
+                        )
+                    if round_dense_bytes:
+                        compression_ratio = round_dense_bytes / round_update_bytes
+                        update_error = float(np.mean(round_update_errors))
+                        history["update_bytes"].append(round_update_bytes)
+                        history["compression_ratio"].append(compression_ratio)
+                        history["update_error"].append(update_error)
+                        log_print(
+                            f"第 {round_num + 1} 轮上传更新: {round_update_bytes / 1024**2:.2f} MB "
+                            f"(未压缩 {round_dense_bytes / 1024**2:.2f} MB, "
+                            f"压缩比 {compression_ratio:.1f}x, 增量相对误差 {update_error:.4f})",
+                            is_training=True,
+                        )
+                    local_state_bytes = sum(
+                        client.local_state_nbytes() for client in self.clients
+                    )
+                    if local_state_bytes:
+                        log_print(
+                            f"客户端本地状态共 {local_state_bytes / 1024**2:.1f} MB",
+                            is_training=True,
+                        )
+
+                    # 5. 评估全局模型（可选，可能跳过以避免错误）
+                    if test_loader is not None and (
+                        (round_num + 1) % eval_every == 0
+                        or round_num == global_rounds - 1
+                    ):
                         try:
                             log_print(
                                 f"评估第 {round_num + 1} 轮全局模型...",
                                 is_training=True,
                             )
                             global_loss = self.server.evaluate_global_model(test_loader)
-                            self.server.training_history["avg_loss"][-1] = global_loss
+                            history["val_rounds"].append(round_num + 1)
+                            history["val_loss"].append(global_loss)
                             log_print(
                                 f"全局模型评估损失: {global_loss:.4f}", is_training=True
                             )
+                            if early_stopping is not None and early_stopping.update(
+                                round_num + 1, global_loss, self.server.global_model
+                            ):
+                                log_print(
+                                    f"验证损失改善，第 {round_num + 1} 轮为当前最佳模型",
+                                    is_training=True,
+                                )
                         except Exception as e:
                             log_print(f"全局模型评估失败: {e}", is_training=True)
                             # 继续训练，不中断
+
+                    # 目标损失按客户端平均训练损失判断（验证损失另记在val_loss中）
+                    round_loss = history["avg_loss"][-1]
+                    if (
+                        target_loss is not None
+                        and history["rounds_to_target"] is None
+                        and round_loss <= target_loss
+                    ):
+                        history["rounds_to_target"] = round_num + 1
+                        log_print(
+                            f"第 {round_num + 1} 轮达到目标损失 {target_loss:.4f} "
+                            f"(当前 {round_loss:.4f})",
+                            is_training=True,
+                        )
+
+                    # 6. 保存轮次检查点（后台线程写入，不阻塞下一轮）
+                    if checkpointer is not None:
+                        checkpointer.save(
+                            self.round_checkpoint_state(round_num + 1, early_stopping)
+                        )
+                        log_print(
+                            f"第 {round_num + 1} 轮检查点已提交后台写入: {checkpointer.path}",
+                            is_training=True,
+                        )
+
+                    # 7. 验证损失长期没有改善时提前结束
+                    if early_stopping is not None and early_stopping.should_stop:
+                        stop_reason = early_stopping.stop_reason()
+                        log_print(stop_reason, is_training=True)
+                        break
                 except Exception as e:
                     log_print(f"模型聚合失败: {e}", is_training=True)
+                    stop_reason = f"模型聚合失败: {e}"
+                    failed = True
                     break
 
             # 更新全局训练状态（如果存在）
@@ -724,9 +1405,382 @@ class FederatedLearningCoordinator:
                 except Exception as e:
                     log_print(f"更新最终训练状态失败: {e}", is_training=True)
 
-        log_print("\n联邦学习训练完成！", is_training=True)
+        if executor is not None:
+            executor.shutdown()
+        if checkpointer is not None:
+            checkpointer.wait()
+            if checkpointer.last_saved is not None:
+                saved_round, write_time = checkpointer.last_saved
+                log_print(
+                    f"最后的轮次检查点: 第 {saved_round} 轮，写入耗时 {write_time:.2f}s",
+                    is_training=True,
+                )
+            if not failed:
+                # 训练已正常结束，检查点不再用于继续训练
+                checkpointer.remove()
+
+        history = self.server.training_history
+        history["stop_reason"] = stop_reason
+        if early_stopping is not None and early_stopping.best_state is not None:
+            # 保存的最终模型为验证损失最佳的轮次
+            history["best_round"] = early_stopping.best_round
+            self.server.global_model.load_state_dict(early_stopping.best_state)
+            log_print(
+                f"全局模型恢复为第 {early_stopping.best_round} 轮的最佳模型 "
+                f"(验证损失 {early_stopping.best_loss:.4f})",
+                is_training=True,
+            )
+        if global_training_status:
+            global_training_status["stop_reason"] = stop_reason
+
+        log_print(f"\n联邦学习训练完成！({stop_reason})", is_training=True)
         return self.server.training_history
 
+    def checkpoint_config(self):
+        """
+        决定训练结果的运行配置，写入轮次检查点，继续训练时必须与当前配置一致
+
+        Returns:
+            dict: 客户端数、模型、上传压缩、服务器优化器和客户端数据设置
+        """
+        compressor = self.clients[0].compressor if self.clients else None
+        server_optimizer = self.server.server_optimizer
+        return {
+            "num_clients": len(self.clients),
+            "model_class": self.server.model_class.__name__,
+            "model_kwargs": dict(self.server.model_kwargs),
+            "update_compression": compressor.method if compressor else None,
+            "topk_ratio": compressor.topk_ratio if compressor else None,
+            "server_optimizer": server_optimizer.method if server_optimizer else None,
+            "data": self.data_config,
+        }
+
+    def round_checkpoint_state(self, completed_rounds, early_stopping=None):
+        """
+        当前训练状态的检查点快照
+
+        模型参数为拷贝；客户端本地状态每轮都会整体替换为新张量，直接引用即可，
+        后台写入时训练可以继续
+
+        Args:
+            completed_rounds: 已完成的全局轮数
+            early_stopping: 早停状态（EarlyStopping），None表示未启用
+
+        Returns:
+            dict: 检查点内容
+        """
+        return {
+            "round": completed_rounds,
+            "num_clients": len(self.clients),
+            "config": self.checkpoint_config(),
+            "model_state_dict": OrderedDict(
+                (name, tensor.clone())
+                for name, tensor in self.server.global_model.state_dict().items()
+            ),
+            "training_history": copy.deepcopy(self.server.training_history),
+            "clients": [
+                {
+                    "optimizer_state": client.optimizer_state,
+                    "bn_stats": client.bn_stats,
+                    "residuals": (
+                        dict(client.compressor.residuals) if client.compressor else None
+                    ),
+                    "training_history": list(client.training_history),
+                }
+                for client in self.clients
+            ],
+            "server_optimizer": (
+                self.server.server_optimizer.state_dict()
+                if self.server.server_optimizer is not None
+                else None
+            ),
+            "early_stopping": (
+                early_stopping.state_dict() if early_stopping is not None else None
+            ),
+            "rng_state": capture_rng_state(),
+        }
+
+    def resume_from_checkpoint(
+        self, checkpoint_path, early_stopping=None, global_rounds=None
+    ):
+        """
+        从轮次检查点恢复服务器和客户端状态
+
+        检查点的运行配置（checkpoint_config）与当前不一致，或已完成的轮数不少于
+        global_rounds时不恢复（检查点来自另一次训练）
+
+        Args:
+            checkpoint_path: 检查点路径
+            early_stopping: 需要恢复状态的EarlyStopping，None表示未启用
+            global_rounds: 本次训练的全局轮数，None表示不检查
+
+        Returns:
+            int: 已完成的全局轮数，没有可用检查点时返回0
+        """
+        checkpoint = load_round_checkpoint(checkpoint_path)
+        if checkpoint is None:
+            log_print(
+                f"未找到轮次检查点 {checkpoint_path}，从头开始训练", is_training=True
+            )
+            return 0
+        saved_config = checkpoint.get("config") or {}
+        config = self.checkpoint_config()
+        mismatched = [
+            key
+            for key in sorted(set(config) | set(saved_config))
+            if config.get(key) != saved_config.get(key)
+        ]
+        if mismatched:
+            log_print(
+                f"检查点的运行配置与本次训练不一致 ({', '.join(mismatched)})，"
+                "不恢复检查点，从头开始训练",
+                is_training=True,
+            )
+            return 0
+        if global_rounds is not None and checkpoint["round"] >= global_rounds:
+            log_print(
+                f"检查点已完成 {checkpoint['round']} 轮，不少于本次的 {global_rounds} 轮，"
+                "从头开始训练",
+                is_training=True,
+            )
+            return 0
+
+        self.server.global_model.load_state_dict(checkpoint["model_state_dict"])
+        self.server.round_num = checkpoint["round"]
+        self.server.training_history.update(checkpoint["training_history"])
+        for client, state in zip(self.clients, checkpoint["clients"]):
+            client.optimizer_state = state["optimizer_state"]
+            client.bn_stats = state["bn_stats"]
+            if client.compressor is not None and state["residuals"]:
+                client.compressor.residuals = state["residuals"]
+            client.training_history = state["training_history"]
+        if (
+            self.server.server_optimizer is not None
+            and checkpoint.get("server_optimizer") is not None
+        ):
+            self.server.server_optimizer.load_state_dict(checkpoint["server_optimizer"])
+        if early_stopping is not None and checkpoint.get("early_stopping") is not None:
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+        restore_rng_state(checkpoint["rng_state"])
+
+        log_print(
+            f"从轮次检查点恢复: {checkpoint_path}，已完成 {checkpoint['round']} 轮",
+            is_training=True,
+        )
+        return checkpoint["round"]
+
+    def federated_training_async(
+        self,
+        train_loaders,
+        test_loader=None,
+        global_rounds=5,
+        local_epochs=3,
+        parallel_clients=0,
+        buffer_size=2,
+        server_lr=1.0,
+    ):
+        """
+        异步缓冲联邦训练（FedBuff）
+
+        没有轮次屏障：客户端训练完成后立即提交增量并拉取最新的全局模型继续训练，
+        服务器每缓冲buffer_size个增量更新一次全局模型，慢客户端不再拖慢其他客户端
+
+        Args:
+            train_loaders: 客户端训练数据加载器列表
+            test_loader: 测试数据加载器
+            global_rounds: 全局模型更新次数（训练结束时的模型版本号）
+            local_epochs: 每次本地训练的轮数
+            parallel_clients: 同时训练的客户端进程数，<=1表示在当前进程中轮流训练
+            buffer_size: 每次更新全局模型所需的客户端增量数K
+            server_lr: 服务器学习率
+
+        Returns:
+            dict: 服务器训练历史
+        """
+        log_print(
+            f"开始异步联邦学习训练 - 全局模型更新 {global_rounds} 次，"
+            f"缓冲区大小 {buffer_size}，服务器学习率 {server_lr}",
+            is_training=True,
+        )
+        global_training_status = get_flask_training_status()
+
+        active = []
+        for i, (client, train_loader) in enumerate(zip(self.clients, train_loaders)):
+            if len(train_loader.dataset) == 0:
+                log_print(f"客户端 {i} 数据为空，跳过训练", is_training=True)
+                continue
+            client.local_epochs = local_epochs
+            active.append((i, client, train_loader))
+        if not active:
+            log_print("没有可训练的客户端", is_training=True)
+            return self.server.training_history
+        if any(client.compressor is not None for _, client, _ in active):
+            # 异步模式下服务器直接读取客户端相对拉取版本的增量
+            log_print("异步模式下不使用更新压缩", is_training=True)
+
+        if self.simulation and parallel_clients > 1:
+            # 共用模型时客户端只能依次训练
+            log_print("单模型模拟模式下不使用并行训练", is_training=True)
+            parallel_clients = 0
+
+        aggregator = BufferedAsyncAggregator(
+            self.server.flat_store, buffer_size=buffer_size, server_lr=server_lr
+        )
+        history = self.server.training_history
+        train_start = time.perf_counter()
+        # 当前缓冲区中的客户端及其损失、拉取参数的耗时
+        buffered_clients = []
+        buffered_losses = []
+        param_copy_time = 0.0
+
+        def pull(client):
+            nonlocal param_copy_time
+            copy_start = time.perf_counter()
+            version = aggregator.pull(client.flat_store)
+            param_copy_time += time.perf_counter() - copy_start
+            return version
+
+        def submit_update(i, client, base_version, result):
+            """把客户端的训练结果交给服务器，缓冲区满时记录新的全局模型版本"""
+            nonlocal param_copy_time
+            version_before = aggregator.version
+            staleness = aggregator.add(
+                client.flat_store, base_version, result["weight"]
+            )
+            buffered_clients.append(i)
+            buffered_losses.extend(result["epoch_losses"])
+            log_print(
+                f"客户端 {i} 提交更新 - 基于版本 {base_version}，过时 {staleness}，"
+                f"数据量: {result['weight']}",
+                is_training=True,
+            )
+            if aggregator.version == version_before:
+                return
+
+            # 全局模型已更新
+            version = aggregator.version
+            self.server.round_num = version
+            elapsed = time.perf_counter() - train_start
+            throughput = aggregator.num_updates / elapsed if elapsed > 0 else 0.0
+            avg_loss = float(np.mean(buffered_losses)) if buffered_losses else 0.0
+            peak_rss = peak_rss_mb()
+
+            history["rounds"].append(version)
+            history["avg_loss"].append(avg_loss)
+            history["selected_clients"].append(list(buffered_clients))
+            history["param_copy_time"].append(param_copy_time)
+            history["peak_rss_mb"].append(peak_rss)
+            history["model_version"].append(version)
+            history["update_throughput"].append(throughput)
+            history["staleness_histogram"] = aggregator.staleness_summary()
+            buffered_clients.clear()
+            buffered_losses.clear()
+            param_copy_time = 0.0
+
+            log_print(
+                f"✅ 全局模型已更新 - 版本 {version}/{global_rounds}，平均客户端损失: {avg_loss:.4f}，"
+                f"吞吐量: {throughput:.2f} 更新/秒，过时分布: {history['staleness_histogram']}，"
+                f"峰值内存: {peak_rss:.0f} MB",
+                is_training=True,
+            )
+
+            if global_training_status:
+                try:
+                    global_training_status["current_round"] = version
+                    global_training_status["progress"] = int(
+                        version / global_rounds * 100
+                    )
+                    global_training_status["model_version"] = version
+                    global_training_status["staleness_histogram"] = history[
+                        "staleness_histogram"
+                    ]
+                    global_training_status["update_throughput"] = round(throughput, 3)
+                except Exception as e:
+                    log_print(f"更新训练状态失败: {e}", is_training=True)
+
+            if test_loader is not None:
+                try:
+                    global_loss = self.server.evaluate_global_model(test_loader)
+                    history["val_rounds"].append(version)
+                    history["val_loss"].append(global_loss)
+                except Exception as e:
+                    log_print(f"全局模型评估失败: {e}", is_training=True)
+
+        if parallel_clients > 1:
+            executor = ParallelRoundExecutor(min(parallel_clients, len(active)))
+            log_print(
+                f"{executor.num_workers} 个进程异步训练 {len(active)} 个客户端，"
+                f"每个进程 {executor.threads_per_worker} 个线程",
+                is_training=True,
+            )
+            # 空闲客户端按轮转顺序等待训练，同时训练的客户端数不超过进程数
+            idle = list(active)
+            in_flight = {}
+
+            def launch():
+                i, client, train_loader = idle.pop(0)
+                base_version = pull(client)
+                future = executor.submit(client, train_loader, local_epochs)
+                in_flight[future] = (i, client, train_loader, base_version)
+
+            while idle and len(in_flight) < executor.num_workers:
+                launch()
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, client, train_loader, base_version = in_flight.pop(future)
+                    result = executor.collect(client, future)
+                    if aggregator.version < global_rounds:
+                        submit_update(i, client, base_version, result)
+                    idle.append((i, client, train_loader))
+                # 达到目标版本后不再提交新任务，等待进行中的任务结束
+                while (
+                    aggregator.version < global_rounds
+                    and idle
+                    and len(in_flight) < executor.num_workers
+                ):
+                    launch()
+            executor.shutdown()
+        else:
+            # 依次轮流训练，每个客户端训练前拉取最新的全局模型
+            position = 0
+            while aggregator.version < global_rounds:
+                i, client, train_loader = active[position % len(active)]
+                position += 1
+                base_version = pull(client)
+                epoch_losses = client.local_train(train_loader, local_epochs)
+                submit_update(
+                    i,
+                    client,
+                    base_version,
+                    {
+                        "weight": client.get_data_size(train_loader),
+                        "epoch_losses": epoch_losses,
+                    },
+                )
+
+        elapsed = time.perf_counter() - train_start
+        log_print(
+            f"\n异步联邦学习训练完成！模型版本: {aggregator.version}，"
+            f"客户端更新: {aggregator.num_updates} 次，耗时 {elapsed:.2f}s，"
+            f"吞吐量: {aggregator.num_updates / elapsed:.2f} 更新/秒，"
+            f"过时分布: {aggregator.staleness_summary()}",
+            is_training=True,
+        )
+
+        if global_training_status:
+            try:
+                global_training_status["current_round"] = global_rounds
+                global_training_status["progress"] = 100
+                global_training_status["is_training"] = False
+                global_training_status["end_time"] = datetime.now().strftime(
+                    "%Y-%m-%d %H:%M:%S"
+                )
+            except Exception as e:
+                log_print(f"更新最终训练状态失败: {e}", is_training=True)
+
+        return history
+
     def save_federated_model(self, save_path="federated_luna16_model.pth"):
         """保存联邦学习模型"""
         self.server.save_global_model(save_path)
@@ -745,6 +1799,10 @@ class FederatedLearningCoordinator:
             # 损失曲线
             plt.subplot(1, 2, 1)
             plt.plot(history["rounds"], history["avg_loss"], "b-o", label="平均损失")
+            if history["val_loss"]:
+                plt.plot(
+                    history["val_rounds"], history["val_loss"], "r-s", label="验证损失"
+                )
             plt.xlabel("全局训练轮次")
             plt.ylabel("损失")
             plt.title("联邦学习训练损失")
@@ -753,7 +1811,9 @@ class FederatedLearningCoordinator:
 
             # 客户端参与情况
             plt.subplot(1, 2, 2)
-            client_participation = [len(self.clients)] * len(history["rounds"])
+            client_participation = [
+                len(selected) for selected in history["selected_clients"]
+            ]
             plt.bar(
                 history["rounds"], client_participation, alpha=0.7, label="参与客户端数"
             )
@@ -777,7 +1837,50 @@ class FederatedLearningCoordinator:
 
 
 def train_federated_model(
-    num_clients=3, global_rounds=5, local_epochs=3, client_data_dirs=None
+    num_clients=3,
+    global_rounds=5,
+    local_epochs=3,
+    client_data_dirs=None,
+    cache_dir=DEFAULT_CACHE_DIR,
+    patch_sampling="annotation",
+    patches_per_volume=4,
+    positive_ratio=0.5,
+    num_workers=0,
+    prefetch_factor=2,
+    pin_memory=False,
+    persistent_workers=True,
+    batch_size=1,
+    target_spacing=None,
+    patch_store_dir=None,
+    parallel_clients=0,
+    aggregation="streaming",
+    simulation=False,
+    keep_optimizer_state=False,
+    local_bn_stats=False,
+    client_fraction=1.0,
+    selection_strategy="uniform",
+    selection_seed=None,
+    client_availability=None,
+    asynchronous=False,
+    buffer_size=2,
+    server_lr=1.0,
+    mixed_precision=False,
+    patch_size=(64, 64, 64),
+    checkpoint_stages=None,
+    update_compression=None,
+    topk_ratio=0.01,
+    error_feedback=True,
+    checkpoint_path=None,
+    resume=False,
+    server_optimizer=None,
+    server_optimizer_lr=None,
+    server_momentum=0.9,
+    target_loss=None,
+    validation_fraction=0.0,
+    max_validation_patches=32,
+    eval_every=1,
+    patience=None,
+    min_delta=0.0,
 ):
     """
     训练联邦学习模型的主函数
@@ -788,6 +1891,52 @@ def train_federated_model(
         local_epochs: 本地训练轮数
         client_data_dirs: 客户端数据目录列表，例如 ["./client0", "./client1", "./client2"]
                          如果为None，则使用原有的数据分布策略
+        cache_dir: 标准化体数据缓存目录，每个MHD/RAW只解码一次；None表示不使用缓存
+        patch_sampling: patch采样方式，"annotation"为以标注为中心的多patch采样，"center"为中心裁剪
+        patches_per_volume: 每个体数据每个epoch采样的patch数量
+        positive_ratio: 以结节为中心的正样本patch比例
+        num_workers: 每个客户端的数据加载进程数，>0时数据加载与训练计算重叠
+        prefetch_factor: 每个数据加载进程预取的batch数
+        pin_memory: 是否使用锁页内存（GPU训练时加速拷贝）
+        persistent_workers: 是否在轮次之间保留数据加载进程
+        batch_size: 本地训练的批大小，加载失败的样本会被丢弃并从数据集中补齐
+        target_spacing: 重采样目标间距 (x, y, z)，例如(1.0, 1.0, 1.0)；None表示保持原始间距
+        patch_store_dir: 分片patch存储根目录（例如"./cache/patch_store"），
+                         客户端patch打包成大分片顺序读取；None表示直接读取MHD/RAW
+        parallel_clients: 并行训练的客户端进程数，每个进程分得 CPU核数/进程数 个线程；
+                          <=1表示依次训练各客户端
+        aggregation: 聚合方式，"streaming"为客户端完成即折叠的在线聚合，"batch"为一次性聚合
+        simulation: 单模型模拟模式，所有客户端共用一个模型实例，只保存各自的本地状态
+        keep_optimizer_state: 客户端是否跨轮次保留优化器动量
+        local_bn_stats: 客户端是否保留自己的BatchNorm统计量
+        client_fraction: 每轮参与训练的客户端比例C，1.0表示所有客户端都参与
+        selection_strategy: 客户端选择策略，"uniform"、"weighted"（按数据量）或"availability"
+        selection_seed: 客户端选择的随机种子，相同种子每轮的选择结果相同
+        client_availability: 客户端序号 -> 在线概率，availability策略使用
+        asynchronous: 是否使用异步缓冲聚合（FedBuff），global_rounds为全局模型更新次数
+        buffer_size: 异步模式下每次更新全局模型所需的客户端增量数
+        server_lr: 异步模式下的服务器学习率
+        mixed_precision: 客户端本地训练是否使用bfloat16 autocast（损失和聚合仍为float32）
+        patch_size: 训练patch大小 (z, y, x)
+        checkpoint_stages: Simple3DUNet中做激活检查点的conv_block阶段，"all"表示全部阶段，
+                           用重算换内存以训练更大的patch；None表示不使用
+        update_compression: 客户端上传更新的压缩方式，"delta"、"int8"或"topk"；
+                            None表示上传完整参数
+        topk_ratio: topk压缩保留的元素比例
+        error_feedback: 压缩时是否把残差累积到下一轮上传
+        checkpoint_path: 轮次检查点路径（例如"./checkpoints/federated_round.pth"），
+                         每轮聚合后在后台写入；None表示不保存
+        resume: 是否从轮次检查点中最后完成的轮次继续训练
+        server_optimizer: 聚合后的服务器优化器，"fedavg"、"fedavgm"、"fedadam"或"fedyogi"；
+                          None表示直接使用平均参数（同步模式）
+        server_optimizer_lr: 服务器优化器的学习率，None表示使用该方法的默认值
+        server_momentum: fedavgm的服务器动量系数
+        target_loss: 目标损失，训练历史记录客户端平均训练损失首次达到该损失的轮次
+        validation_fraction: 每个客户端留作验证集的体数据比例，0表示不评估全局模型
+        max_validation_patches: 验证集最多使用的patch数（随机子采样），None表示全部使用
+        eval_every: 每隔多少轮评估一次全局模型
+        patience: 验证损失连续多少次评估未改善时早停，None表示不早停
+        min_delta: 视为验证损失改善的最小降低量
     """
     import sys
     import io
@@ -809,8 +1958,22 @@ def train_federated_model(
     coordinator = FederatedLearningCoordinator(
         num_clients=num_clients,
         model_class=Simple3DUNet,
-        model_kwargs={"in_channels": 1, "out_channels": 2},
+        model_kwargs={
+            "in_channels": 1,
+            "out_channels": 2,
+            "checkpoint_stages": checkpoint_stages,
+        },
         device=device,
+        simulation=simulation,
+        keep_optimizer_state=keep_optimizer_state,
+        local_bn_stats=local_bn_stats,
+        mixed_precision=mixed_precision,
+        update_compression=update_compression,
+        topk_ratio=topk_ratio,
+        error_feedback=error_feedback,
+        server_optimizer=server_optimizer,
+        server_optimizer_lr=server_optimizer_lr,
+        server_momentum=server_momentum,
     )
     print("联邦学习协调器初始化完成")
     sys.stdout.flush()
@@ -828,8 +1991,20 @@ def train_federated_model(
         client_loaders = coordinator.distribute_data_from_folders(
             client_data_dirs=client_data_dirs,
             csv_path=csv_path,
-            patch_size=(64, 64, 64),
+            patch_size=patch_size,
             max_samples_per_client=15,  # 每个客户端最大样本数
+            cache_dir=cache_dir,
+            patch_sampling=patch_sampling,
+            patches_per_volume=patches_per_volume,
+            positive_ratio=positive_ratio,
+            num_workers=num_workers,
+            prefetch_factor=prefetch_factor,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+            batch_size=batch_size,
+            target_spacing=target_spacing,
+            patch_store_dir=patch_store_dir,
+            validation_fraction=validation_fraction,
         )
         print(f"数据加载完成，共 {len(client_loaders)} 个客户端")
         sys.stdout.flush()
@@ -839,21 +2014,72 @@ def train_federated_model(
         sys.stdout.flush()
         client_loaders = []
 
-    # 创建测试数据集 - 跳过测试阶段以避免错误
-    print("跳过测试数据集创建...")
+    # 从留出的体数据构建验证集（只采样一次），没有留出数据时跳过评估
     test_loader = None
+    if validation_fraction > 0:
+        test_loader = coordinator.build_validation_loader(
+            max_patches=max_validation_patches, batch_size=batch_size
+        )
+    if test_loader is None:
+        print("跳过验证数据集创建...")
     sys.stdout.flush()
 
+    early_stopping = None
+    if patience is not None:
+        if test_loader is None:
+            log_print("没有验证集，不启用早停", is_training=True)
+        else:
+            early_stopping = EarlyStopping(patience=patience, min_delta=min_delta)
+
     # 执行联邦学习训练
     print("开始执行联邦学习训练...")
     sys.stdout.flush()
 
-    training_history = coordinator.federated_training(
-        train_loaders=client_loaders,
-        test_loader=test_loader,
-        global_rounds=global_rounds,
-        local_epochs=local_epochs,
-    )
+    client_selector = None
+    if client_fraction < 1.0 or selection_strategy != "uniform":
+        client_selector = ClientSelector(
+            strategy=selection_strategy,
+            fraction=client_fraction,
+            seed=selection_seed,
+            availability=client_availability,
+        )
+
+    if asynchronous:
+        if client_selector is not None:
+            log_print("异步模式下所有客户端持续训练，忽略客户端选择", is_training=True)
+        if checkpoint_path:
+            log_print("异步模式暂不保存轮次检查点", is_training=True)
+        if server_optimizer is not None:
+            log_print(
+                "异步模式使用缓冲聚合的服务器学习率，忽略服务器优化器",
+                is_training=True,
+            )
+        if early_stopping is not None:
+            log_print("异步模式暂不支持早停", is_training=True)
+        training_history = coordinator.federated_training_async(
+            train_loaders=client_loaders,
+            test_loader=test_loader,
+            global_rounds=global_rounds,
+            local_epochs=local_epochs,
+            parallel_clients=parallel_clients,
+            buffer_size=buffer_size,
+            server_lr=server_lr,
+        )
+    else:
+        training_history = coordinator.federated_training(
+            train_loaders=client_loaders,
+            test_loader=test_loader,
+            global_rounds=global_rounds,
+            local_epochs=local_epochs,
+            parallel_clients=parallel_clients,
+            aggregation=aggregation,
+            client_selector=client_selector,
+            checkpoint_path=checkpoint_path,
+            resume=resume,
+            target_loss=target_loss,
+            eval_every=eval_every,
+            early_stopping=early_stopping,
+        )
 
     # 保存模型
     print("正在保存训练好的模型...")
@@ -908,13 +2134,10 @@ def run_federated_training(
             for item in os.listdir(data_dir):
                 item_path = os.path.join(data_dir, item)
                 if os.path.isdir(item_path):
-                    # 检查是否包含.mhd文件
-                    has_mhd = any(
-                        f.endswith(".mhd")
-                        for f in os.listdir(item_path)
-                        if os.path.isfile(os.path.join(item_path, f))
-                    )
-                    if has_mhd:
+                    # 通过目录清单检查是否包含.mhd文件（只对变化的文件重新登记）
+                    manifest = get_volume_manifest(item_path)
+                    manifest.refresh()
+                    if manifest.mhd_count > 0:
                         potential_clients.append(item_path)
 
             if potential_clients:
@@ -0,0 +1,157 @@
+"""
+扁平连续的模型参数存储
+把模型的所有参数和缓冲区按数据类型拷贝到少量连续的一维张量中，
+再把各模块的参数/缓冲区重新绑定为这些张量的视图
+
+这样分发全局模型只需一次 copy_，收集客户端参数可以直接使用零拷贝视图，
+不再需要对state_dict做deepcopy；扁平张量可以放入共享内存供其他进程直接读写
+"""
+
+import resource
+from collections import OrderedDict
+
+import torch
+
+
+class FlatParameterStore:
+    """模型参数和缓冲区的扁平存储"""
+
+    def __init__(self, model, flat_buffers=None, copy_values=None):
+        """
+        把模型的参数/缓冲区绑定到扁平存储上
+
+        Args:
+            model: 要绑定的模型
+            flat_buffers: 已有的扁平张量 {dtype: tensor}（例如其他进程共享的张量），
+                          为None时新建
+            copy_values: 是否把模型当前的值拷入扁平存储，None表示仅在新建时拷贝
+        """
+        self.model = model
+        # state_dict中的每一项: (名称, 模块, 属性名, 是否为参数, dtype, 偏移, 形状)
+        self.entries = []
+
+        sizes = {}
+        for module_name, module in model.named_modules():
+            for kind, tensors in (
+                ("param", module._parameters),
+                ("buffer", module._buffers),
+            ):
+                for attr, tensor in tensors.items():
+                    if tensor is None:
+                        continue
+                    name = f"{module_name}.{attr}" if module_name else attr
+                    offset = sizes.get(tensor.dtype, 0)
+                    self.entries.append(
+                        (
+                            name,
+                            module,
+                            attr,
+                            kind == "param",
+                            tensor.dtype,
+                            offset,
+                            tensor.shape,
+                        )
+                    )
+                    sizes[tensor.dtype] = offset + tensor.numel()
+
+        device = next(model.parameters()).device
+        self.sizes = sizes
+        if copy_values is None:
+            copy_values = flat_buffers is None
+        if flat_buffers is None:
+            flat_buffers = {
+                dtype: torch.empty(size, dtype=dtype, device=device)
+                for dtype, size in sizes.items()
+            }
+        self.flat_buffers = flat_buffers
+
+        for name, module, attr, is_param, dtype, offset, shape in self.entries:
+            numel = shape.numel()
+            view = self.flat_buffers[dtype][offset : offset + numel].view(shape)
+            if is_param:
+                tensor = module._parameters[attr]
+                if copy_values:
+                    view.copy_(tensor.data)
+                tensor.data = view
+            else:
+                if copy_values:
+                    view.copy_(module._buffers[attr])
+                module._buffers[attr] = view
+
+    @classmethod
+    def stacked(cls, models):
+        """
+        为多个结构相同的模型创建扁平存储，各模型的扁平张量是同一矩阵的相邻行，
+        聚合时可以直接把所有客户端的参数当作一个矩阵使用，无需拷贝堆叠
+
+        Args:
+            models: 结构相同的模型列表
+
+        Returns:
+            与models顺序一致的FlatParameterStore列表
+        """
+        first = cls(models[0])
+        matrices = {
+            dtype: torch.empty(
+                (len(models), tensor.numel()), dtype=dtype, device=tensor.device
+            )
+            for dtype, tensor in first.flat_buffers.items()
+        }
+        return [
+            cls(
+                model,
+                flat_buffers={dtype: matrix[i] for dtype, matrix in matrices.items()},
+                copy_values=True,
+            )
+            for i, model in enumerate(models)
+        ]
+
+    @property
+    def nbytes(self):
+        """扁平存储占用的字节数"""
+        return sum(t.numel() * t.element_size() for t in self.flat_buffers.values())
+
+    def share_memory_(self):
+        """把扁平张量移入共享内存（视图仍然有效）"""
+        for tensor in self.flat_buffers.values():
+            tensor.share_memory_()
+        return self
+
+    def copy_from(self, other):
+        """
+        从另一个扁平存储拷贝全部参数（用于分发全局模型）
+
+        Args:
+            other: 结构相同的FlatParameterStore
+        """
+        with torch.no_grad():
+            for dtype, tensor in self.flat_buffers.items():
+                tensor.copy_(other.flat_buffers[dtype])
+
+    def state_dict_view(self, flat_buffers=None):
+        """
+        以state_dict的形式返回参数的零拷贝视图
+
+        Args:
+            flat_buffers: 布局相同的其他扁平张量 {dtype: tensor}（例如解压还原的客户端参数），
+                          None表示本存储的扁平张量
+
+        Returns:
+            OrderedDict: 参数名 -> 扁平存储上的视图
+        """
+        if flat_buffers is None:
+            flat_buffers = self.flat_buffers
+        views = OrderedDict()
+        for name, module, attr, is_param, dtype, offset, shape in self.entries:
+            if not is_param and attr in module._non_persistent_buffers_set:
+                continue
+            views[name] = flat_buffers[dtype][offset : offset + shape.numel()].view(
+                shape
+            )
+        return views
+
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存 (MB)"""
+    # Linux下ru_maxrss的单位为KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
@@ -0,0 +1,192 @@
+"""
+轻量级MetaImage(.mhd/.raw)读取
+解析.mhd文本头，对未压缩的.raw数据使用memmap零拷贝映射，
+裁剪patch时只会读取需要的页；压缩数据等无法映射的情况回退到SimpleITK
+
+坐标约定与SimpleITK保持一致：数组为 (z, y, x) 顺序，spacing/origin为 (x, y, z) 顺序，
+origin取自Offset字段（与 sitk.Image.GetOrigin() 相同）
+"""
+
+import os
+import numpy as np
+import SimpleITK as sitk
+
+# MetaImage元素类型到NumPy类型的映射（MET_LONG等平台相关类型不做映射，回退到SimpleITK）
+MET_ELEMENT_TYPES = {
+    "MET_CHAR": "i1",
+    "MET_UCHAR": "u1",
+    "MET_SHORT": "i2",
+    "MET_USHORT": "u2",
+    "MET_INT": "i4",
+    "MET_UINT": "u4",
+    "MET_LONG_LONG": "i8",
+    "MET_ULONG_LONG": "u8",
+    "MET_FLOAT": "f4",
+    "MET_DOUBLE": "f8",
+}
+
+# 同义字段
+_ORIGIN_KEYS = ("Offset", "Origin", "Position")
+_BYTE_ORDER_KEYS = ("BinaryDataByteOrderMSB", "ElementByteOrderMSB")
+
+
+class MetaImageHeader:
+    """解析后的.mhd文件头"""
+
+    def __init__(self, mhd_path):
+        """
+        读取并解析.mhd文件头
+
+        Args:
+            mhd_path: .mhd文件路径
+        """
+        self.mhd_path = mhd_path
+        self.fields = {}
+        # ElementDataFile为LOCAL时，数据紧跟在文件头之后
+        self.local_data_offset = None
+
+        with open(mhd_path, "rb") as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                key, sep, value = line.decode("latin-1").partition("=")
+                if not sep:
+                    continue
+                key = key.strip()
+                self.fields[key] = value.strip()
+                # ElementDataFile总是文件头的最后一个字段
+                if key == "ElementDataFile":
+                    self.local_data_offset = f.tell()
+                    break
+
+        ndims = int(self.fields.get("NDims", 0))
+        self.dim_size = tuple(int(v) for v in self.fields.get("DimSize", "").split())
+        if ndims and len(self.dim_size) != ndims:
+            raise ValueError(f"DimSize与NDims不匹配: {mhd_path}")
+
+        spacing = self.fields.get("ElementSpacing") or self.fields.get("ElementSize")
+        self.spacing = (
+            tuple(float(v) for v in spacing.split())
+            if spacing
+            else (1.0,) * len(self.dim_size)
+        )
+
+        origin = next((self.fields[k] for k in _ORIGIN_KEYS if k in self.fields), None)
+        self.origin = (
+            tuple(float(v) for v in origin.split())
+            if origin
+            else (0.0,) * len(self.dim_size)
+        )
+
+        self.element_type = self.fields.get("ElementType", "")
+        self.compressed = self.fields.get("CompressedData", "False").lower() == "true"
+        self.channels = int(self.fields.get("ElementNumberOfChannels", 1))
+        self.header_size = int(self.fields.get("HeaderSize", 0))
+
+        msb = next((self.fields[k] for k in _BYTE_ORDER_KEYS if k in self.fields), "")
+        self.big_endian = msb.lower() == "true"
+
+        data_file = self.fields.get("ElementDataFile", "")
+        if data_file == "LOCAL":
+            self.data_path = mhd_path
+        elif data_file and not data_file.startswith("LIST") and "%" not in data_file:
+            self.data_path = os.path.join(os.path.dirname(mhd_path), data_file)
+        else:
+            self.data_path = None
+
+    @property
+    def dtype(self):
+        """NumPy数据类型（含字节序），不支持的类型返回None"""
+        code = MET_ELEMENT_TYPES.get(self.element_type)
+        if code is None:
+            return None
+        return np.dtype(code).newbyteorder(">" if self.big_endian else "<")
+
+    @property
+    def shape(self):
+        """数组形状 (z, y, x)"""
+        return tuple(reversed(self.dim_size))
+
+    @property
+    def nbytes(self):
+        """像素数据的字节数"""
+        dtype = self.dtype
+        if dtype is None:
+            return None
+        return int(np.prod(self.dim_size)) * self.channels * dtype.itemsize
+
+    def can_memmap(self):
+        """是否可以直接用memmap映射像素数据"""
+        return (
+            not self.compressed
+            and self.channels == 1
+            and len(self.dim_size) == 3
+            and self.dtype is not None
+            and self.data_path is not None
+            and os.path.exists(self.data_path)
+        )
+
+    def data_offset(self):
+        """像素数据在数据文件中的字节偏移"""
+        if self.data_path == self.mhd_path:
+            base = self.local_data_offset
+        else:
+            base = 0
+        if self.header_size == -1:
+            # HeaderSize = -1 表示数据位于文件末尾
+            return os.path.getsize(self.data_path) - self.nbytes
+        return base + self.header_size
+
+
+def read_volume(mhd_path):
+    """
+    读取体数据，能映射时返回只读memmap（零拷贝），否则回退到SimpleITK
+
+    Args:
+        mhd_path: .mhd文件路径
+
+    Returns:
+        tuple: (array, spacing, origin)，array为 (z, y, x)，spacing/origin为 (x, y, z)
+    """
+    try:
+        header = MetaImageHeader(mhd_path)
+    except (OSError, ValueError):
+        header = None
+
+    if header is not None and header.can_memmap():
+        array = np.memmap(
+            header.data_path,
+            dtype=header.dtype,
+            mode="r",
+            offset=header.data_offset(),
+            shape=header.shape,
+        )
+        return array, header.spacing, header.origin
+
+    # 压缩数据或特殊格式，使用SimpleITK读取
+    image = sitk.ReadImage(mhd_path)
+    return sitk.GetArrayFromImage(image), image.GetSpacing(), image.GetOrigin()
+
+
+class NormalizedVolume:
+    """
+    延迟标准化的体数据视图：切片时才读取并标准化对应区域，
+    配合memmap使用时只会读取patch需要的页
+    """
+
+    def __init__(self, array, normalize):
+        """
+        Args:
+            array: 原始体数据（通常为memmap）
+            normalize: 标准化函数
+        """
+        self.array = array
+        self.normalize = normalize
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def __getitem__(self, key):
+        return self.normalize(np.asarray(self.array[key]))
@@ -0,0 +1,241 @@
+"""
+客户端本地训练的并行轮次执行器
+每个客户端的本地训练在独立的进程中运行，各进程按CPU核数划分torch线程数，
+一轮的耗时接近最慢的客户端，而不是所有客户端耗时之和
+
+子进程中log_print的消息通过队列转发回主进程，仍会出现在Flask训练日志中
+"""
+
+import os
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+from torch.utils.data import RandomSampler
+
+from train_simple_model import (
+    VolumeGroupedBatchSampler,
+    VolumeGroupedSampler,
+    build_data_loader,
+)
+from flat_params import FlatParameterStore
+
+
+def _forward_logs(log_queue):
+    """主进程中把子进程的日志转发给Flask日志函数（子进程已在终端打印过）"""
+    import federated_training
+
+    while True:
+        item = log_queue.get()
+        if item is None:
+            break
+        is_training, message = item
+        try:
+            if is_training and federated_training.flask_add_training_log:
+                federated_training.flask_add_training_log(message)
+            elif not is_training and federated_training.flask_add_server_log:
+                federated_training.flask_add_server_log(message)
+        except Exception as e:
+            print(f"Flask日志函数调用失败: {e}")
+
+
+def _init_worker(num_threads, log_queue):
+    """子进程初始化：限制torch线程数，并把日志发送到队列"""
+    torch.set_num_threads(num_threads)
+
+    import federated_training
+
+    federated_training.set_flask_log_functions(
+        lambda message: log_queue.put((True, message)),
+        lambda message: log_queue.put((False, message)),
+    )
+
+
+def _local_train_task(
+    client_id,
+    model_class,
+    model_kwargs,
+    device,
+    learning_rate,
+    mixed_precision,
+    flat_buffers,
+    dataset,
+    loader_kwargs,
+    local_epochs,
+    local_state,
+):
+    """
+    在子进程中执行一个客户端的本地训练
+
+    模型参数直接绑定到主进程客户端的共享内存扁平存储上，训练结果原地写回，
+    无需把参数传回主进程
+    """
+    from federated_training import FederatedClient
+
+    client = FederatedClient(client_id, model_class, model_kwargs, device)
+    client.learning_rate = learning_rate
+    client.mixed_precision = mixed_precision
+    client.flat_store = FlatParameterStore(client.model, flat_buffers=flat_buffers)
+    # 本地状态（优化器动量、BN统计量）随任务传入并随结果传回
+    for key, value in local_state.items():
+        setattr(client, key, value)
+
+    train_loader = build_data_loader(dataset, **loader_kwargs)
+    epoch_losses = client.local_train(train_loader, local_epochs)
+
+    return {
+        "weight": client.get_data_size(train_loader),
+        "epoch_losses": epoch_losses,
+        "timing": client.last_timing,
+        "local_state": {key: getattr(client, key) for key in local_state},
+    }
+
+
+def describe_loader(loader):
+    """
+    提取数据加载器的构建参数，用于在子进程中重建
+
+    Args:
+        loader: build_data_loader创建的DataLoader
+
+    Returns:
+        build_data_loader的关键字参数（不含dataset）
+    """
+    batch_size = loader.batch_size
+    sampler = (
+        loader.sampler if isinstance(loader.sampler, VolumeGroupedSampler) else None
+    )
+    if isinstance(loader.batch_sampler, VolumeGroupedBatchSampler):
+        batch_size = loader.batch_sampler.batch_size
+        sampler = loader.batch_sampler.sampler
+    return {
+        "batch_size": batch_size,
+        "sampler": sampler,
+        "shuffle": isinstance(loader.sampler, RandomSampler),
+        "num_workers": loader.num_workers,
+        "prefetch_factor": loader.prefetch_factor if loader.num_workers > 0 else 2,
+        "pin_memory": loader.pin_memory,
+        "persistent_workers": loader.persistent_workers,
+        "refill_failed": getattr(loader.collate_fn, "refill", False),
+    }
+
+
+class ParallelRoundExecutor:
+    """在进程池中并行执行客户端本地训练"""
+
+    def __init__(self, num_workers, threads_per_worker=None):
+        """
+        Args:
+            num_workers: 并行训练的进程数
+            threads_per_worker: 每个进程的torch线程数，None表示按CPU核数平均划分
+        """
+        self.num_workers = num_workers
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+        self.threads_per_worker = threads_per_worker
+
+        # spawn避免fork时复制主进程的线程和锁（Flask线程、torch线程池）
+        context = mp.get_context("spawn")
+        self._log_queue = context.Queue()
+        self._log_thread = threading.Thread(
+            target=_forward_logs, args=(self._log_queue,), daemon=True
+        )
+        self._log_thread.start()
+        self._pool = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(threads_per_worker, self._log_queue),
+        )
+
+    def submit(self, client, train_loader, local_epochs):
+        """
+        提交一个客户端的本地训练任务
+
+        客户端应已加载全局模型，子进程直接在客户端的共享内存扁平存储上训练，
+        任务完成前主进程不应修改该客户端的参数
+
+        Args:
+            client: 客户端
+            train_loader: 客户端的数据加载器
+            local_epochs: 本地训练轮数
+
+        Returns:
+            Future，完成后交给collect处理
+        """
+        # 已在共享内存中时不会重复移动
+        client.flat_store.share_memory_()
+        return self._pool.submit(
+            _local_train_task,
+            client.client_id,
+            client.model_class,
+            client.model_kwargs,
+            client.device,
+            client.learning_rate,
+            client.mixed_precision,
+            client.flat_store.flat_buffers,
+            train_loader.dataset,
+            describe_loader(train_loader),
+            local_epochs,
+            {
+                "keep_optimizer_state": client.keep_optimizer_state,
+                "optimizer_state": client.optimizer_state,
+                "local_bn_stats": client.local_bn_stats,
+                "bn_stats": client.bn_stats,
+            },
+        )
+
+    def collect(self, client, future):
+        """
+        把已完成任务的训练结果写回主进程的客户端对象
+
+        Returns:
+            结果字典，包含 "params", "weight", "epoch_losses", "timing"
+        """
+        result = future.result()
+
+        # 参数已原地写回共享内存，其余状态与串行训练保持一致
+        result["params"] = client.get_model_params_view()
+        client.training_history.extend(result["epoch_losses"])
+        client.last_timing = result["timing"]
+        for key, value in result.pop("local_state").items():
+            setattr(client, key, value)
+        return result
+
+    def run_round(self, clients, train_loaders, local_epochs, on_result=None):
+        """
+        并行执行一轮本地训练，训练结果写回主进程的客户端对象
+
+        客户端应已加载本轮的全局模型，子进程直接在客户端的共享内存扁平存储上训练
+
+        Args:
+            clients: 参与训练的客户端列表
+            train_loaders: 对应的数据加载器列表
+            local_epochs: 本地训练轮数
+            on_result: 每个客户端完成时立即调用的回调 on_result(index, result)，
+                       可在其他客户端仍在训练时处理（例如流式聚合）
+
+        Returns:
+            与clients顺序一致的结果列表，每项包含 "params", "weight", "timing"
+        """
+        futures = {
+            self.submit(client, loader, local_epochs): index
+            for index, (client, loader) in enumerate(zip(clients, train_loaders))
+        }
+
+        results = [None] * len(clients)
+        for future in as_completed(futures):
+            index = futures[future]
+            result = self.collect(clients[index], future)
+            results[index] = result
+            if on_result is not None:
+                on_result(index, result)
+
+        return results
+
+    def shutdown(self):
+        """关闭进程池和日志转发线程"""
+        self._pool.shutdown(wait=True)
+        self._log_queue.put(None)
+        self._log_thread.join(timeout=5)
@@ -0,0 +1,449 @@
+"""
+客户端训练数据的分片patch存储
+将客户端预处理好的patch（图像float16/uint8 + 标签uint8）打包成少量大分片文件并建立索引，
+训练时按分片顺序读取并通过shuffle buffer打乱，把随机小文件读取变成大块顺序读取
+
+构建是增量的：新上传到 uploads/clientN_data 的体数据只会追加新的分片，
+源文件发生变化的体数据会在旧分片中标记为失效；失效记录过多的分片在构建结束时被压缩
+（有效记录复制到新分片，旧文件删除）
+
+patch位置在打包时采样一次，之后的epoch和轮次复用同一批patch（抖动和负样本位置固定）；
+resample=True时重新采样并打包所有体数据
+
+用法:
+    python patch_store.py <数据目录> <存储目录> [标注文件路径] [--resample]
+"""
+
+import os
+import sys
+import json
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from train_simple_model import SimpleLUNA16Dataset
+from volume_cache import source_signature
+from volume_manifest import VolumeManifest, get_volume_manifest
+
+INDEX_FILENAME = "index.json"
+DEFAULT_PATCH_STORE_DIR = "./cache/patch_store"
+# 单个分片的最大字节数
+DEFAULT_MAX_SHARD_BYTES = 1024**3
+# 有效记录比例低于该值的分片在构建结束时被压缩
+DEFAULT_MIN_LIVE_FRACTION = 0.5
+
+
+def _load_index(store_dir):
+    path = os.path.join(store_dir, INDEX_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _save_index(store_dir, index):
+    path = os.path.join(store_dir, INDEX_FILENAME)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _record_layout(patch_size, image_dtype):
+    """单条记录的布局: (图像字节数, 标签字节数)"""
+    voxels = int(np.prod(patch_size))
+    return voxels * np.dtype(image_dtype).itemsize, voxels
+
+
+def _encode_image(image, image_dtype):
+    if np.dtype(image_dtype) == np.uint8:
+        return np.round(np.clip(image, 0.0, 1.0) * 255).astype(np.uint8)
+    return image.astype(image_dtype)
+
+
+def _decode_image(image, image_dtype):
+    if np.dtype(image_dtype) == np.uint8:
+        return image.astype(np.float32) / 255.0
+    return image.astype(np.float32)
+
+
+def _new_shard(index):
+    """分配新分片（文件名序号单调递增，压缩删除旧分片后也不会重名）"""
+    number = index.get("next_shard")
+    if number is None:
+        number = 1 + max(
+            (int(s["file"][len("shard_") : -len(".bin")]) for s in index["shards"]),
+            default=-1,
+        )
+    index["next_shard"] = number + 1
+    return {"file": f"shard_{number:05d}.bin", "num_records": 0, "ranges": []}
+
+
+def compact_patch_store(store_dir, index, min_live_fraction=DEFAULT_MIN_LIVE_FRACTION):
+    """
+    压缩分片存储：删除没有有效记录的分片，有效记录比例低于min_live_fraction的分片
+    把有效记录复制到一个新分片后删除
+
+    Args:
+        store_dir: 分片存储目录
+        index: 分片存储的索引字典（原地修改；先保存新索引再删除旧分片文件）
+        min_live_fraction: 需要压缩的有效记录比例阈值
+
+    Returns:
+        int: 删除的分片文件数
+    """
+    image_bytes, label_bytes = _record_layout(
+        index["settings"]["patch_size"], index["settings"]["image_dtype"]
+    )
+    record_bytes = image_bytes + label_bytes
+
+    keep, sparse = [], []
+    for shard in index["shards"]:
+        live = sum(count for _, _, count in shard["ranges"])
+        if live >= shard["num_records"] * min_live_fraction and live > 0:
+            keep.append(shard)
+        else:
+            sparse.append(shard)
+    if not sparse:
+        return 0
+
+    live_ranges = [(s, r) for s in sparse for r in s["ranges"]]
+    if live_ranges:
+        shard = _new_shard(index)
+        tmp_path = os.path.join(store_dir, shard["file"] + ".tmp")
+        with open(tmp_path, "wb") as out:
+            for old_shard, (series_uid, start, count) in live_ranges:
+                with open(os.path.join(store_dir, old_shard["file"]), "rb") as f:
+                    f.seek(start * record_bytes)
+                    out.write(f.read(count * record_bytes))
+                shard["ranges"].append([series_uid, shard["num_records"], count])
+                shard["num_records"] += count
+                index["volumes"][series_uid]["shard"] = shard["file"]
+        os.replace(tmp_path, os.path.join(store_dir, shard["file"]))
+        keep.append(shard)
+
+    index["shards"] = keep
+    _save_index(store_dir, index)
+    for old_shard in sparse:
+        try:
+            os.remove(os.path.join(store_dir, old_shard["file"]))
+        except OSError:
+            pass
+    return len(sparse)
+
+
+def update_patch_store(
+    data_dir,
+    store_dir,
+    csv_path,
+    patch_size=(64, 64, 64),
+    max_samples=None,
+    patches_per_volume=4,
+    positive_ratio=0.5,
+    target_spacing=None,
+    cache_dir=None,
+    image_dtype="float16",
+    max_shard_bytes=DEFAULT_MAX_SHARD_BYTES,
+    resample=False,
+    min_live_fraction=DEFAULT_MIN_LIVE_FRACTION,
+):
+    """
+    增量构建客户端的分片patch存储：只处理尚未打包或源文件已变化的体数据，
+    新patch写入新的分片文件；已不在数据集中的体数据（源文件被删除或超出max_samples）
+    从索引中移除，最后压缩失效记录过多的分片
+
+    Args:
+        data_dir: 客户端数据目录
+        store_dir: 分片存储目录
+        csv_path: 标注文件路径
+        patch_size: patch大小
+        max_samples: 最多打包的体数据数量
+        patches_per_volume: 每个体数据打包的patch数量（打包时采样一次，之后各epoch复用）
+        positive_ratio: 以结节为中心的正样本比例
+        target_spacing: 重采样目标间距，None表示保持原始间距
+        cache_dir: 标准化体数据缓存目录
+        image_dtype: 图像存储类型，"float16"或"uint8"
+        max_shard_bytes: 单个分片的最大字节数
+        resample: 是否重新采样并打包所有体数据（刷新固定下来的抖动和负样本位置）
+        min_live_fraction: 有效记录比例低于该值的分片会被压缩
+
+    Returns:
+        分片存储的索引字典
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    settings = {
+        "patch_size": list(patch_size),
+        "image_dtype": str(np.dtype(image_dtype)),
+        "patches_per_volume": patches_per_volume,
+        "positive_ratio": positive_ratio,
+        "target_spacing": list(target_spacing) if target_spacing else None,
+    }
+
+    index = _load_index(store_dir)
+    if index is None or index.get("settings") != settings:
+        # 打包设置变化时旧分片不再可用
+        if index is not None:
+            print(f"分片存储设置已变化，重新构建: {store_dir}")
+            for shard in index["shards"]:
+                try:
+                    os.remove(os.path.join(store_dir, shard["file"]))
+                except OSError:
+                    pass
+        index = {"settings": settings, "shards": [], "volumes": {}}
+
+    # 体数据签名：优先使用清单中的内容哈希，否则使用文件mtime/大小
+    manifest_entries = {}
+    if VolumeManifest.exists(data_dir):
+        manifest = get_volume_manifest(data_dir, csv_path)
+        manifest.refresh()
+        manifest_entries = {e["series_uid"]: e for e in manifest.volumes.values()}
+
+    dataset = SimpleLUNA16Dataset(
+        data_dir=data_dir,
+        csv_path=csv_path,
+        patch_size=tuple(patch_size),
+        max_samples=max_samples,
+        is_custom=True,
+        cache_dir=cache_dir,
+        sampling="annotation",
+        patches_per_volume=patches_per_volume,
+        positive_ratio=positive_ratio,
+        target_spacing=target_spacing,
+    )
+
+    pending = []
+    for volume_idx, item in enumerate(dataset.image_files):
+        entry = manifest_entries.get(item["series_uid"])
+        signature = (
+            entry["content_hash"]
+            if entry and entry.get("content_hash")
+            else source_signature(item["image_path"])
+        )
+        packed = index["volumes"].get(item["series_uid"])
+        if not resample and packed is not None and packed["signature"] == signature:
+            continue
+        pending.append((volume_idx, item["series_uid"], signature))
+
+    # 不在当前数据集中的体数据：记录标记为失效，由压缩回收
+    current_uids = {item["series_uid"] for item in dataset.image_files}
+    removed_uids = set(index["volumes"]) - current_uids
+    for series_uid in removed_uids:
+        del index["volumes"][series_uid]
+    if removed_uids:
+        for old_shard in index["shards"]:
+            old_shard["ranges"] = [
+                r for r in old_shard["ranges"] if r[0] not in removed_uids
+            ]
+
+    if not pending and not removed_uids:
+        print(f"分片存储已是最新: {store_dir}")
+        return index
+
+    image_bytes, label_bytes = _record_layout(patch_size, image_dtype)
+    record_bytes = image_bytes + label_bytes
+
+    shard_file = None
+    shard = None
+
+    def close_shard():
+        if shard_file is None:
+            return
+        shard_file.close()
+        os.replace(
+            os.path.join(store_dir, shard["file"] + ".tmp"),
+            os.path.join(store_dir, shard["file"]),
+        )
+        index["shards"].append(shard)
+
+    written = 0
+    for volume_idx, series_uid, signature in pending:
+        # 源文件变化的体数据：旧分片中的记录标记为失效
+        index["volumes"].pop(series_uid, None)
+        for old_shard in index["shards"]:
+            old_shard["ranges"] = [r for r in old_shard["ranges"] if r[0] != series_uid]
+
+        records = []
+        for patch_idx in range(patches_per_volume):
+            sample = dataset[volume_idx * patches_per_volume + patch_idx]
+            if sample["series_uid"] == "error":
+                continue
+            records.append(
+                (
+                    _encode_image(sample["image"][0].numpy(), image_dtype),
+                    sample["label"].numpy().astype(np.uint8),
+                )
+            )
+        if not records:
+            continue
+
+        # 当前分片写满时开始新分片
+        if shard is None or (
+            (shard["num_records"] + len(records)) * record_bytes > max_shard_bytes
+        ):
+            close_shard()
+            shard = _new_shard(index)
+            shard_file = open(os.path.join(store_dir, shard["file"] + ".tmp"), "wb")
+
+        for image, label in records:
+            shard_file.write(image.tobytes())
+            shard_file.write(label.tobytes())
+
+        shard["ranges"].append([series_uid, shard["num_records"], len(records)])
+        shard["num_records"] += len(records)
+        index["volumes"][series_uid] = {"signature": signature, "shard": shard["file"]}
+        written += 1
+
+    close_shard()
+    _save_index(store_dir, index)
+    removed = compact_patch_store(store_dir, index, min_live_fraction)
+    print(
+        f"分片存储已更新: {store_dir}，新增 {written} 个体数据"
+        + (f"，移除 {len(removed_uids)} 个体数据" if removed_uids else "")
+        + (f"，压缩删除 {removed} 个分片" if removed else "")
+    )
+    return index
+
+
+class ShardedPatchDataset(IterableDataset):
+    """
+    顺序读取分片patch存储的数据集：
+    每个epoch打乱分片顺序，分片内按块顺序读取，再经shuffle buffer打乱样本
+
+    多个数据加载进程时，各进程用相同的种子打乱分片顺序后按进程序号间隔划分，
+    每个分片每个epoch恰好被一个进程读取一次；shuffle buffer使用各进程自己的rng
+    """
+
+    def __init__(
+        self,
+        store_dir,
+        shuffle=True,
+        shuffle_buffer=64,
+        read_records=16,
+        exclude_series_uids=None,
+        seed=None,
+    ):
+        """
+        Args:
+            store_dir: 分片存储目录
+            shuffle: 是否打乱
+            shuffle_buffer: shuffle buffer大小（样本数）
+            read_records: 每次顺序读取的记录数
+            exclude_series_uids: 不读取的体数据（例如留作验证集的体数据）
+            seed: 分片顺序的基础种子，None表示随机选取
+        """
+        self.store_dir = store_dir
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.read_records = read_records
+        self.rng = np.random.default_rng()
+        self.seed = (
+            int(np.random.default_rng().integers(2**31)) if seed is None else seed
+        )
+        # 已开始的epoch数（每个数据加载进程的副本各自计数，步调一致）
+        self.epoch = 0
+
+        index = _load_index(store_dir)
+        if index is None:
+            raise FileNotFoundError(f"分片存储不存在: {store_dir}")
+        settings = index["settings"]
+        self.patch_size = tuple(settings["patch_size"])
+        self.image_dtype = np.dtype(settings["image_dtype"])
+        exclude = set(exclude_series_uids or ())
+        self.shards = []
+        for shard in index["shards"]:
+            ranges = [r for r in shard["ranges"] if r[0] not in exclude]
+            if ranges:
+                self.shards.append({**shard, "ranges": ranges})
+
+        self.image_bytes, self.label_bytes = _record_layout(
+            self.patch_size, self.image_dtype
+        )
+
+    def __len__(self):
+        return sum(count for s in self.shards for _, _, count in s["ranges"])
+
+    def _read_shard(self, shard):
+        """按块顺序读取一个分片中的所有有效记录"""
+        record_bytes = self.image_bytes + self.label_bytes
+        with open(os.path.join(self.store_dir, shard["file"]), "rb") as f:
+            for series_uid, start, count in shard["ranges"]:
+                f.seek(start * record_bytes)
+                remaining = count
+                while remaining > 0:
+                    n = min(self.read_records, remaining)
+                    block = np.frombuffer(f.read(n * record_bytes), dtype=np.uint8)
+                    block = block.reshape(n, record_bytes)
+                    for record in block:
+                        image = record[: self.image_bytes].view(self.image_dtype)
+                        label = record[self.image_bytes :]
+                        yield {
+                            "image": torch.from_numpy(
+                                _decode_image(image, self.image_dtype).reshape(
+                                    self.patch_size
+                                )
+                            ).unsqueeze(0),
+                            "label": torch.from_numpy(
+                                label.reshape(self.patch_size).astype(np.int64)
+                            ),
+                            "series_uid": series_uid,
+                        }
+                    remaining -= n
+
+    def _shard_order(self, worker_info):
+        """
+        本epoch的分片顺序，所有数据加载进程相同
+
+        进程的种子为 DataLoader基础种子 + 进程序号：非持久进程每个epoch重新创建，
+        基础种子随之变化；持久进程的基础种子固定，由epoch计数区分各epoch
+        """
+        shards = list(self.shards)
+        if self.shuffle:
+            base_seed = (
+                worker_info.seed - worker_info.id
+                if worker_info is not None
+                else self.seed
+            )
+            rng = np.random.default_rng([base_seed % 2**63, self.epoch])
+            rng.shuffle(shards)
+        self.epoch += 1
+        return shards
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        shards = self._shard_order(worker_info)
+
+        # 多个数据加载进程时按分片划分
+        if worker_info is not None:
+            shards = shards[worker_info.id :: worker_info.num_workers]
+
+        buffer = []
+        for shard in shards:
+            for sample in self._read_shard(shard):
+                if not self.shuffle:
+                    yield sample
+                    continue
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                i = self.rng.integers(len(buffer))
+                yield buffer[i]
+                buffer[i] = sample
+
+        if self.shuffle:
+            self.rng.shuffle(buffer)
+        yield from buffer
+
+
+if __name__ == "__main__":
+    if len([arg for arg in sys.argv[1:] if arg != "--resample"]) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    resample = "--resample" in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != "--resample"]
+    update_patch_store(
+        data_dir=args[0],
+        store_dir=args[1],
+        csv_path=args[2] if len(args) > 2 else "./src/annotations.csv",
+        resample=resample,
+    )
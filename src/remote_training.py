@@ -0,0 +1,355 @@
+"""
+进程外客户端的联邦训练服务端
+客户端代理（client_agent.py）在各自的机器上用本地数据训练，通过HTTP与服务器交互，
+原始CT不再需要上传到服务器：
+    注册        POST /api/fl/register  {"name", "data_size"} -> 客户端序号和训练配置
+    查询状态    GET  /api/fl/status    -> 当前模型版本、是否结束
+    拉取模型    GET  /api/fl/model     -> 全局模型的扁平张量（响应头X-FL-Model-Version为版本号）
+    上传更新    POST /api/fl/update?client_id=&base_version=  -> 压缩后的参数增量
+
+同步FedAvg：当前版本收齐num_clients个客户端的更新后，服务器解压并聚合，版本号加一；
+基于旧版本的更新被拒绝，客户端拉取新模型后重新训练。更新在保存前检查权重、
+各dtype的元素数和数值是否有限；聚合失败时丢弃本轮已收到的更新，客户端重新训练
+
+模型和更新用torch.save序列化，服务器用weights_only=True读取，不执行任意pickle对象
+"""
+
+import io
+import math
+import threading
+from datetime import datetime
+
+import numpy as np
+import torch
+
+from federated_training import FederatedServer, get_flask_training_status, log_print
+from train_simple_model import Simple3DUNet
+from update_compression import decompress_update
+
+# 客户端代理请求头中的访问令牌（服务器的FL_AGENT_TOKEN，未设置时启动远程训练时随机生成）
+TOKEN_HEADER = "X-FL-Token"
+VERSION_HEADER = "X-FL-Model-Version"
+
+
+def serialize(obj):
+    """用torch.save把张量字典序列化为字节"""
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    return buffer.getvalue()
+
+
+def deserialize(data):
+    """读取serialize的结果（只允许张量和基本类型）"""
+    return torch.load(io.BytesIO(data), map_location="cpu", weights_only=True)
+
+
+class StaleUpdateError(Exception):
+    """更新基于旧版本的全局模型，或该客户端本版本已提交过更新"""
+
+
+class UnknownClientError(Exception):
+    """提交更新的客户端序号未注册"""
+
+
+class RemoteTrainingSession:
+    """一次远程联邦训练：管理全局模型版本，收集客户端代理的更新并聚合"""
+
+    def __init__(
+        self,
+        num_clients=2,
+        global_rounds=5,
+        local_epochs=2,
+        model_class=Simple3DUNet,
+        model_kwargs=None,
+        update_compression="int8",
+        topk_ratio=0.01,
+        error_feedback=True,
+        mixed_precision=False,
+        save_path="best_federated_lung_nodule_model.pth",
+    ):
+        """
+        Args:
+            num_clients: 每轮聚合所需的客户端更新数
+            global_rounds: 全局训练轮数
+            local_epochs: 客户端本地训练轮数
+            model_class: 模型类
+            model_kwargs: 模型初始化参数
+            update_compression: 客户端上传更新的压缩方式，"delta"、"int8"或"topk"
+            topk_ratio: topk压缩保留的元素比例
+            error_feedback: 客户端压缩时是否使用误差反馈
+            mixed_precision: 客户端本地训练是否使用bfloat16 autocast
+            save_path: 训练结束时保存全局模型的路径
+        """
+        if model_kwargs is None:
+            model_kwargs = {"in_channels": 1, "out_channels": 2}
+        self.num_clients = num_clients
+        self.global_rounds = global_rounds
+        self.save_path = save_path
+        self.server = FederatedServer(model_class, model_kwargs, device="cpu")
+
+        # 下发给客户端代理的训练配置
+        self.config = {
+            "model_kwargs": model_kwargs,
+            "local_epochs": local_epochs,
+            "update_compression": update_compression,
+            "topk_ratio": topk_ratio,
+            "error_feedback": error_feedback,
+            "mixed_precision": mixed_precision,
+            "global_rounds": global_rounds,
+        }
+
+        self._lock = threading.Lock()
+        # 客户端序号 -> {"name", "data_size", "last_seen"}
+        self.agents = {}
+        # 当前版本已收到的更新: 客户端序号 -> (还原的参数, 权重, 损失, 压缩误差, 字节数)
+        self._updates = {}
+        self._model_bytes = None
+        self.finished = False
+        # Flask应用中的训练状态（不在Flask中运行时为None）
+        self._training_status = get_flask_training_status()
+
+    @property
+    def version(self):
+        """全局模型版本号（已完成的聚合轮数）"""
+        return self.server.round_num
+
+    def register(self, name, data_size):
+        """
+        注册一个客户端代理
+
+        Args:
+            name: 客户端名称（例如医院名）
+            data_size: 本地训练样本数
+
+        Returns:
+            dict: 客户端序号和训练配置
+        """
+        with self._lock:
+            client_id = len(self.agents)
+            self.agents[client_id] = {
+                "name": name,
+                "data_size": data_size,
+                "last_seen": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            }
+        log_print(
+            f"客户端代理注册: {name} (序号 {client_id}, 数据量 {data_size})",
+            is_training=True,
+        )
+        return {"client_id": client_id, **self.config}
+
+    def status(self):
+        """当前版本、已收到的更新数和是否结束"""
+        with self._lock:
+            return {
+                "version": self.version,
+                "global_rounds": self.global_rounds,
+                "num_clients": self.num_clients,
+                "updates_received": len(self._updates),
+                "pending_clients": sorted(self._updates),
+                "registered": len(self.agents),
+                "finished": self.finished,
+            }
+
+    def model_bytes(self):
+        """
+        当前版本全局模型的序列化扁平张量（每个版本只序列化一次）
+
+        Returns:
+            tuple: (版本号, 字节)
+        """
+        with self._lock:
+            if self._model_bytes is None or self._model_bytes[0] != self.version:
+                self._model_bytes = (
+                    self.version,
+                    serialize(dict(self.server.flat_store.flat_buffers)),
+                )
+            return self._model_bytes
+
+    def submit_update(self, client_id, base_version, data):
+        """
+        接收一个客户端代理的压缩更新，收齐num_clients个更新后聚合
+
+        Args:
+            client_id: 客户端序号
+            base_version: 客户端训练时使用的全局模型版本
+            data: 序列化的 {"payload", "weight", "loss", "update_error"}
+
+        Returns:
+            int: 处理后的全局模型版本号
+
+        Raises:
+            UnknownClientError: 客户端未注册
+            StaleUpdateError: 训练已结束、更新基于旧版本或重复提交
+            ValueError: 更新格式错误、权重无效或参数包含非有限值
+        """
+        update = deserialize(data)
+        with self._lock:
+            if client_id not in self.agents:
+                raise UnknownClientError(f"未注册的客户端: {client_id}")
+            self.agents[client_id]["last_seen"] = datetime.now().strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+            if self.finished:
+                raise StaleUpdateError("训练已结束")
+            if base_version != self.version:
+                raise StaleUpdateError(
+                    f"更新基于版本 {base_version}，当前版本为 {self.version}"
+                )
+            if client_id in self._updates:
+                raise StaleUpdateError(f"客户端 {client_id} 已提交版本 {base_version}")
+
+            flat_buffers, weight, loss, update_error = self._check_update(update)
+            self._updates[client_id] = (
+                self.server.flat_store.state_dict_view(flat_buffers),
+                weight,
+                loss,
+                update_error,
+                len(data),
+            )
+            log_print(
+                f"收到客户端 {self.agents[client_id]['name']} 的更新 "
+                f"(版本 {base_version}, {len(data) / 1024**2:.2f} MB, "
+                f"{len(self._updates)}/{self.num_clients})",
+                is_training=True,
+            )
+            if len(self._updates) >= self.num_clients:
+                self._aggregate()
+            return self.version
+
+    def _check_update(self, update):
+        """
+        检查并解压一个客户端更新（调用方持有锁）
+
+        Args:
+            update: 反序列化的 {"payload", "weight", "loss", "update_error"}
+
+        Returns:
+            tuple: (还原的扁平张量 {dtype: tensor}, 权重, 损失, 压缩误差)
+
+        Raises:
+            ValueError: 更新格式错误、权重无效或参数包含非有限值
+        """
+        global_buffers = self.server.flat_store.flat_buffers
+        try:
+            weight = float(update["weight"])
+            loss = float(update["loss"])
+            update_error = float(update["update_error"])
+            payload = update["payload"]
+            if payload["method"] != self.config["update_compression"]:
+                raise ValueError(
+                    f"压缩方式 {payload['method']} 与服务器配置 "
+                    f"{self.config['update_compression']} 不一致"
+                )
+            dtypes = set(payload["tensors"]) | set(payload["raw"])
+            if dtypes != set(global_buffers):
+                raise ValueError(
+                    f"参数dtype {sorted(map(str, dtypes))} 与全局模型不一致"
+                )
+            for dtype, base in global_buffers.items():
+                compressed = payload["tensors"].get(dtype)
+                if compressed is not None and compressed["numel"] != base.numel():
+                    raise ValueError(
+                        f"{dtype} 元素数 {compressed['numel']} 与全局模型 {base.numel()} 不一致"
+                    )
+            # 解压时使用当前全局参数，与客户端计算增量的基准相同
+            flat_buffers = decompress_update(payload, global_buffers)
+        except (KeyError, TypeError, IndexError, AttributeError, RuntimeError) as e:
+            raise ValueError(f"更新格式错误: {e!r}") from e
+
+        if not math.isfinite(weight) or weight <= 0:
+            raise ValueError(f"无效的客户端权重: {weight}")
+        if not math.isfinite(loss) or not math.isfinite(update_error):
+            raise ValueError(f"客户端损失或压缩误差不是有限值: {loss}, {update_error}")
+        for dtype, base in global_buffers.items():
+            tensor = flat_buffers[dtype]
+            if (
+                not torch.is_tensor(tensor)
+                or tensor.dtype != base.dtype
+                or tensor.shape != base.shape
+            ):
+                raise ValueError(f"{dtype} 参数的类型或形状与全局模型不一致")
+            if tensor.is_floating_point() and not torch.isfinite(tensor).all():
+                raise ValueError(f"{dtype} 参数包含非有限值")
+        return flat_buffers, weight, loss, update_error
+
+    def _aggregate(self):
+        """聚合当前版本收到的所有更新（调用方持有锁）"""
+        client_ids = sorted(self._updates)
+        updates = [self._updates[i] for i in client_ids]
+        try:
+            self.server.federated_averaging(
+                [params for params, *_ in updates],
+                [weight for _, weight, *_ in updates],
+            )
+        except Exception as e:
+            # 丢弃本轮更新，版本号不变，客户端代理在状态中看不到自己的待聚合更新后重新训练
+            self._updates = {}
+            log_print(
+                f"第 {self.version + 1} 轮聚合失败，已丢弃本轮更新: {e}",
+                is_training=True,
+            )
+            return
+
+        history = self.server.training_history
+        update_bytes = sum(size for *_, size in updates)
+        dense_bytes = self.server.flat_store.nbytes * len(updates)
+        avg_loss = float(np.mean([loss for _, _, loss, _, _ in updates]))
+        history["rounds"].append(self.version)
+        history["avg_loss"].append(avg_loss)
+        history["selected_clients"].append(client_ids)
+        history["update_bytes"].append(update_bytes)
+        history["compression_ratio"].append(dense_bytes / update_bytes)
+        history["update_error"].append(
+            float(np.mean([error for *_, error, _ in updates]))
+        )
+        self._updates = {}
+        log_print(
+            f"第 {self.version} 轮聚合完成 - 平均客户端损失 {avg_loss:.4f}, "
+            f"上传 {update_bytes / 1024**2:.2f} MB",
+            is_training=True,
+        )
+
+        if self.version >= self.global_rounds:
+            self.finished = True
+            self.server.save_global_model(self.save_path)
+            log_print(
+                f"远程联邦训练完成，模型已保存: {self.save_path}", is_training=True
+            )
+
+        status = self._training_status
+        if status:
+            status["current_round"] = self.version
+            status["progress"] = int(self.version / self.global_rounds * 100)
+            status["selected_clients"] = client_ids
+            if self.finished:
+                status["is_training"] = False
+                status["end_time"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                status["stop_reason"] = f"完成全部 {self.global_rounds} 轮"
+
+    def stop(self, reason="服务器手动停止"):
+        """
+        提前结束远程训练：丢弃未聚合的更新，已完成至少一轮时保存全局模型
+
+        Args:
+            reason: 结束原因
+
+        Returns:
+            bool: 是否停止了正在进行的训练（已结束时为False）
+        """
+        with self._lock:
+            if self.finished:
+                return False
+            self.finished = True
+            self._updates = {}
+            if self.version > 0:
+                self.server.save_global_model(self.save_path)
+            log_print(
+                f"远程联邦训练已停止 ({reason})，完成 {self.version} 轮",
+                is_training=True,
+            )
+            status = self._training_status
+            if status:
+                status["is_training"] = False
+                status["end_time"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                status["stop_reason"] = reason
+            return True
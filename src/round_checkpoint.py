@@ -0,0 +1,119 @@
+"""
+联邦训练的轮次检查点
+每轮聚合完成后保存服务器状态（全局模型、轮次、训练历史、客户端本地状态和随机数状态），
+进程意外退出后可以从最后完成的轮次继续训练
+
+检查点在后台线程中写入，先写临时文件再原子替换，写入过程中崩溃不会损坏上一份检查点
+"""
+
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+
+DEFAULT_CHECKPOINT_PATH = "./checkpoints/federated_round.pth"
+
+
+def capture_rng_state():
+    """
+    获取Python、NumPy和torch的随机数状态
+
+    Returns:
+        dict: 随机数状态
+    """
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    """恢复capture_rng_state保存的随机数状态"""
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_round_checkpoint(path):
+    """
+    读取轮次检查点
+
+    Args:
+        path: 检查点路径
+
+    Returns:
+        dict: 检查点内容，文件不存在时返回None
+    """
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+class RoundCheckpointer:
+    """在后台线程中原子写入轮次检查点"""
+
+    def __init__(self, path=DEFAULT_CHECKPOINT_PATH):
+        """
+        Args:
+            path: 检查点路径（临时文件为 path + ".tmp"）
+        """
+        self.path = path
+        self._thread = None
+        # 最近一次写入的 (轮次, 耗时秒数) 和错误
+        self.last_saved = None
+        self.last_error = None
+
+    def save(self, state):
+        """
+        提交一份检查点，在后台线程中写入
+
+        state中的张量必须是快照（不会再被训练修改）；上一份检查点仍在写入时先等待其完成
+
+        Args:
+            state: 检查点内容
+        """
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(state,))
+        self._thread.start()
+
+    def _write(self, state):
+        start = time.perf_counter()
+        temp_path = self.path + ".tmp"
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(temp_path, "wb") as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self.last_saved = (state.get("round"), time.perf_counter() - start)
+        except Exception as e:
+            from federated_training import log_print
+
+            self.last_error = e
+            log_print(f"写入轮次检查点失败: {e}", is_training=True)
+
+    def wait(self):
+        """等待正在写入的检查点完成"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def remove(self):
+        """训练正常结束后删除检查点（等待正在进行的写入完成）"""
+        self.wait()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
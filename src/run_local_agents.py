@@ -0,0 +1,143 @@
+"""
+在本机验证远程联邦训练：启动Flask服务器和远程训练会话，再为每个数据目录启动一个
+client_agent.py进程，等待全部代理退出后打印每轮的聚合结果
+
+用法:
+    python src/run_local_agents.py --data-dirs ./client1_data ./client2_data --global-rounds 3
+
+每个数据目录对应一个客户端代理；--num-clients默认为数据目录数（每轮需要的更新数）
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SRC_DIR))
+
+import app as server_app  # noqa: E402
+from remote_training import TOKEN_HEADER  # noqa: E402
+
+
+def start_server(port, training_config):
+    """
+    在后台线程中启动Flask服务器，并以服务器身份启动远程训练
+
+    Args:
+        port: 监听端口（只绑定127.0.0.1）
+        training_config: POST /server/start_remote_training 的参数
+
+    Returns:
+        tuple: (服务器地址, 客户端代理的访问令牌)
+    """
+    client = server_app.app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session["username"] = "server"
+        flask_session["role"] = "server"
+    response = client.post("/server/start_remote_training", json=training_config)
+    if response.status_code != 200:
+        raise RuntimeError(f"启动远程训练失败: {response.get_json()}")
+    token = response.get_json()["token"]
+
+    thread = threading.Thread(
+        target=server_app.app.run,
+        kwargs={"host": "127.0.0.1", "port": port, "threaded": True},
+        daemon=True,
+    )
+    thread.start()
+
+    server_url = f"http://127.0.0.1:{port}"
+    request = urllib.request.Request(server_url + "/api/fl/status")
+    request.add_header(TOKEN_HEADER, token)
+    for _ in range(50):
+        try:
+            with urllib.request.urlopen(request, timeout=5):
+                return server_url, token
+        except urllib.error.URLError:
+            time.sleep(0.2)
+    raise RuntimeError(f"服务器未能在端口 {port} 上启动")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="在本机启动远程联邦训练服务器和客户端代理"
+    )
+    parser.add_argument(
+        "--data-dirs", nargs="+", required=True, help="各代理的数据目录"
+    )
+    parser.add_argument("--csv", default=os.path.join(SRC_DIR, "annotations.csv"))
+    parser.add_argument("--port", type=int, default=5052)
+    parser.add_argument("--num-clients", type=int, default=None)
+    parser.add_argument("--global-rounds", type=int, default=3)
+    parser.add_argument("--local-epochs", type=int, default=1)
+    parser.add_argument("--update-compression", default="int8")
+    parser.add_argument("--patch-size", type=int, nargs=3, default=(64, 64, 64))
+    parser.add_argument("--patches-per-volume", type=int, default=4)
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    args = parser.parse_args()
+
+    # 代理进程的工作目录是src/，相对路径按当前目录解析
+    data_dirs = [os.path.abspath(data_dir) for data_dir in args.data_dirs]
+    server_url, token = start_server(
+        args.port,
+        {
+            "num_clients": args.num_clients or len(data_dirs),
+            "global_rounds": args.global_rounds,
+            "local_epochs": args.local_epochs,
+            "update_compression": args.update_compression,
+        },
+    )
+    print(f"远程训练服务器已启动: {server_url}")
+
+    agent_args = [
+        "--server",
+        server_url,
+        "--csv",
+        os.path.abspath(args.csv),
+        "--patch-size",
+        *map(str, args.patch_size),
+        "--patches-per-volume",
+        str(args.patches_per_volume),
+        "--poll-interval",
+        str(args.poll_interval),
+    ]
+    if args.cache_dir:
+        agent_args += ["--cache-dir", os.path.abspath(args.cache_dir)]
+    # 令牌通过环境变量传给代理，不出现在进程的命令行中
+    agent_env = dict(os.environ, FL_AGENT_TOKEN=token)
+    agents = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(SRC_DIR, "client_agent.py")]
+            + agent_args
+            + ["--data-dir", data_dir],
+            cwd=SRC_DIR,
+            env=agent_env,
+        )
+        for data_dir in data_dirs
+    ]
+    try:
+        return_codes = [agent.wait() for agent in agents]
+    except KeyboardInterrupt:
+        server_app.remote_session.stop("本地测试被中断")
+        for agent in agents:
+            agent.terminate()
+        raise
+
+    history = server_app.remote_session.server.training_history
+    for round_num, loss, ratio in zip(
+        history["rounds"], history["avg_loss"], history["compression_ratio"]
+    ):
+        print(f"第 {round_num} 轮 - 平均客户端损失 {loss:.4f}, 压缩比 {ratio:.1f}x")
+    print(f"训练状态: {server_app.remote_session.status()}")
+    print(f"代理退出码: {return_codes}")
+    return 0 if all(code == 0 for code in return_codes) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+服务器端优化器（Adaptive Federated Optimization）
+把每轮聚合结果与上一轮全局参数之差 Δ = 平均参数 - 全局参数 视为伪梯度的反方向，
+由服务器优化器决定全局参数的实际更新量：
+    fedavg  - 全局参数 = 平均参数（即 全局参数 += Δ）
+    fedavgm - 服务器动量 m = β·m + Δ，全局参数 += lr·m
+    fedadam - Adam式一阶/二阶矩，全局参数 += lr·m / (sqrt(v) + τ)
+    fedyogi - 与fedadam相同，二阶矩按Yogi规则更新，v的增长更平缓
+
+只作用于可训练参数；BatchNorm统计量等缓冲区仍直接取聚合结果
+"""
+
+import torch
+
+SERVER_OPTIMIZERS = ("fedavg", "fedavgm", "fedadam", "fedyogi")
+
+# 各方法的默认服务器学习率（自适应方法的更新量约为 lr·sign(Δ)，需要较小的学习率）
+DEFAULT_SERVER_LR = {
+    "fedavg": 1.0,
+    "fedavgm": 1.0,
+    "fedadam": 0.01,
+    "fedyogi": 0.01,
+}
+
+
+def _clone_list(tensors):
+    return None if tensors is None else [t.clone() for t in tensors]
+
+
+class ServerOptimizer:
+    """作用于全局模型参数的服务器优化器，状态按参数顺序保存"""
+
+    def __init__(
+        self,
+        method="fedadam",
+        lr=None,
+        momentum=0.9,
+        beta1=0.9,
+        beta2=0.99,
+        tau=1e-3,
+    ):
+        """
+        Args:
+            method: 服务器优化方法，"fedavg"、"fedavgm"、"fedadam"或"fedyogi"
+            lr: 服务器学习率，None表示使用该方法的默认值
+            momentum: fedavgm的动量系数
+            beta1: fedadam/fedyogi的一阶矩系数
+            beta2: fedadam/fedyogi的二阶矩系数
+            tau: 自适应程度，数值稳定项（二阶矩初始化为τ²）
+        """
+        if method not in SERVER_OPTIMIZERS:
+            raise ValueError(
+                f"未知的服务器优化器: {method}，可选: {', '.join(SERVER_OPTIMIZERS)}"
+            )
+        self.method = method
+        self.lr = DEFAULT_SERVER_LR[method] if lr is None else lr
+        self.momentum = momentum
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.tau = tau
+
+        # 每个参数的一阶矩/动量和二阶矩
+        self.exp_avg = None
+        self.exp_avg_sq = None
+        self.steps = 0
+
+    def step(self, params, previous):
+        """
+        用聚合结果更新全局参数
+
+        Args:
+            params: 全局模型的参数列表，调用时已是本轮的平均参数，原地写入更新后的值
+            previous: 聚合前的全局参数（与params顺序一致）
+        """
+        if self.method == "fedavg":
+            self.steps += 1
+            return
+
+        with torch.no_grad():
+            if self.exp_avg is None:
+                self.exp_avg = [torch.zeros_like(p) for p in previous]
+                if self.method != "fedavgm":
+                    self.exp_avg_sq = [
+                        torch.full_like(p, self.tau**2) for p in previous
+                    ]
+
+            for i, (param, base) in enumerate(zip(params, previous)):
+                delta = param - base
+                exp_avg = self.exp_avg[i]
+                if self.method == "fedavgm":
+                    exp_avg.mul_(self.momentum).add_(delta)
+                    param.copy_(base).add_(exp_avg, alpha=self.lr)
+                    continue
+
+                exp_avg.mul_(self.beta1).add_(delta, alpha=1 - self.beta1)
+                exp_avg_sq = self.exp_avg_sq[i]
+                delta_sq = delta.square()
+                if self.method == "fedadam":
+                    exp_avg_sq.mul_(self.beta2).add_(delta_sq, alpha=1 - self.beta2)
+                else:
+                    # Yogi: v -= (1-β2)·Δ²·sign(v - Δ²)
+                    exp_avg_sq.addcmul_(
+                        delta_sq,
+                        torch.sign(exp_avg_sq - delta_sq),
+                        value=-(1 - self.beta2),
+                    )
+                denom = exp_avg_sq.sqrt().add_(self.tau)
+                param.copy_(base).addcdiv_(exp_avg, denom, value=self.lr)
+        self.steps += 1
+
+    def state_dict(self):
+        """优化器状态的拷贝（用于轮次检查点，后台写入时训练可以继续）"""
+        return {
+            "method": self.method,
+            "exp_avg": _clone_list(self.exp_avg),
+            "exp_avg_sq": _clone_list(self.exp_avg_sq),
+            "steps": self.steps,
+        }
+
+    def load_state_dict(self, state):
+        """
+        恢复state_dict保存的状态
+
+        Args:
+            state: state_dict的返回值
+        """
+        if state["method"] != self.method:
+            raise ValueError(
+                f"服务器优化器不一致: 检查点为 {state['method']}，当前为 {self.method}"
+            )
+        self.exp_avg = state["exp_avg"]
+        self.exp_avg_sq = state["exp_avg_sq"]
+        self.steps = state["steps"]
+
+    def describe(self):
+        """用于日志的简短描述"""
+        if self.method == "fedavg":
+            return "fedavg"
+        if self.method == "fedavgm":
+            return f"fedavgm (lr={self.lr}, momentum={self.momentum})"
+        return (
+            f"{self.method} (lr={self.lr}, beta1={self.beta1}, "
+            f"beta2={self.beta2}, tau={self.tau})"
+        )
@@ -1,10 +1,10 @@
 import os
 import numpy as np
 import pandas as pd
-import SimpleITK as sitk
 import torch
 import torch.nn.functional as F
 from train_simple_model import Simple3DUNet
+from metaimage_io import read_volume
 import matplotlib.pyplot as plt
 from scipy import ndimage
 import warnings
@@ -46,11 +46,8 @@ class SimpleLungNodulePredictor:
         """
         对单个CT图像进行预测
         """
-        # 加载图像
-        image = sitk.ReadImage(image_path)
-        image_array = sitk.GetArrayFromImage(image)
-        spacing = image.GetSpacing()
-        origin = image.GetOrigin()
+        # 加载图像（未压缩RAW直接memmap映射）
+        image_array, spacing, origin = read_volume(image_path)
 
         print(f"图像形状: {image_array.shape}")
         print(f"图像间距: {spacing}")
@@ -1,23 +1,83 @@
 import os
+import random
+import functools
+import contextlib
 import numpy as np
-import pandas as pd
 import SimpleITK as sitk
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.checkpoint import checkpoint
+from scipy import ndimage
+from torch.utils.data import (
+    Dataset,
+    IterableDataset,
+    DataLoader,
+    Sampler,
+    get_worker_info,
+)
+from torch.utils.data.dataloader import default_collate
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import warnings
+from annotation_index import get_annotation_index
+from metaimage_io import read_volume, NormalizedVolume
+from volume_manifest import VolumeManifest, get_volume_manifest
+from volume_cache import VolumeCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_BYTES
 
 warnings.filterwarnings("ignore")
 
 
+# 可以做激活检查点的conv_block阶段
+CHECKPOINT_STAGES = ("enc1", "enc2", "enc3", "bottleneck", "dec3", "dec2", "dec1")
+
+
+@contextlib.contextmanager
+def _frozen_bn_stats(module):
+    """
+    检查点重算前向时不更新BatchNorm统计量
+
+    训练模式下BN用批统计量归一化，重算结果与第一次前向相同；
+    统计量已在第一次前向时更新过，重算时把momentum置0并恢复num_batches_tracked
+    """
+    saved = [
+        (bn, bn.momentum, bn.num_batches_tracked.clone())
+        for bn in module.modules()
+        if isinstance(bn, nn.modules.batchnorm._BatchNorm) and bn.track_running_stats
+    ]
+    for bn, _, _ in saved:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, momentum, num_batches_tracked in saved:
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(num_batches_tracked)
+
+
 # 简化的3D UNet模型
 class Simple3DUNet(nn.Module):
-    def __init__(self, in_channels=1, out_channels=2):
+    def __init__(self, in_channels=1, out_channels=2, checkpoint_stages=None):
+        """
+        Args:
+            in_channels: 输入通道数
+            out_channels: 输出通道数
+            checkpoint_stages: 做激活检查点的conv_block阶段（CHECKPOINT_STAGES中的名称），
+                               "all"表示全部阶段，None表示不使用；这些阶段的中间激活不保存，
+                               反向传播时重算，以计算量换内存（不改变参数和state_dict）
+        """
         super(Simple3DUNet, self).__init__()
 
+        if checkpoint_stages == "all":
+            checkpoint_stages = CHECKPOINT_STAGES
+        checkpoint_stages = tuple(checkpoint_stages or ())
+        unknown = set(checkpoint_stages) - set(CHECKPOINT_STAGES)
+        if unknown:
+            raise ValueError(
+                f"未知的检查点阶段: {sorted(unknown)}，可选: {', '.join(CHECKPOINT_STAGES)}"
+            )
+        self.checkpoint_stages = checkpoint_stages
+
         # Encoder
         self.enc1 = self.conv_block(in_channels, 32)
         self.pool1 = nn.MaxPool3d(2)
@@ -53,36 +113,463 @@ class Simple3DUNet(nn.Module):
             nn.ReLU(inplace=True),
         )
 
+    def run_stage(self, name, x):
+        """执行一个conv_block阶段，训练且需要梯度时按配置做激活检查点"""
+        stage = getattr(self, name)
+        if name in self.checkpoint_stages and self.training and torch.is_grad_enabled():
+            # 第一次调用是前向，之后的调用是反向时的重算（不依赖torch 2.1才有的context_fn）
+            calls = []
+
+            def run(inputs):
+                if calls:
+                    with _frozen_bn_stats(stage):
+                        return stage(inputs)
+                calls.append(True)
+                return stage(inputs)
+
+            return checkpoint(run, x, use_reentrant=False)
+        return stage(x)
+
     def forward(self, x):
         # Encoder
-        enc1 = self.enc1(x)
+        enc1 = self.run_stage("enc1", x)
         pool1 = self.pool1(enc1)
 
-        enc2 = self.enc2(pool1)
+        enc2 = self.run_stage("enc2", pool1)
         pool2 = self.pool2(enc2)
 
-        enc3 = self.enc3(pool2)
+        enc3 = self.run_stage("enc3", pool2)
         pool3 = self.pool3(enc3)
 
         # Bottleneck
-        bottleneck = self.bottleneck(pool3)
+        bottleneck = self.run_stage("bottleneck", pool3)
 
         # Decoder
         up3 = self.upconv3(bottleneck)
         up3 = torch.cat([up3, enc3], dim=1)
-        dec3 = self.dec3(up3)
+        dec3 = self.run_stage("dec3", up3)
 
         up2 = self.upconv2(dec3)
         up2 = torch.cat([up2, enc2], dim=1)
-        dec2 = self.dec2(up2)
+        dec2 = self.run_stage("dec2", up2)
 
         up1 = self.upconv1(dec2)
         up1 = torch.cat([up1, enc1], dim=1)
-        dec1 = self.dec1(up1)
+        dec1 = self.run_stage("dec1", up1)
 
         return self.final(dec1)
 
 
+@functools.lru_cache(maxsize=512)
+def ellipsoid_kernel(radii):
+    """
+    生成体素空间中的椭球核（结果会被缓存，相同半径只计算一次）
+
+    Args:
+        radii: 各轴半径 (rz, ry, rx)，单位为体素
+
+    Returns:
+        只读的bool数组，形状为 (2*floor(rz)+1, 2*floor(ry)+1, 2*floor(rx)+1)
+    """
+    rz, ry, rx = radii
+    hz, hy, hx = int(rz), int(ry), int(rx)
+    zz, yy, xx = np.ogrid[-hz : hz + 1, -hy : hy + 1, -hx : hx + 1]
+    # 加一个很小的容差，避免整数半径边界上的浮点误差
+    kernel = (zz / rz) ** 2 + (yy / ry) ** 2 + (xx / rx) ** 2 <= 1.0 + 1e-9
+    kernel.setflags(write=False)
+    return kernel
+
+
+def nodule_voxel_geometry(world_coords, diameters, spacing, origin):
+    """
+    将结节的世界坐标和直径转换为体素坐标下的中心和各轴半径
+
+    Args:
+        world_coords: (N, 3) 世界坐标，(x, y, z)顺序
+        diameters: (N,) 直径(mm)
+        spacing: 图像间距 (x, y, z)
+        origin: 图像原点 (x, y, z)
+
+    Returns:
+        tuple: (centers, radii)，均为 (N, 3) 且为 (z, y, x) 顺序，
+               centers为整数体素坐标，radii为各轴体素半径（各向异性时为椭球）
+    """
+    world_coords = np.asarray(world_coords, dtype=np.float64).reshape(-1, 3)
+    diameters = np.asarray(diameters, dtype=np.float64).reshape(-1, 1)
+    spacing = np.asarray(spacing, dtype=np.float64)
+    voxel_coords = (world_coords - np.asarray(origin, dtype=np.float64)) / spacing
+
+    centers = voxel_coords[:, ::-1].astype(np.int64)
+    radii = np.maximum(1.0, diameters / (2 * spacing[::-1]))
+    return centers, radii
+
+
+def rasterize_nodules(label_array, centers, radii, offset=(0, 0, 0)):
+    """
+    在label中标记结节区域（向量化的椭球印章，替代逐体素的三重循环）
+
+    Args:
+        label_array: 要写入的label数组 (z, y, x)，原地修改
+        centers: (N, 3) 结节中心体素坐标 (z, y, x)
+        radii: (N, 3) 各轴体素半径 (z, y, x)
+        offset: label_array在整个体数据中的起始坐标 (z, y, x)，用于只写入某个patch
+
+    Returns:
+        label_array
+    """
+    shape = np.asarray(label_array.shape)
+    offset = np.asarray(offset, dtype=np.int64)
+
+    for center, radius in zip(centers, radii):
+        kernel = ellipsoid_kernel(tuple(np.round(radius, 2)))
+        start = (
+            np.asarray(center, dtype=np.int64) - offset - np.asarray(kernel.shape) // 2
+        )
+
+        # 裁剪到label范围内
+        lo = np.maximum(start, 0)
+        hi = np.minimum(start + kernel.shape, shape)
+        if np.any(hi <= lo):
+            continue
+        k_lo = lo - start
+        k_hi = hi - start
+
+        region = label_array[lo[0] : hi[0], lo[1] : hi[1], lo[2] : hi[2]]
+        region[kernel[k_lo[0] : k_hi[0], k_lo[1] : k_hi[1], k_lo[2] : k_hi[2]]] = 1
+
+    return label_array
+
+
+def resample_volume(image, spacing, target_spacing, order=1):
+    """
+    将体数据重采样到目标间距（例如1mm各向同性）
+
+    原点保持不变，新体素i对应原体素坐标 i * target_spacing / spacing，
+    因此世界坐标仍为 origin + i * target_spacing
+
+    Args:
+        image: 体数据 (z, y, x)
+        spacing: 原始间距 (x, y, z)
+        target_spacing: 目标间距 (x, y, z)
+        order: 插值阶数，1为线性插值
+
+    Returns:
+        tuple: (resampled_image, new_spacing)，new_spacing为 (x, y, z)
+    """
+    spacing_zyx = np.asarray(spacing, dtype=np.float64)[::-1]
+    target_zyx = np.asarray(target_spacing, dtype=np.float64)[::-1]
+    scale = target_zyx / spacing_zyx
+
+    # 新网格覆盖原体数据的物理范围
+    output_shape = tuple(
+        int(np.floor((s - 1) / f)) + 1 for s, f in zip(image.shape, scale)
+    )
+    resampled = ndimage.affine_transform(
+        np.asarray(image, dtype=np.float32),
+        scale,
+        output_shape=output_shape,
+        order=order,
+        mode="nearest",
+    )
+    return resampled, tuple(float(s) for s in target_spacing)
+
+
+def preprocessing_variant(target_spacing):
+    """预处理变体标识，用于区分不同重采样设置下的缓存条目"""
+    if target_spacing is None:
+        return ""
+    return "iso" + "x".join(f"{s:g}" for s in target_spacing)
+
+
+def center_patch_start(shape, patch_size):
+    """
+    计算中心裁剪patch的起始坐标（小于patch的维度两侧padding，大于的维度居中裁剪）
+
+    Returns:
+        (z, y, x)起始坐标，图像小于patch时为负数（表示需要padding）
+    """
+    return np.array(
+        [
+            (s - t) // 2 if s >= t else -((t - s) // 2)
+            for s, t in zip(shape, patch_size)
+        ],
+        dtype=np.int64,
+    )
+
+
+def crop_patch(array, start, patch_size):
+    """
+    从体数据中裁剪patch，超出边界的部分用0填充
+
+    Args:
+        array: 体数据 (z, y, x)，可以是memmap（只读取需要的页）
+        start: patch起始坐标 (z, y, x)，可以为负数或超出边界
+        patch_size: patch大小
+
+    Returns:
+        float32的patch数组
+    """
+    start = np.asarray(start, dtype=np.int64)
+    end = start + np.asarray(patch_size)
+    lo = np.clip(start, 0, array.shape)
+    hi = np.clip(end, 0, array.shape)
+
+    patch = np.zeros(patch_size, dtype=np.float32)
+    if np.all(hi > lo):
+        dst_lo = lo - start
+        dst_hi = hi - start
+        patch[dst_lo[0] : dst_hi[0], dst_lo[1] : dst_hi[1], dst_lo[2] : dst_hi[2]] = (
+            array[lo[0] : hi[0], lo[1] : hi[1], lo[2] : hi[2]]
+        )
+    return patch
+
+
+class VolumeGroupedSampler(Sampler):
+    """
+    按体数据分组的采样器：每个epoch打乱体数据顺序，
+    但同一体数据的K个patch连续产出，使每个体数据只需解码一次
+    """
+
+    def __init__(self, dataset, shuffle=True):
+        self.dataset = dataset
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        patches_per_volume = self.dataset.patches_per_volume
+        num_volumes = len(self.dataset) // patches_per_volume
+
+        volume_order = (
+            torch.randperm(num_volumes).tolist()
+            if self.shuffle
+            else list(range(num_volumes))
+        )
+        for volume_idx in volume_order:
+            patch_order = (
+                torch.randperm(patches_per_volume).tolist()
+                if self.shuffle
+                else range(patches_per_volume)
+            )
+            for patch_idx in patch_order:
+                yield volume_idx * patches_per_volume + patch_idx
+
+
+class VolumeGroupedBatchSampler(Sampler):
+    """
+    多worker加载时的按体数据分组batch采样器
+
+    DataLoader把第k个batch交给第 k % num_workers 个worker；batch_size小于
+    patches_per_volume时，直接按顺序切分batch会把同一体数据的patch分到不同worker，
+    每个worker各解码一次。这里按VolumeGroupedSampler的体数据顺序轮流把整个体数据
+    分配给各worker，各worker的patch各自切分成batch后再交错排列，
+    使每个体数据只由一个worker解码（只有epoch末尾各worker的batch数不相等时，
+    最后几个batch可能落到其他worker上）
+    """
+
+    def __init__(self, sampler, batch_size, num_workers):
+        """
+        Args:
+            sampler: VolumeGroupedSampler，决定体数据和patch的顺序
+            batch_size: 批大小
+            num_workers: DataLoader的worker数
+        """
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+
+    def _worker_patch_counts(self):
+        patches_per_volume = self.sampler.dataset.patches_per_volume
+        num_volumes = len(self.sampler) // patches_per_volume
+        return [
+            (num_volumes // self.num_workers + (w < num_volumes % self.num_workers))
+            * patches_per_volume
+            for w in range(self.num_workers)
+        ]
+
+    def __len__(self):
+        return sum(
+            (count + self.batch_size - 1) // self.batch_size
+            for count in self._worker_patch_counts()
+        )
+
+    def __iter__(self):
+        patches_per_volume = self.sampler.dataset.patches_per_volume
+        worker_indices = [[] for _ in range(self.num_workers)]
+        for position, idx in enumerate(self.sampler):
+            # 第 n 个体数据分配给第 n % num_workers 个worker
+            volume_position = position // patches_per_volume
+            worker_indices[volume_position % self.num_workers].append(idx)
+
+        worker_batches = [
+            [
+                indices[start : start + self.batch_size]
+                for start in range(0, len(indices), self.batch_size)
+            ]
+            for indices in worker_indices
+        ]
+        for batch_idx in range(max(len(batches) for batches in worker_batches)):
+            for batches in worker_batches:
+                if batch_idx < len(batches):
+                    yield batches[batch_idx]
+
+
+def seed_worker(worker_id):
+    """
+    DataLoader工作进程初始化：限制每个worker的线程数，并为每个worker设置独立的随机种子
+    （否则各worker会复制相同的随机状态，产生相同的patch位置）
+    """
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+    torch.set_num_threads(1)
+
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+    worker_info = get_worker_info()
+    dataset = worker_info.dataset if worker_info is not None else None
+    # 兼容Subset等包装的数据集
+    while dataset is not None and not hasattr(dataset, "rng"):
+        dataset = getattr(dataset, "dataset", None)
+    if dataset is not None:
+        dataset.rng = np.random.default_rng(seed)
+
+
+class FailureTolerantCollate:
+    """
+    容错的batch组装函数：丢弃加载失败的样本（series_uid为"error"），
+    可选地从最近加载成功的少量样本（内存中的备用样本）中补齐，并在batch中记录丢弃数量
+
+    补齐不再访问数据集，不会解码无关的体数据、打断VolumeGroupedSampler的分组；
+    备用样本用数据集的随机数生成器（每个worker独立设置种子）选取
+
+    返回的batch额外包含 "num_dropped" 和 "num_refilled"；
+    所有样本都失败且没有备用样本时返回batch大小为0的空batch
+    """
+
+    def __init__(self, dataset=None, refill=False, reserve_size=4):
+        """
+        Args:
+            dataset: 数据集（使用其rng选取备用样本，没有时使用独立的随机数生成器）
+            refill: 是否补齐被丢弃的样本
+            reserve_size: 保留的备用样本数
+        """
+        self.dataset = dataset
+        self.refill = refill
+        self.reserve_size = reserve_size
+        self.reserve = []
+        self._rng = None
+
+    def _random_index(self, n):
+        rng = getattr(self.dataset, "rng", None)
+        if rng is None:
+            if self._rng is None:
+                self._rng = np.random.default_rng()
+            rng = self._rng
+        return int(rng.integers(n))
+
+    def _remember(self, samples):
+        """把加载成功的样本加入备用样本（满了之后随机替换）"""
+        for sample in samples:
+            if len(self.reserve) < self.reserve_size:
+                self.reserve.append(sample)
+            elif self.reserve_size > 0:
+                self.reserve[self._random_index(self.reserve_size)] = sample
+
+    def __call__(self, samples):
+        # 非字典格式的样本（如模拟数据集）直接使用默认组装
+        if not samples or not isinstance(samples[0], dict):
+            return default_collate(samples)
+
+        valid = [s for s in samples if s["series_uid"] != "error"]
+        num_dropped = len(samples) - len(valid)
+        num_refilled = 0
+
+        if self.refill:
+            refills = []
+            if num_dropped > 0 and self.reserve:
+                refills = [
+                    self.reserve[self._random_index(len(self.reserve))]
+                    for _ in range(num_dropped)
+                ]
+            self._remember(valid)
+            valid += refills
+            num_refilled = len(refills)
+
+        if valid:
+            batch = default_collate(valid)
+        else:
+            # 全部失败：返回空batch，保持张量形状便于调用方统一处理
+            template = samples[0]
+            batch = {
+                "image": template["image"].new_zeros((0, *template["image"].shape)),
+                "label": template["label"].new_zeros((0, *template["label"].shape)),
+                "series_uid": [],
+            }
+
+        batch["num_dropped"] = num_dropped
+        batch["num_refilled"] = num_refilled
+        return batch
+
+
+def build_data_loader(
+    dataset,
+    batch_size=1,
+    shuffle=False,
+    sampler=None,
+    num_workers=0,
+    prefetch_factor=2,
+    pin_memory=False,
+    persistent_workers=True,
+    refill_failed=False,
+):
+    """
+    创建数据加载器；num_workers>0时在后台进程中预取数据，与训练计算重叠
+
+    Args:
+        dataset: 数据集
+        batch_size: 批大小
+        shuffle: 是否打乱（指定sampler时忽略）
+        sampler: 自定义采样器（VolumeGroupedSampler在多worker时按体数据分配worker）
+        num_workers: 数据加载进程数，0表示在主进程中加载
+        prefetch_factor: 每个worker预取的batch数
+        pin_memory: 是否使用锁页内存（GPU训练时加速拷贝）
+        persistent_workers: epoch之间是否保留worker进程（保留各worker的体数据缓存）
+        refill_failed: 是否用最近加载成功的样本补齐加载失败的样本
+
+    Returns:
+        DataLoader
+    """
+    loader_kwargs = {
+        "batch_size": batch_size,
+        "num_workers": num_workers,
+        "pin_memory": pin_memory,
+        "collate_fn": FailureTolerantCollate(dataset, refill=refill_failed),
+    }
+    if isinstance(sampler, VolumeGroupedSampler) and num_workers > 1:
+        # 同一体数据的patch留在同一个worker中，只解码一次
+        loader_kwargs["batch_sampler"] = VolumeGroupedBatchSampler(
+            sampler, loader_kwargs.pop("batch_size"), num_workers
+        )
+    elif sampler is not None:
+        loader_kwargs["sampler"] = sampler
+    elif isinstance(dataset, IterableDataset):
+        # 流式数据集自行打乱，DataLoader不接受shuffle参数
+        pass
+    else:
+        loader_kwargs["shuffle"] = shuffle
+    if num_workers > 0:
+        loader_kwargs.update(
+            {
+                "prefetch_factor": prefetch_factor,
+                "persistent_workers": persistent_workers,
+                "worker_init_fn": seed_worker,
+            }
+        )
+    return DataLoader(dataset, **loader_kwargs)
+
+
 class SimpleLUNA16Dataset(Dataset):
     def __init__(
         self,
@@ -92,16 +579,52 @@ class SimpleLUNA16Dataset(Dataset):
         max_samples=None,
         patch_size=(64, 64, 64),
         is_custom=False,
+        cache_dir=None,
+        cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+        sampling="center",
+        patches_per_volume=1,
+        positive_ratio=0.5,
+        jitter=16,
+        target_spacing=None,
     ):
         """
         简化的LUNA16数据集加载器
+
+        cache_dir不为None时，标准化后的体数据会缓存到磁盘，
+        之后的epoch/轮次直接通过memmap读取，不再重复解码MHD/RAW
+
+        sampling为"center"时每个体数据只取中心patch；为"annotation"时每个体数据
+        取patches_per_volume个patch，其中positive_ratio比例以标注结节为中心
+        （带±jitter体素的随机抖动），其余为随机位置的负样本
+
+        target_spacing不为None时（如(1.0, 1.0, 1.0)），体数据会先重采样到该间距，
+        重采样结果与标准化结果一起缓存
         """
         self.data_dir = data_dir
         self.patch_size = patch_size
+        self.target_spacing = target_spacing
+
+        # patch采样设置
+        if sampling not in ("center", "annotation"):
+            raise ValueError(f"不支持的patch采样方式: {sampling}")
+        self.sampling = sampling
+        self.patches_per_volume = 1 if sampling == "center" else patches_per_volume
+        self.positive_ratio = positive_ratio
+        self.jitter = jitter
+        self.rng = np.random.default_rng()
+
+        # 最近一次加载的体数据，同一体数据的多个patch复用
+        self._volume_memo = None
+
+        # 标准化体数据的磁盘缓存
+        self.volume_cache = (
+            VolumeCache(cache_dir, max_bytes=cache_max_bytes) if cache_dir else None
+        )
 
-        # 读取标注文件
-        self.annotations = pd.read_csv(csv_path)
-        print(f"总共有 {len(self.annotations)} 个标注")
+        # 读取标注文件（进程内共享的索引，只在CSV变化时重新加载）
+        self.csv_path = csv_path
+        self.annotation_index = get_annotation_index(csv_path)
+        print(f"总共有 {len(self.annotation_index)} 个标注")
 
         # 获取所有可用的mhd文件
         self.image_files = []
@@ -120,7 +643,7 @@ class SimpleLUNA16Dataset(Dataset):
                     for mhd_file in mhd_files:
                         series_uid = mhd_file.replace(".mhd", "")
                         # 检查是否有对应的标注
-                        if series_uid in self.annotations["seriesuid"].values:
+                        if series_uid in self.annotation_index:
                             self.image_files.append(
                                 {
                                     "series_uid": series_uid,
@@ -133,13 +656,28 @@ class SimpleLUNA16Dataset(Dataset):
 
             print(f"找到 {len(self.image_files)} 个有标注的图像文件")
         else:
-            # 自定义数据目录加载方式 - 直接扫描指定目录
-            if os.path.exists(data_dir):
+            # 自定义数据目录加载方式 - 优先读取目录清单，没有清单时直接扫描指定目录
+            if os.path.exists(data_dir) and VolumeManifest.exists(data_dir):
+                manifest = get_volume_manifest(data_dir, csv_path)
+                # 按mtime/大小同步清单之外的改动（手动拷贝或删除的文件），未变化的文件不会被打开
+                manifest.refresh()
+                for entry in manifest.paired_volumes():
+                    if entry["series_uid"] in self.annotation_index:
+                        self.image_files.append(
+                            {
+                                "series_uid": entry["series_uid"],
+                                "image_path": os.path.join(data_dir, entry["mhd_file"]),
+                                "subset": "custom",
+                                "shape": tuple(entry["shape"]),
+                            }
+                        )
+                print(f"从清单找到 {len(self.image_files)} 个自定义图像文件")
+            elif os.path.exists(data_dir):
                 mhd_files = [f for f in os.listdir(data_dir) if f.endswith(".mhd")]
                 for mhd_file in mhd_files:
                     series_uid = mhd_file.replace(".mhd", "")
                     # 检查是否有对应的标注
-                    if series_uid in self.annotations["seriesuid"].values:
+                    if series_uid in self.annotation_index:
                         self.image_files.append(
                             {
                                 "series_uid": series_uid,
@@ -157,7 +695,7 @@ class SimpleLUNA16Dataset(Dataset):
             print(f"限制到 {max_samples} 个样本用于测试")
 
     def __len__(self):
-        return len(self.image_files)
+        return len(self.image_files) * self.patches_per_volume
 
     def normalize_image(self, image):
         """图像标准化"""
@@ -165,86 +703,128 @@ class SimpleLUNA16Dataset(Dataset):
         image = (image + 1000) / 1400.0  # 归一化到0-1
         return image.astype(np.float32)
 
-    def extract_patch(self, image, label, target_size):
-        """提取固定大小的patch"""
-        # 如果图像比目标大小小，进行padding
-        if any(s < t for s, t in zip(image.shape, target_size)):
-            pad_width = [
-                (max(0, (t - s) // 2), max(0, (t - s + 1) // 2))
-                for s, t in zip(image.shape, target_size)
-            ]
-            image = np.pad(image, pad_width, mode="constant", constant_values=0)
-            label = np.pad(label, pad_width, mode="constant", constant_values=0)
+    def load_volume(self, series_uid, image_path):
+        """
+        加载标准化（及可选重采样）后的体数据，优先从磁盘缓存读取；未命中时直接映射RAW文件，
+        启用缓存时处理整个体数据并写入缓存，否则返回只在裁剪时标准化的延迟视图
 
-        # 如果图像比目标大小大，进行中心裁剪
-        if any(s > t for s, t in zip(image.shape, target_size)):
-            start = [(s - t) // 2 for s, t in zip(image.shape, target_size)]
-            end = [st + t for st, t in zip(start, target_size)]
-            image = image[start[0] : end[0], start[1] : end[1], start[2] : end[2]]
-            label = label[start[0] : end[0], start[1] : end[1], start[2] : end[2]]
+        Returns:
+            tuple: (image_array, spacing, origin)，spacing/origin为(x, y, z)顺序
+        """
+        variant = preprocessing_variant(self.target_spacing)
+        if self.volume_cache is not None:
+            cached = self.volume_cache.get(series_uid, image_path, variant)
+            if cached is not None:
+                image_array, meta = cached
+                return image_array, tuple(meta["spacing"]), tuple(meta["origin"])
+
+        # 未压缩数据为memmap，压缩数据回退到SimpleITK
+        raw_array, spacing, origin = read_volume(image_path)
+
+        if self.volume_cache is None and self.target_spacing is None:
+            return NormalizedVolume(raw_array, self.normalize_image), spacing, origin
+
+        image_array = self.normalize_image(raw_array)
+        if self.target_spacing is not None:
+            image_array, spacing = resample_volume(
+                image_array, spacing, self.target_spacing
+            )
+
+        if self.volume_cache is not None:
+            try:
+                self.volume_cache.put(
+                    series_uid,
+                    image_path,
+                    image_array,
+                    {"spacing": list(spacing), "origin": list(origin)},
+                    variant,
+                )
+            except OSError as e:
+                print(f"写入体数据缓存失败 {image_path}: {e}")
+
+        return image_array, spacing, origin
+
+    def __getstate__(self):
+        # 传给其他进程时不复制已加载的体数据
+        state = self.__dict__.copy()
+        state["_volume_memo"] = None
+        return state
+
+    def get_volume(self, series_uid, image_path):
+        """加载体数据，连续请求同一体数据时直接复用上一次的结果"""
+        if self._volume_memo is not None and self._volume_memo[0] == image_path:
+            return self._volume_memo[1]
+        volume = self.load_volume(series_uid, image_path)
+        self._volume_memo = (image_path, volume)
+        return volume
+
+    def plan_patch_start(self, shape, centers, patch_idx):
+        """
+        规划第patch_idx个patch的起始坐标
 
-        return image, label
+        Args:
+            shape: 体数据形状 (z, y, x)
+            centers: (N, 3) 结节中心体素坐标 (z, y, x)
+            patch_idx: 该体数据中的patch序号
+
+        Returns:
+            (z, y, x)起始坐标
+        """
+        patch_size = np.asarray(self.patch_size)
+        if self.sampling == "center":
+            return center_patch_start(shape, self.patch_size)
+
+        num_positive = (
+            int(round(self.patches_per_volume * self.positive_ratio))
+            if len(centers)
+            else 0
+        )
+
+        if patch_idx < num_positive:
+            # 正样本：以结节为中心并加随机抖动，依次覆盖所有结节
+            center = centers[patch_idx % len(centers)] + self.rng.integers(
+                -self.jitter, self.jitter + 1, size=3
+            )
+            return center - patch_size // 2
+
+        # 负样本：在体数据内随机取patch，尽量不包含结节中心
+        fallback = center_patch_start(shape, self.patch_size)
+        for _ in range(10):
+            start = np.array(
+                [
+                    self.rng.integers(0, s - t + 1) if s >= t else f
+                    for s, t, f in zip(shape, self.patch_size, fallback)
+                ],
+                dtype=np.int64,
+            )
+            inside = np.all((centers >= start) & (centers < start + patch_size), axis=1)
+            if not np.any(inside):
+                break
+        return start
 
     def __getitem__(self, idx):
-        item = self.image_files[idx]
+        volume_idx, patch_idx = divmod(idx, self.patches_per_volume)
+        item = self.image_files[volume_idx]
         series_uid = item["series_uid"]
         image_path = item["image_path"]
 
         try:
-            # 加载图像
-            image = sitk.ReadImage(image_path)
-            image_array = sitk.GetArrayFromImage(image)
-
-            # 获取图像的spacing和origin信息
-            spacing = image.GetSpacing()  # (x, y, z)
-            origin = image.GetOrigin()  # (x, y, z)
+            # 加载标准化后的图像（缓存命中时为memmap）
+            image_array, spacing, origin = self.get_volume(series_uid, image_path)
 
             # 获取该图像的所有标注
-            nodule_annotations = self.annotations[
-                self.annotations["seriesuid"] == series_uid
-            ]
+            world_coords, diameters = self.annotation_index.get(series_uid)
+            centers, radii = nodule_voxel_geometry(
+                world_coords, diameters, spacing, origin
+            )
 
-            # 创建标签mask
-            label_array = np.zeros_like(image_array, dtype=np.float32)
+            # 提取固定大小的patch（memmap只读取需要的页）
+            start = self.plan_patch_start(image_array.shape, centers, patch_idx)
+            image_array = crop_patch(image_array, start, self.patch_size)
 
-            for _, annotation in nodule_annotations.iterrows():
-                # 世界坐标转换为体素坐标
-                world_coord = np.array(
-                    [annotation["coordX"], annotation["coordY"], annotation["coordZ"]]
-                )
-                voxel_coord = (world_coord - np.array(origin)) / np.array(spacing)
-
-                z, y, x = int(voxel_coord[2]), int(voxel_coord[1]), int(voxel_coord[0])
-                diameter_mm = annotation["diameter_mm"]
-
-                # 将直径转换为体素单位
-                radius_voxels = max(1, int(diameter_mm / (2 * min(spacing))))
-
-                # 在label中标记结节区域（简化为球形）
-                for zi in range(
-                    max(0, z - radius_voxels),
-                    min(label_array.shape[0], z + radius_voxels + 1),
-                ):
-                    for yi in range(
-                        max(0, y - radius_voxels),
-                        min(label_array.shape[1], y + radius_voxels + 1),
-                    ):
-                        for xi in range(
-                            max(0, x - radius_voxels),
-                            min(label_array.shape[2], x + radius_voxels + 1),
-                        ):
-                            if (zi - z) ** 2 + (yi - y) ** 2 + (
-                                xi - x
-                            ) ** 2 <= radius_voxels**2:
-                                label_array[zi, yi, xi] = 1.0
-
-            # 标准化图像
-            image_array = self.normalize_image(image_array)
-
-            # 提取固定大小的patch
-            image_array, label_array = self.extract_patch(
-                image_array, label_array, self.patch_size
-            )
+            # 只在patch范围内创建标签mask（各向异性spacing下结节为体素空间的椭球）
+            label_array = np.zeros(self.patch_size, dtype=np.float32)
+            rasterize_nodules(label_array, centers, radii, offset=start)
 
             # 转换为tensor
             image_tensor = torch.from_numpy(image_array).unsqueeze(0)  # 添加channel维度
@@ -292,6 +872,25 @@ class DiceLoss(nn.Module):
         return 1 - torch.mean(dice)
 
 
+def autocast_context(device, enabled=True):
+    """
+    bfloat16混合精度的autocast上下文，用于模型的前向计算
+
+    卷积在上下文中以bfloat16计算，参数、梯度和优化器状态仍为float32；
+    反向传播沿用前向时各算子的精度，损失应在上下文之外用float32输出计算
+
+    Args:
+        device: 计算设备
+        enabled: 是否启用混合精度，False时返回空上下文
+
+    Returns:
+        上下文管理器
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+
 def create_mock_dataset(patch_size=(64, 64, 64), num_samples=10):
     """创建模拟数据集用于演示"""
     class MockDataset(Dataset):
@@ -325,8 +924,20 @@ def create_mock_dataset(patch_size=(64, 64, 64), num_samples=10):
     return MockDataset(patch_size, num_samples)
 
 
-def train_simple_model(data_dir="./LUNA16", save_path="best_lung_nodule_model.pth"):
-    """训练简化模型"""
+def train_simple_model(
+    data_dir="./LUNA16",
+    save_path="best_lung_nodule_model.pth",
+    cache_dir=DEFAULT_CACHE_DIR,
+    num_workers=0,
+    batch_size=1,
+    mixed_precision=False,
+):
+    """
+    训练简化模型
+
+    Args:
+        mixed_precision: 是否使用bfloat16 autocast做前向/反向计算（损失仍为float32）
+    """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"使用设备: {device}")
 
@@ -348,6 +959,7 @@ def train_simple_model(data_dir="./LUNA16", save_path="best_lung_nodule_model.pt
             subset_folders=["subset0"],  # 只使用subset0
             max_samples=5,  # 很少的样本用于快速测试
             patch_size=(64, 64, 64),
+            cache_dir=cache_dir,
     )
 
     print("创建验证数据集...")
@@ -357,21 +969,23 @@ def train_simple_model(data_dir="./LUNA16", save_path="best_lung_nodule_model.pt
         subset_folders=["subset1"],  # 使用subset1作为验证集
         max_samples=2,  # 验证集更少样本
         patch_size=(64, 64, 64),
+        cache_dir=cache_dir,
     )
 
     # 创建数据加载器
-    train_loader = DataLoader(
+    train_loader = build_data_loader(
         train_dataset,
-        batch_size=1,  # 小batch size
+        batch_size=batch_size,
         shuffle=True,
-        num_workers=0,  # 避免多进程问题
+        num_workers=num_workers,
+        refill_failed=True,
     )
 
-    val_loader = DataLoader(
+    val_loader = build_data_loader(
         val_dataset,
-        batch_size=1,
+        batch_size=batch_size,
         shuffle=False,
-        num_workers=0,
+        num_workers=num_workers,
     )
 
     print(f"训练样本数: {len(train_dataset)}")
@@ -392,7 +1006,7 @@ def train_simple_model(data_dir="./LUNA16", save_path="best_lung_nodule_model.pt
     num_epochs = 5  # 很少的epoch用于快速测试
     best_val_loss = float("inf")
 
-    print("开始训练...")
+    print("开始训练..." + (" (bfloat16混合精度)" if mixed_precision else ""))
     for epoch in range(num_epochs):
         model.train()
         train_loss = 0
@@ -403,15 +1017,17 @@ def train_simple_model(data_dir="./LUNA16", save_path="best_lung_nodule_model.pt
         # 训练阶段
         for batch_idx, batch_data in enumerate(train_loader):
             try:
-                if batch_data["series_uid"][0] == "error":
+                # 整个batch都加载失败时跳过
+                if len(batch_data["series_uid"]) == 0:
                     continue
 
                 images = batch_data["image"].to(device)
                 labels = batch_data["label"].to(device)
 
                 optimizer.zero_grad()
-                outputs = model(images)
-                loss = criterion(outputs, labels)
+                with autocast_context(device, mixed_precision):
+                    outputs = model(images)
+                loss = criterion(outputs.float(), labels)
                 loss.backward()
                 optimizer.step()
 
@@ -433,14 +1049,15 @@ def train_simple_model(data_dir="./LUNA16", save_path="best_lung_nodule_model.pt
         with torch.no_grad():
             for batch_idx, batch_data in enumerate(val_loader):
                 try:
-                    if batch_data["series_uid"][0] == "error":
+                    if len(batch_data["series_uid"]) == 0:
                         continue
 
                     images = batch_data["image"].to(device)
                     labels = batch_data["label"].to(device)
 
-                    outputs = model(images)
-                    loss = criterion(outputs, labels)
+                    with autocast_context(device, mixed_precision):
+                        outputs = model(images)
+                    loss = criterion(outputs.float(), labels)
                     val_loss += loss.item()
                     val_samples += 1
                     print(f"  验证批次 {batch_idx+1}: loss = {loss.item():.4f}")
@@ -0,0 +1,207 @@
+"""
+训练吞吐量计时
+按阶段累计每个batch的耗时，定位慢的轮次是卡在数据读取、拷贝、前向、反向还是聚合：
+    data_wait  - 等待数据加载器返回batch
+    h2d        - batch拷贝到计算设备
+    forward    - 前向计算和损失
+    backward   - 反向传播
+    optimizer  - 优化器更新和损失记录
+    param_copy - 分发全局模型参数（服务器端）
+    aggregation - 解压、聚合客户端参数（服务器端）
+
+计时只在阶段边界读取一次perf_counter，开销为每个batch几微秒；
+CUDA上默认在阶段边界记录CUDA事件（不同步设备，保留主机与设备的重叠），
+summary时同步一次再读取各事件之间的耗时；sync=True时改为在阶段边界同步设备
+"""
+
+import time
+
+import numpy as np
+import torch
+
+# 客户端每个batch的计时阶段
+STEP_PHASES = ("data_wait", "h2d", "forward", "backward", "optimizer")
+# 服务器每轮的计时阶段
+SERVER_PHASES = ("param_copy", "aggregation")
+
+
+class StepTimer:
+    """按阶段累计客户端本地训练的耗时"""
+
+    def __init__(self, device="cpu", sync=False):
+        """
+        Args:
+            device: 计算设备
+            sync: CUDA设备上是否在每个阶段边界同步设备（阶段归属精确，但主机要等待设备，
+                  训练会变慢）；False时用CUDA事件计时
+        """
+        is_cuda = torch.device(device).type == "cuda"
+        self.sync = is_cuda and sync
+        self.use_events = is_cuda and not sync
+        self.totals = dict.fromkeys(STEP_PHASES, 0.0)
+        # 每个batch的总耗时，以及最慢batch的各阶段耗时
+        self.step_times = []
+        self.step_max = 0.0
+        self.slowest = {}
+        self.samples = 0
+
+        self._current = {}
+        # CUDA事件计时：尚未读取的batch [(阶段事件列表, 样本数)]
+        self._pending = []
+        self._last = self._mark()
+        self._step_start = self._last
+
+    def _mark(self):
+        if self.use_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def wait(self):
+        """开始等待下一个batch（每个epoch开始时调用）"""
+        self._last = self._mark()
+
+    def lap(self, phase):
+        """
+        结束一个阶段：上一个边界到现在的耗时计入phase
+
+        Args:
+            phase: STEP_PHASES中的阶段名
+        """
+        now = self._mark()
+        if phase == "data_wait":
+            self._step_start = now
+        self._current[phase] = (self._last, now)
+        self._last = now
+
+    def end_step(self, num_samples):
+        """
+        结束一个batch（训练出错时也会调用，只记录已完成的阶段）
+
+        Args:
+            num_samples: batch中的有效样本数
+        """
+        now = self._mark()
+        self._current["step"] = (self._step_start, now)
+        self._last = now
+        if self.use_events:
+            self._pending.append((self._current, num_samples))
+        else:
+            self._record(
+                {phase: end - start for phase, (start, end) in self._current.items()},
+                num_samples,
+            )
+        self._current = {}
+
+    def _record(self, step, num_samples):
+        for phase in STEP_PHASES:
+            self.totals[phase] += step.get(phase, 0.0)
+        step_time = step["step"]
+        if not self.step_times or step_time > self.step_max:
+            self.step_max = step_time
+            self.slowest = {phase: step.get(phase, 0.0) for phase in STEP_PHASES}
+        self.step_times.append(step_time)
+        self.samples += num_samples
+
+    def _resolve_events(self):
+        """同步设备一次，读取所有待处理batch的事件耗时"""
+        if not self._pending:
+            return
+        torch.cuda.synchronize()
+        for events, num_samples in self._pending:
+            self._record(
+                {
+                    phase: start.elapsed_time(end) / 1000.0
+                    for phase, (start, end) in events.items()
+                },
+                num_samples,
+            )
+        self._pending = []
+
+    def summary(self):
+        """
+        汇总计时结果
+
+        Returns:
+            dict: 各阶段总耗时、compute（batch计算总耗时）、step_p50/step_p90/step_max
+                  （batch耗时分位数）、slowest_step（最慢batch的各阶段耗时）、
+                  samples、batches和samples_per_sec
+        """
+        self._resolve_events()
+        compute = sum(self.step_times)
+        elapsed = self.totals["data_wait"] + compute
+        p50, p90 = (
+            np.percentile(self.step_times, [50, 90]) if self.step_times else (0.0, 0.0)
+        )
+        result = dict(self.totals)
+        result.update(
+            {
+                "compute": compute,
+                "step_p50": float(p50),
+                "step_p90": float(p90),
+                "step_max": self.step_max,
+                "slowest_step": dict(self.slowest),
+                "samples": self.samples,
+                "batches": len(self.step_times),
+                "samples_per_sec": self.samples / elapsed if elapsed > 0 else 0.0,
+            }
+        )
+        return result
+
+
+def summarize_round(client_timings, param_copy, aggregation, wall_time):
+    """
+    汇总一轮的计时
+
+    Args:
+        client_timings: 客户端序号 -> StepTimer.summary()
+        param_copy: 参数分发耗时
+        aggregation: 聚合耗时
+        wall_time: 本轮从分发到聚合完成的总耗时
+
+    Returns:
+        dict: 各阶段耗时（客户端阶段为所有客户端之和）、样本数、
+              samples_per_sec（按本轮总耗时计算）和各客户端的计时
+    """
+    result = {
+        phase: sum(timing[phase] for timing in client_timings.values())
+        for phase in STEP_PHASES
+    }
+    samples = sum(timing["samples"] for timing in client_timings.values())
+    result.update(
+        {
+            "param_copy": param_copy,
+            "aggregation": aggregation,
+            "wall_time": wall_time,
+            "samples": samples,
+            "samples_per_sec": samples / wall_time if wall_time > 0 else 0.0,
+            "clients": {
+                client_id: {
+                    key: timing[key]
+                    for key in STEP_PHASES
+                    + (
+                        "compute",
+                        "step_p50",
+                        "step_p90",
+                        "step_max",
+                        "slowest_step",
+                        "samples",
+                        "samples_per_sec",
+                    )
+                }
+                for client_id, timing in client_timings.items()
+            },
+        }
+    )
+    return result
+
+
+def format_round_metrics(metrics):
+    """用于日志的一行阶段耗时摘要"""
+    phases = ", ".join(
+        f"{phase} {metrics[phase]:.2f}s" for phase in STEP_PHASES + SERVER_PHASES
+    )
+    return f"{phases}; {metrics['samples_per_sec']:.2f} 样本/秒"
@@ -0,0 +1,166 @@
+"""
+客户端→服务器参数更新的压缩
+客户端上传 训练后参数 - 本轮全局参数 的增量，而不是完整的float32 state_dict，支持：
+    delta - 不压缩的float32增量（用于对比）
+    int8  - 按块量化为8位整数，每块一个float32缩放系数
+    topk  - 只保留绝对值最大的k个元素（下标 + float32值）
+
+误差反馈（error feedback）：客户端保存本次压缩丢失的残差，下次上传前加回增量，
+被压缩掉的部分不会永久丢失
+
+服务器用本轮全局参数加上解压后的增量还原客户端参数，再交给原有的聚合流程
+"""
+
+import torch
+
+COMPRESSION_METHODS = ("delta", "int8", "topk")
+
+# int8量化的块大小（每块一个缩放系数）
+DEFAULT_BLOCK_SIZE = 1024
+
+
+def _quantize_int8(delta, block_size):
+    """按块对称量化为int8，返回 (量化值, 每块缩放系数)"""
+    padding = (-delta.numel()) % block_size
+    blocks = torch.nn.functional.pad(delta, (0, padding)).view(-1, block_size)
+    scales = blocks.abs().amax(dim=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = torch.round(blocks / scales[:, None]).clamp_(-127, 127).to(torch.int8)
+    return quantized, scales
+
+
+def _dequantize_int8(quantized, scales, numel):
+    return (quantized.float() * scales[:, None]).view(-1)[:numel]
+
+
+class UpdateCompressor:
+    """客户端的更新压缩器（误差反馈的残差按客户端保存）"""
+
+    def __init__(
+        self,
+        method="int8",
+        topk_ratio=0.01,
+        error_feedback=True,
+        block_size=DEFAULT_BLOCK_SIZE,
+    ):
+        """
+        Args:
+            method: 压缩方式，"delta"、"int8"或"topk"
+            topk_ratio: topk方式保留的元素比例
+            error_feedback: 是否把压缩残差累积到下一次上传
+            block_size: int8量化的块大小
+        """
+        if method not in COMPRESSION_METHODS:
+            raise ValueError(
+                f"未知的更新压缩方式: {method}，可选: {', '.join(COMPRESSION_METHODS)}"
+            )
+        self.method = method
+        self.topk_ratio = topk_ratio
+        self.error_feedback = error_feedback
+        self.block_size = block_size
+
+        # dtype -> 上次压缩丢失的残差
+        self.residuals = {}
+        # 最近一次压缩的相对误差 ||增量 - 还原增量|| / ||增量||
+        self.last_error = 0.0
+
+    def compress(self, client_store, global_store):
+        """
+        压缩客户端相对全局模型的参数增量
+
+        Args:
+            client_store: 训练完成的客户端FlatParameterStore
+            global_store: 客户端本轮开始时加载的全局FlatParameterStore
+
+        Returns:
+            dict: 压缩后的更新 {"method", "tensors": {dtype: 压缩数据}, "raw": {dtype: 张量}}，
+                  浮点参数压缩增量，整型缓冲区（num_batches_tracked）原样上传
+        """
+        payload = {"method": self.method, "tensors": {}, "raw": {}}
+        error_sq = 0.0
+        norm_sq = 0.0
+        for dtype, tensor in client_store.flat_buffers.items():
+            if not tensor.is_floating_point():
+                payload["raw"][dtype] = tensor.clone()
+                continue
+
+            delta = tensor.float() - global_store.flat_buffers[dtype].float()
+            if self.error_feedback and dtype in self.residuals:
+                delta += self.residuals[dtype]
+
+            if self.method == "int8":
+                quantized, scales = _quantize_int8(delta, self.block_size)
+                compressed = {"quantized": quantized, "scales": scales}
+            elif self.method == "topk":
+                k = max(1, int(delta.numel() * self.topk_ratio))
+                indices = delta.abs().topk(k, sorted=False).indices
+                compressed = {
+                    "indices": indices.to(torch.int32),
+                    "values": delta[indices],
+                }
+            else:
+                compressed = {"delta": delta}
+            compressed["numel"] = delta.numel()
+            payload["tensors"][dtype] = compressed
+
+            residual = delta - _decompress_delta(self.method, compressed)
+            error_sq += residual.square().sum().item()
+            norm_sq += delta.square().sum().item()
+            if self.error_feedback and self.method != "delta":
+                self.residuals[dtype] = residual
+
+        self.last_error = (error_sq / norm_sq) ** 0.5 if norm_sq > 0 else 0.0
+        return payload
+
+    def residual_nbytes(self):
+        """误差反馈残差占用的字节数"""
+        return sum(t.numel() * t.element_size() for t in self.residuals.values())
+
+
+def _decompress_delta(method, compressed):
+    """还原一个dtype的float32增量"""
+    if method == "int8":
+        return _dequantize_int8(
+            compressed["quantized"], compressed["scales"], compressed["numel"]
+        )
+    if method == "topk":
+        values = compressed["values"]
+        delta = torch.zeros(
+            compressed["numel"], dtype=values.dtype, device=values.device
+        )
+        delta[compressed["indices"].long()] = values
+        return delta
+    return compressed["delta"]
+
+
+def decompress_update(payload, global_buffers):
+    """
+    用全局参数加上解压后的增量还原客户端参数
+
+    Args:
+        payload: UpdateCompressor.compress的返回值
+        global_buffers: 全局模型的扁平张量 {dtype: tensor}
+
+    Returns:
+        dict: 还原后的扁平张量 {dtype: tensor}
+    """
+    flat_buffers = {}
+    for dtype, base in global_buffers.items():
+        if dtype in payload["raw"]:
+            flat_buffers[dtype] = payload["raw"][dtype]
+        else:
+            delta = _decompress_delta(payload["method"], payload["tensors"][dtype])
+            flat_buffers[dtype] = (base.float() + delta.to(base.device)).to(dtype)
+    return flat_buffers
+
+
+def payload_nbytes(payload):
+    """压缩更新的字节数（张量数据部分）"""
+    total = sum(t.numel() * t.element_size() for t in payload["raw"].values())
+    for compressed in payload["tensors"].values():
+        total += sum(
+            value.numel() * value.element_size()
+            for value in compressed.values()
+            if torch.is_tensor(value)
+        )
+    return total
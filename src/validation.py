@@ -0,0 +1,158 @@
+"""
+全局模型的验证集与早停
+从各客户端留出的体数据中采样一次验证patch并常驻内存（读取走标准化体数据缓存），
+之后每次评估直接使用，不再重复解码和采样，各轮的验证损失可以直接比较
+
+早停：验证损失连续patience次评估没有比最佳值降低超过min_delta时停止训练，
+并保留最佳轮次的模型参数
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+class ValidationPatches(Dataset):
+    """常驻内存的验证patch（标签以uint8保存，读取时转换为long）"""
+
+    def __init__(self, samples):
+        """
+        Args:
+            samples: [{"image", "label", "series_uid"}] 样本列表
+        """
+        self.samples = [
+            {
+                "image": sample["image"],
+                "label": sample["label"].to(torch.uint8),
+                "series_uid": sample["series_uid"],
+            }
+            for sample in samples
+        ]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        sample = self.samples[idx]
+        return {
+            "image": sample["image"],
+            "label": sample["label"].long(),
+            "series_uid": sample["series_uid"],
+        }
+
+    @property
+    def nbytes(self):
+        """验证patch占用的内存字节数"""
+        return sum(
+            s["image"].numel() * s["image"].element_size() + s["label"].numel()
+            for s in self.samples
+        )
+
+
+def build_validation_set(datasets, max_patches=None, seed=0):
+    """
+    从留出的数据集中采样验证patch
+
+    Args:
+        datasets: 留出体数据的数据集列表（例如各客户端的SimpleLUNA16Dataset）
+        max_patches: 最多保留的patch数，超过时随机子采样；None表示全部保留
+        seed: 子采样的随机种子
+
+    Returns:
+        ValidationPatches: 验证集
+    """
+    indices = [
+        (dataset_idx, idx)
+        for dataset_idx, dataset in enumerate(datasets)
+        for idx in range(len(dataset))
+    ]
+    if max_patches is not None and len(indices) > max_patches:
+        rng = np.random.default_rng(seed)
+        chosen = np.sort(rng.choice(len(indices), size=max_patches, replace=False))
+        indices = [indices[i] for i in chosen]
+
+    samples = []
+    for dataset_idx, idx in indices:
+        sample = datasets[dataset_idx][idx]
+        if sample["series_uid"] == "error":
+            continue
+        samples.append(sample)
+    return ValidationPatches(samples)
+
+
+class EarlyStopping:
+    """按验证损失早停，并保存最佳轮次的模型参数"""
+
+    def __init__(self, patience=3, min_delta=0.0):
+        """
+        Args:
+            patience: 验证损失连续多少次评估没有改善后停止
+            min_delta: 视为改善所需的最小降低量
+        """
+        self.patience = patience
+        self.min_delta = min_delta
+
+        self.best_loss = None
+        self.best_round = None
+        # 最佳轮次的模型参数拷贝
+        self.best_state = None
+        self.bad_evaluations = 0
+
+    def update(self, round_num, loss, model):
+        """
+        记录一次验证结果
+
+        Args:
+            round_num: 已完成的全局轮数
+            loss: 验证损失
+            model: 全局模型，损失改善时保存其参数拷贝
+
+        Returns:
+            bool: 本次是否为新的最佳结果
+        """
+        if self.best_loss is None or loss < self.best_loss - self.min_delta:
+            self.best_loss = loss
+            self.best_round = round_num
+            self.best_state = OrderedDict(
+                (name, tensor.detach().clone())
+                for name, tensor in model.state_dict().items()
+            )
+            self.bad_evaluations = 0
+            return True
+        self.bad_evaluations += 1
+        return False
+
+    @property
+    def should_stop(self):
+        """是否已连续patience次评估没有改善"""
+        return self.bad_evaluations >= self.patience
+
+    def stop_reason(self):
+        """早停原因的描述"""
+        return (
+            f"早停: 验证损失连续 {self.bad_evaluations} 次评估未改善 "
+            f"(最佳为第 {self.best_round} 轮, {self.best_loss:.4f})"
+        )
+
+    def state_dict(self):
+        """早停状态（用于轮次检查点；best_state只会整体替换，可以直接引用）"""
+        return {
+            "best_loss": self.best_loss,
+            "best_round": self.best_round,
+            "best_state": self.best_state,
+            "bad_evaluations": self.bad_evaluations,
+        }
+
+    def load_state_dict(self, state):
+        """
+        恢复state_dict保存的状态
+
+        Args:
+            state: state_dict的返回值
+        """
+        self.best_loss = state["best_loss"]
+        self.best_round = state["best_round"]
+        self.best_state = state["best_state"]
+        self.bad_evaluations = state["bad_evaluations"]
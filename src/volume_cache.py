@@ -0,0 +1,204 @@
+"""
+预处理体数据磁盘缓存
+将标准化后的CT体数据以紧凑的dtype保存为.npy文件，之后通过memmap读取，
+避免每个本地epoch、每个全局轮次都重新解码MHD/RAW文件
+
+缓存键由 series_uid + 源文件(mhd/raw)的mtime和大小 组成，源文件变化后自动失效；
+缓存总大小超过上限时按最近访问时间(LRU)淘汰
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+# 默认缓存目录和大小上限
+DEFAULT_CACHE_DIR = "./cache/volumes"
+DEFAULT_CACHE_MAX_BYTES = 20 * 1024**3  # 20GB
+
+
+def source_signature(image_path):
+    """
+    计算源文件签名（mhd及其对应raw文件的mtime和大小）
+
+    Args:
+        image_path: .mhd文件路径
+
+    Returns:
+        签名字符串
+    """
+    parts = []
+    raw_path = os.path.splitext(image_path)[0] + ".raw"
+    for path in (image_path, raw_path):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f"{os.path.basename(path)}:{stat.st_mtime_ns}:{stat.st_size}")
+    return "|".join(parts)
+
+
+class VolumeCache:
+    """标准化体数据的磁盘缓存（.npy + memmap，LRU淘汰）"""
+
+    def __init__(
+        self,
+        cache_dir=DEFAULT_CACHE_DIR,
+        max_bytes=DEFAULT_CACHE_MAX_BYTES,
+        dtype=np.float16,
+    ):
+        """
+        初始化体数据缓存
+
+        Args:
+            cache_dir: 缓存目录
+            max_bytes: 缓存总大小上限（字节）
+            dtype: 缓存数据类型，标准化到0-1后float16几乎无损
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # 命中统计
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_name(self, series_uid, image_path, variant=""):
+        """生成缓存条目名称"""
+        digest = hashlib.sha1(
+            f"{series_uid}|{source_signature(image_path)}|{variant}".encode("utf-8")
+        ).hexdigest()[:16]
+        return f"{series_uid}_{digest}"
+
+    def _paths(self, name):
+        base = os.path.join(self.cache_dir, name)
+        return base + ".npy", base + ".json"
+
+    def get(self, series_uid, image_path, variant=""):
+        """
+        从缓存读取体数据
+
+        Args:
+            series_uid: 序列UID
+            image_path: 源.mhd文件路径
+            variant: 预处理变体标识（不同预处理参数使用不同条目）
+
+        Returns:
+            (array, meta) 或 None，其中array为只读memmap
+        """
+        npy_path, meta_path = self._paths(
+            self._entry_name(series_uid, image_path, variant)
+        )
+        if not (os.path.exists(npy_path) and os.path.exists(meta_path)):
+            self.misses += 1
+            return None
+
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            array = np.load(npy_path, mmap_mode="r")
+            # 更新访问时间，用于LRU淘汰
+            os.utime(npy_path, None)
+        except (OSError, ValueError) as e:
+            print(f"读取缓存失败 {npy_path}: {e}")
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return array, meta
+
+    def put(self, series_uid, image_path, array, meta, variant=""):
+        """
+        写入缓存（先写临时文件再原子替换，支持多进程并发写入）
+
+        Args:
+            series_uid: 序列UID
+            image_path: 源.mhd文件路径
+            array: 标准化后的体数据
+            meta: 元数据字典（spacing、origin等，需可JSON序列化）
+            variant: 预处理变体标识
+        """
+        name = self._entry_name(series_uid, image_path, variant)
+        npy_path, meta_path = self._paths(name)
+        tmp_suffix = f".tmp{os.getpid()}"
+
+        # 删除同一序列的过期条目（源文件已变化）
+        self._remove_stale(series_uid, name, variant)
+
+        meta = dict(meta, series_uid=series_uid, variant=variant)
+        with open(meta_path + tmp_suffix, "w") as f:
+            json.dump(meta, f)
+        with open(npy_path + tmp_suffix, "wb") as f:
+            np.save(f, np.ascontiguousarray(array, dtype=self.dtype))
+        os.replace(meta_path + tmp_suffix, meta_path)
+        os.replace(npy_path + tmp_suffix, npy_path)
+
+        self.evict(keep=npy_path)
+
+    def _remove_stale(self, series_uid, current_name, variant):
+        """删除同一序列、同一变体的旧缓存条目"""
+        prefix = f"{series_uid}_"
+        for filename in os.listdir(self.cache_dir):
+            if not (filename.startswith(prefix) and filename.endswith(".json")):
+                continue
+            name = filename[: -len(".json")]
+            if name == current_name or len(name) != len(current_name):
+                continue
+            npy_path, meta_path = self._paths(name)
+            try:
+                with open(meta_path, "r") as f:
+                    if json.load(f).get("variant", "") != variant:
+                        continue
+            except (OSError, ValueError):
+                pass
+            for path in (npy_path, meta_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def total_bytes(self):
+        """缓存当前占用的字节数"""
+        total = 0
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(".npy"):
+                try:
+                    total += os.path.getsize(os.path.join(self.cache_dir, filename))
+                except OSError:
+                    pass
+        return total
+
+    def evict(self, keep=None):
+        """
+        按最近访问时间淘汰缓存条目，直到总大小不超过上限
+
+        Args:
+            keep: 不参与淘汰的条目路径（通常是刚写入的条目）
+        """
+        entries = []
+        total = 0
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".npy"):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+                continue
+            for victim in (path, path[: -len(".npy")] + ".json"):
+                try:
+                    os.remove(victim)
+                except OSError:
+                    pass
+            total -= size
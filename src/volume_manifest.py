@@ -0,0 +1,286 @@
+"""
+数据目录的体数据清单
+为每个 uploads/<client>_data 和 server_inference 目录维护一个清单文件，
+记录每个序列的形状、间距、原点、数据类型、字节数、mhd/raw配对、标注数量和内容哈希
+
+清单在文件上传时增量更新，数据集构建、patch规划和内存估算直接读取清单，
+不再重复扫描目录或打开图像
+"""
+
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+
+from metaimage_io import MetaImageHeader
+from annotation_index import get_annotation_index
+
+MANIFEST_FILENAME = ".volume_manifest.json"
+
+
+def _file_signature(path):
+    """文件签名 (mtime_ns, size)"""
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _content_hash(paths, chunk_size=1024 * 1024):
+    """计算多个文件内容的SHA1"""
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class VolumeManifest:
+    """单个数据目录的体数据清单"""
+
+    def __init__(self, directory, csv_path=None):
+        """
+        加载（或新建）目录清单
+
+        Args:
+            directory: 数据目录
+            csv_path: 标注文件路径，用于统计每个序列的标注数量
+        """
+        self.directory = directory
+        self.csv_path = csv_path
+        self.path = os.path.join(directory, MANIFEST_FILENAME)
+        self._lock = threading.RLock()
+
+        # 已登记的文件: filename -> [mtime_ns, size]
+        self.files = {}
+        # 体数据条目: mhd文件名 -> 元数据
+        self.volumes = {}
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                self.files = data.get("files", {})
+                self.volumes = data.get("volumes", {})
+            except (OSError, ValueError) as e:
+                print(f"读取清单失败 {self.path}: {e}，将重新建立")
+
+    @staticmethod
+    def exists(directory):
+        """目录中是否已有清单"""
+        return os.path.exists(os.path.join(directory, MANIFEST_FILENAME))
+
+    def _annotation_index(self):
+        if self.csv_path and os.path.exists(self.csv_path):
+            return get_annotation_index(self.csv_path)
+        return None
+
+    def _index_volume(self, mhd_name, annotation_index):
+        """解析.mhd文件头并生成清单条目（不读取像素数据）"""
+        mhd_path = os.path.join(self.directory, mhd_name)
+        header = MetaImageHeader(mhd_path)
+        series_uid = os.path.splitext(mhd_name)[0]
+
+        raw_name = None
+        if header.data_path is not None and header.data_path != mhd_path:
+            raw_name = os.path.basename(header.data_path)
+        has_raw = header.data_path is not None and os.path.exists(header.data_path)
+
+        data_files = [mhd_path]
+        if has_raw and header.data_path != mhd_path:
+            data_files.append(header.data_path)
+
+        return {
+            "series_uid": series_uid,
+            "mhd_file": mhd_name,
+            "raw_file": raw_name,
+            "has_raw": has_raw,
+            "shape": list(header.shape),
+            "spacing": list(header.spacing),
+            "origin": list(header.origin),
+            "dtype": header.element_type,
+            "compressed": header.compressed,
+            "mhd_size": os.path.getsize(mhd_path),
+            "raw_size": (
+                os.path.getsize(header.data_path)
+                if has_raw and header.data_path != mhd_path
+                else 0
+            ),
+            "nbytes": header.nbytes,
+            "annotation_count": (
+                annotation_index.count(series_uid) if annotation_index else 0
+            ),
+            "content_hash": _content_hash(data_files) if has_raw else None,
+            "modified_time": datetime.fromtimestamp(
+                os.path.getmtime(mhd_path)
+            ).strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    def update(self, filenames):
+        """
+        增量登记新到达的文件（上传完成后调用）
+
+        Args:
+            filenames: 新增或被覆盖的文件名列表
+        """
+        with self._lock:
+            annotation_index = self._annotation_index()
+            dirty_volumes = set()
+
+            for filename in filenames:
+                path = os.path.join(self.directory, filename)
+                if not os.path.exists(path):
+                    continue
+                self.files[filename] = _file_signature(path)
+
+                lower = filename.lower()
+                if lower.endswith(".mhd") or lower.endswith(".mha"):
+                    dirty_volumes.add(filename)
+                else:
+                    # 数据文件到达后，引用它的mhd条目需要重新配对
+                    dirty_volumes.update(
+                        name
+                        for name, entry in self.volumes.items()
+                        if entry.get("raw_file") == filename
+                    )
+                    if lower.endswith(".raw"):
+                        mhd_name = os.path.splitext(filename)[0] + ".mhd"
+                        if mhd_name in self.files:
+                            dirty_volumes.add(mhd_name)
+
+            for mhd_name in dirty_volumes:
+                try:
+                    self.volumes[mhd_name] = self._index_volume(
+                        mhd_name, annotation_index
+                    )
+                except (OSError, ValueError) as e:
+                    print(f"登记体数据失败 {mhd_name}: {e}")
+                    self.volumes.pop(mhd_name, None)
+
+            self.save()
+
+    def remove(self, filenames):
+        """
+        从清单中移除已删除的文件
+
+        Args:
+            filenames: 被删除的文件名列表
+        """
+        with self._lock:
+            removed = set(filenames)
+            for filename in removed:
+                self.files.pop(filename, None)
+                self.volumes.pop(filename, None)
+            for mhd_name, entry in list(self.volumes.items()):
+                if entry.get("raw_file") in removed:
+                    entry["has_raw"] = False
+            self.save()
+
+    def refresh(self):
+        """
+        与磁盘同步：只对签名(mtime/大小)变化的文件重新登记，未变化的文件不会被打开
+
+        用于服务启动时发现清单之外的改动（如手动拷贝的数据）
+        """
+        with self._lock:
+            if not os.path.isdir(self.directory):
+                return
+
+            present = {}
+            for entry in os.scandir(self.directory):
+                lower = entry.name.lower()
+                if entry.is_file() and lower.endswith((".mhd", ".mha", ".raw")):
+                    stat = entry.stat()
+                    present[entry.name] = [stat.st_mtime_ns, stat.st_size]
+
+            missing = [name for name in self.files if name not in present]
+            changed = [
+                name for name, sig in present.items() if self.files.get(name) != sig
+            ]
+
+            if missing:
+                self.remove(missing)
+            if changed:
+                self.update(changed)
+
+            # 标注文件可能更新，同步标注数量
+            annotation_index = self._annotation_index()
+            if annotation_index is not None:
+                for entry in self.volumes.values():
+                    entry["annotation_count"] = annotation_index.count(
+                        entry["series_uid"]
+                    )
+            self.save()
+
+    def save(self):
+        """原子写入清单文件"""
+        with self._lock:
+            if not os.path.isdir(self.directory):
+                return
+            tmp_path = f"{self.path}.tmp{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump({"files": self.files, "volumes": self.volumes}, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+    def paired_volumes(self):
+        """所有mhd与raw配对完整的体数据条目"""
+        return [entry for entry in self.volumes.values() if entry["has_raw"]]
+
+    @property
+    def mhd_count(self):
+        return sum(1 for name in self.files if name.lower().endswith(".mhd"))
+
+    @property
+    def raw_count(self):
+        return sum(1 for name in self.files if name.lower().endswith(".raw"))
+
+    @property
+    def file_pairs(self):
+        return len(self.paired_volumes())
+
+    def estimate_bytes(self, itemsize=4, series_uids=None):
+        """
+        估算加载体数据所需的内存
+
+        Args:
+            itemsize: 每个体素的字节数（float32标准化后为4）
+            series_uids: 只统计这些序列，None表示全部
+
+        Returns:
+            字节数
+        """
+        total = 0
+        for entry in self.paired_volumes():
+            if series_uids is not None and entry["series_uid"] not in series_uids:
+                continue
+            voxels = 1
+            for s in entry["shape"]:
+                voxels *= s
+            total += voxels * itemsize
+        return total
+
+
+_manifest_registry = {}
+_manifest_lock = threading.Lock()
+
+
+def get_volume_manifest(directory, csv_path=None):
+    """
+    获取进程内共享的目录清单实例
+
+    Args:
+        directory: 数据目录
+        csv_path: 标注文件路径
+
+    Returns:
+        VolumeManifest实例
+    """
+    key = os.path.abspath(directory)
+    with _manifest_lock:
+        manifest = _manifest_registry.get(key)
+        if manifest is None:
+            manifest = VolumeManifest(directory, csv_path)
+            _manifest_registry[key] = manifest
+        elif csv_path and manifest.csv_path is None:
+            manifest.csv_path = csv_path
+        return manifest